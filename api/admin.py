@@ -1,8 +1,17 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, Paginator
+from django.db import connection
+from django.forms.models import BaseInlineFormSet
+from django.utils.functional import cached_property
 from django.utils.html import format_html
 from django.urls import reverse
+import json
 
 from api.models import Company, Person, ScrapeError
+from api.helpers.search import search_companies, search_persons
+from api import constants
 
 
 def linkify(field_name):
@@ -24,10 +33,123 @@ def linkify(field_name):
         return format_html('<a href="{}">{}</a>', link_url, linked_obj)
 
     _linkify.short_description = field_name  # Sets column name
+    _linkify.select_related = field_name  # See ScrapedDataAdmin
     return _linkify
 
 
+def estimate_count(queryset):
+    """
+    PostgreSQL planner estimate of the number of rows of a queryset
+        - Unfiltered: the table statistics (pg_class.reltuples)
+        - Filtered: the row estimate of the query plan
+    None when no estimate is available
+    """
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+            # reltuples is negative (or 0 before PostgreSQL 14) until first analyzed
+            return int(row[0]) if row and row[0] > 0 else None
+        sql, params = queryset.query.sql_with_params()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Counts exactly only when the planner estimates fewer than
+    ADMIN_EXACT_COUNT_LIMIT rows, so a changelist never scans the table
+    to count it. Pages past an underestimated end are simply empty.
+    """
+    @cached_property
+    def count(self):
+        estimate = estimate_count(self.object_list)
+        if estimate is None or estimate < constants.ADMIN_EXACT_COUNT_LIMIT:
+            return super().count
+        return estimate
+
+    def validate_number(self, number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            if int(number) > 1:
+                return int(number)
+            raise
+
+
+def cached_values_filter(field_name, title):
+    """
+    List filter on the distinct values of a column, looked up at most
+    once every ADMIN_FILTER_CACHE_SECONDS instead of on every page load
+    """
+    class CachedValuesListFilter(admin.SimpleListFilter):
+        parameter_name = field_name
+
+        def lookups(self, request, model_admin):
+            key = f'admin-filter:{model_admin.model._meta.label}:{field_name}'
+            values = cache.get(key)
+            if values is None:
+                values = list(model_admin.model.objects.order_by(field_name).values_list(
+                    field_name, flat=True).distinct())
+                cache.set(key, values, constants.ADMIN_FILTER_CACHE_SECONDS)
+            return [(value, value) for value in values]
+
+        def queryset(self, request, queryset):
+            if self.value() is None:
+                return queryset
+            return queryset.filter(**{field_name: self.value()})
+
+    CachedValuesListFilter.title = title
+    return CachedValuesListFilter
+
+
+class RankedChangeList(ChangeList):
+    """
+    Search results of a search_function stay in rank order, which the
+    changelist ordering would replace, unless a column is sorted
+    """
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if (self.model_admin.search_function is not None and self.query.strip()
+                and ORDER_VAR not in self.params):
+            queryset = queryset.order_by('-rank', 'id')
+        return queryset
+
+
 class ScrapedDataAdmin(admin.ModelAdmin):
+    """
+    Read-only admin for large tables
+        - Changelist counts are planner estimates (EstimatedCountPaginator)
+        - Foreign keys shown with linkify are fetched with select_related
+        - Searches are ranked by search_function (RankedChangeList)
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # Ranked search function of helpers/search.py, replaces search_fields lookups
+    search_function = None
+
+    def get_list_select_related(self, request):
+        linked = [getattr(field, 'select_related') for field in self.list_display
+                  if hasattr(field, 'select_related')]
+        return linked or super().get_list_select_related(request)
+
+    def get_search_results(self, request, queryset, search_term):
+        if self.search_function is None or not search_term.strip():
+            return super().get_search_results(request, queryset, search_term)
+        results = self.search_function(queryset, search_term)
+        if ORDER_VAR in request.GET:
+            results = results.order_by(*queryset.query.order_by)  # The sorted column
+        return results, False
+
+    def get_changelist(self, request, **kwargs):
+        return RankedChangeList
+
     def has_add_permission(self, request, obj=None):
         return False
 
@@ -38,15 +160,30 @@ class ScrapedDataAdmin(admin.ModelAdmin):
         return False
 
 
+class CappedInlineFormSet(BaseInlineFormSet):
+    """ Only the first ADMIN_INLINE_LIMIT related objects are loaded """
+    def get_queryset(self):
+        if not hasattr(self, '_capped_queryset'):
+            self._capped_queryset = super().get_queryset()[:constants.ADMIN_INLINE_LIMIT]
+        return self._capped_queryset
+
+
 class PersonInline(admin.TabularInline):
     model = Person
+    formset = CappedInlineFormSet
+    fields = ('name', 'relationship', 'stock', 'quota', 'ratio', 'nationality')
     show_change_link = True
 
 
 class CompanyAdmin(ScrapedDataAdmin):
     list_display = ('name', 'description', 'governorate',
                     'show_company_url', 'missing_personnel_data')
+    list_filter = ('governorate',
+                   cached_values_filter('company_status', 'company status'),
+                   cached_values_filter('legal_form', 'legal form'),
+                   'missing_personnel_data')
     search_fields = ('name', )
+    search_function = staticmethod(search_companies)
     inlines = (
         PersonInline,
     )
@@ -55,10 +192,25 @@ class CompanyAdmin(ScrapedDataAdmin):
             'fields': ('name', 'show_company_url', 'description', 'governorate',
                        'registration_number', 'registration_date', 'record_type',
                        'company_status', 'company_duration', 'legal_form',
-                       'capital', 'title', 'additional_name', 'missing_personnel_data',)
+                       'capital', 'title', 'additional_name', 'missing_personnel_data',
+                       'show_personnel',)
         }),
     )
 
+    def show_personnel(self, instance):
+        count = instance.company.count()
+        if count <= constants.ADMIN_INLINE_LIMIT:
+            return count
+        return format_html(
+            '{0} (the first {1} are listed below, <a href="{2}?company__id__exact={3}">'
+            'see all</a>)',
+            count,
+            constants.ADMIN_INLINE_LIMIT,
+            reverse('admin:api_person_changelist'),
+            instance.pk
+        )
+    show_personnel.short_description = "Personnel"
+
     def show_company_url(self, instance):
         return format_html(
             '<a href="{0}" target="_blank">{1}</a>',
@@ -72,6 +224,7 @@ class PersonAdmin(ScrapedDataAdmin):
     list_display = ('name', linkify('company'),
                     'relationship', 'stock', 'nationality',)
     search_fields = ('name',)
+    search_function = staticmethod(search_persons)
     fieldsets = (
         (None, {
             'fields': ('name', linkify('company'),
@@ -81,6 +234,15 @@ class PersonAdmin(ScrapedDataAdmin):
     )
 
 
+class ScrapeErrorAdmin(admin.ModelAdmin):
+    list_display = ('cr_id', 'model_type', 'error_class', 'attempts',
+                    'next_retry_at', 'updated_at')
+    list_filter = ('error_class', 'model_type')
+    search_fields = ('=cr_id',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
 admin.site.register(Company, CompanyAdmin)
 admin.site.register(Person, PersonAdmin)
-admin.site.register(ScrapeError)
+admin.site.register(ScrapeError, ScrapeErrorAdmin)
@@ -1,14 +1,95 @@
 from django.conf import settings
 """
-Request Limit for Scraping, pauses for one second
-every time limit is reached
+URL endpoint for Lebanon Commercial Registry, the cr_id is appended.
+Set COMMERCIAL_REGISTRY_URL in the environment to crawl a stand-in
+instead (e.g. the synthetic_registry command).
 """
-REQUEST_LIMIT = 10
+COMMERCIAL_REGISTRY_URL = settings.COMMERCIAL_REGISTRY_URL
 
 """
-URL endpoint for Lebanon Commercial Registry
+Maximum number of registry pages fetched at once by a single worker
+process. This is also the size of the keep-alive connection pool.
 """
-COMMERCIAL_REGISTRY_URL = 'http://cr.justice.gov.lb/search/result.aspx?id='
+FETCH_CONCURRENCY = 20
+
+"""
+Seconds before a single registry request is abandoned
+"""
+FETCH_TIMEOUT = 30
+
+"""
+Requests/sec to the Commercial Registry shared by all workers.
+Starts at RATE_LIMIT_INITIAL and adapts between RATE_LIMIT_MIN and RATE_LIMIT_MAX:
+    - Adds RATE_LIMIT_INCREASE for every response faster than RATE_LIMIT_LATENCY_TARGET
+    - Multiplies by RATE_LIMIT_DECREASE for slow responses and errors,
+      at most once every RATE_LIMIT_DECREASE_COOLDOWN seconds
+RATE_LIMIT_BURST is how many requests may be made at once after an idle period
+"""
+RATE_LIMIT_INITIAL = 10
+RATE_LIMIT_MIN = 1
+RATE_LIMIT_MAX = 100
+RATE_LIMIT_BURST = 20
+RATE_LIMIT_INCREASE = 0.1
+RATE_LIMIT_DECREASE = 0.5
+RATE_LIMIT_DECREASE_COOLDOWN = 1
+RATE_LIMIT_LATENCY_TARGET = 2
+
+"""
+Consecutive registry errors that pause all fetching for CIRCUIT_OPEN_SECONDS
+"""
+CIRCUIT_FAILURE_THRESHOLD = 20
+CIRCUIT_OPEN_SECONDS = 60
+
+"""
+Number of consecutive cr_sub_ids handled by a single scrape_lcr_range task
+"""
+SCRAPE_BATCH_SIZE = 500
+
+"""
+BulkWriter buffers: companies and people buffered before a flush,
+and seconds after which a buffer is flushed regardless of its size
+"""
+BULK_WRITE_MAX_ROWS = 5000
+BULK_WRITE_FLUSH_INTERVAL = 30
+
+"""
+Scrape pipeline (see helpers/pipeline.py)
+    - SCRAPE_PIPELINE: whether scrape_lcr_range goes through it
+    - PIPELINE_QUEUE_SIZE: pages waiting between two stages, past which
+      the stage before waits
+    - PARSE_PROCESSES: processes parsing pages, 0 parses in a thread
+"""
+SCRAPE_PIPELINE = settings.SCRAPE_PIPELINE
+PIPELINE_QUEUE_SIZE = 200
+PARSE_PROCESSES = settings.SCRAPE_PARSE_PROCESSES
+
+"""
+Crawl dispatching (see helpers/dispatcher.py)
+    - MAX_CHUNKS_IN_FLIGHT: chunks of one governorate queued or running at once
+    - DISPATCH_INTERVAL: seconds between two dispatch_scrape passes
+    - DISPATCH_LOOP_TIMEOUT: seconds without pass after which the
+      dispatch_scrape loop is presumed dead, and scrape_lcr starts another
+    - CHUNK_TIMEOUT: seconds after which a dispatched chunk is presumed lost
+      and dispatched again
+    - CHUNK_MAX_ATTEMPTS: dispatches of a chunk before it is left failed
+      until the next crawl
+"""
+MAX_CHUNKS_IN_FLIGHT = 20
+DISPATCH_INTERVAL = 30
+DISPATCH_LOOP_TIMEOUT = 10 * 60
+CHUNK_TIMEOUT = 60 * 60
+CHUNK_MAX_ATTEMPTS = 5
+
+"""
+Chunk leases of lease_worker nodes (see helpers/dispatcher.py)
+    - LEASE_SECONDS: how long a claimed chunk stays leased without a
+      heartbeat, after which another node takes it over
+    - LEASE_HEARTBEAT_INTERVAL: seconds between two renewals of a lease
+    - LEASE_IDLE_SECONDS: seconds a node without chunk to claim waits
+"""
+LEASE_SECONDS = 5 * 60
+LEASE_HEARTBEAT_INTERVAL = 60
+LEASE_IDLE_SECONDS = 10
 
 """
 How many records to scrape for each governorate
@@ -16,6 +97,7 @@ NOTE:
 These are estimated original values based on manual searching.
 In other words, these were about the highest ids I could find on the LCR website for each
 government, and I assume that there aren't more ids higher than them as of 17-12-2020
+Only used for governorates whose id space was never probed (see id_discovery)
 """
 GOVERNORATE_SCRAPE_LIMIT = {
     1: int(settings.BEIRUT_SCRAPE_LIMIT),
@@ -25,3 +107,173 @@ GOVERNORATE_SCRAPE_LIMIT = {
     5: int(settings.SOUTH_LEBANON_SCRAPE_LIMIT),
     6: int(settings.NABATIEH_SCRAPE_LIMIT),
 }
+
+"""
+Size in bytes after which the page archive starts a new segment file
+"""
+ARCHIVE_SEGMENT_SIZE = 256 * 1024 * 1024
+
+"""
+ID space discovery: a probe looks at DISCOVERY_GAP_TOLERANCE consecutive ids,
+so runs of missing ids shorter than that are not mistaken for the end of the
+id space. The exponential search starts with steps of DISCOVERY_INITIAL_STEP ids.
+"""
+DISCOVERY_GAP_TOLERANCE = 50
+DISCOVERY_INITIAL_STEP = 1000
+
+"""
+Retries of ScrapeErrors: a failed cr_id is retried after RETRY_BASE_DELAY seconds,
+doubling for every further attempt up to RETRY_MAX_DELAY, and given up after
+RETRY_MAX_ATTEMPTS attempts. Empty records are first retried after EMPTY_RETRY_DELAY.
+RETRY_BATCH_SIZE errors are retried per retry_scrape_errors task.
+"""
+RETRY_BASE_DELAY = 5 * 60
+RETRY_MAX_DELAY = 30 * 24 * 60 * 60
+RETRY_MAX_ATTEMPTS = 8
+EMPTY_RETRY_DELAY = 7 * 24 * 60 * 60
+RETRY_BATCH_SIZE = 500
+
+"""
+Coverage index (see helpers/coverage.py): crawls skip the ids it holds
+    - COVERAGE_SCRAPED_TTL: seconds a scraped id stays fresh
+    - COVERAGE_MISSING_TTL: seconds an id without company is not fetched again
+    - COVERAGE_FAILED_TTL: seconds a failed id is left to retry_scrape_errors
+    - COVERAGE_BUCKET_SECONDS: length of the time buckets states are kept in
+    - COVERAGE_SCAN_SIZE: ids read from the index at once
+"""
+COVERAGE_SCRAPED_TTL = 30 * 24 * 60 * 60
+COVERAGE_MISSING_TTL = EMPTY_RETRY_DELAY
+COVERAGE_FAILED_TTL = 24 * 60 * 60
+COVERAGE_BUCKET_SECONDS = 24 * 60 * 60
+COVERAGE_SCAN_SIZE = 65536
+
+"""
+Recrawls (see helpers/recrawl.py)
+    - RECRAWL_DAILY_BUDGET: registry requests per (UTC) day spent on recrawls
+    - RECRAWL_INTERVAL: seconds between two recrawl_lcr passes, each taking
+      its share of the daily budget (the period of its CELERY_BEAT_SCHEDULE
+      entry)
+    - RECRAWL_NEW_IDS: ids past the known end of every governorate checked
+      first by each pass, for new registrations
+    - RECRAWL_MIN_INTERVAL: seconds between two checks of a company of
+      priority 1, longer for lower priorities up to RECRAWL_MAX_INTERVAL
+    - RECRAWL_CLAIM_TIMEOUT: seconds after which a company whose check
+      failed is due again
+    - RECRAWL_STATUS_WEIGHTS: priority weight of each company_status,
+      RECRAWL_DEFAULT_STATUS_WEIGHT for any other
+    - RECRAWL_AGE_HALF_LIFE: years after registration at which recency
+      counts for half
+    - RECRAWL_BATCH_SIZE: companies rescheduled at once
+"""
+RECRAWL_DAILY_BUDGET = settings.RECRAWL_DAILY_BUDGET
+RECRAWL_INTERVAL = 60 * 60
+RECRAWL_NEW_IDS = 10
+RECRAWL_MIN_INTERVAL = 7 * 24 * 60 * 60
+RECRAWL_MAX_INTERVAL = 180 * 24 * 60 * 60
+RECRAWL_CLAIM_TIMEOUT = 24 * 60 * 60
+RECRAWL_STATUS_WEIGHTS = {
+    'قائمة': 1,  # Active
+    'قيد التصفية': 0.5,  # In liquidation
+    'مشطوبة': 0.1,  # Struck off
+}
+RECRAWL_DEFAULT_STATUS_WEIGHT = 0.5
+RECRAWL_AGE_HALF_LIFE = 5
+RECRAWL_BATCH_SIZE = 2000
+
+"""
+Read API pagination: default and largest page size a client may ask for
+"""
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+"""
+Search endpoints: default and largest number of ranked results returned
+"""
+API_SEARCH_RESULTS = 20
+API_MAX_SEARCH_RESULTS = 100
+
+"""
+Admin on large tables
+    - ADMIN_EXACT_COUNT_LIMIT: changelists estimate counts above this many rows
+    - ADMIN_INLINE_LIMIT: related objects loaded by an inline
+    - ADMIN_FILTER_CACHE_SECONDS: lifetime of the values of a list filter
+"""
+ADMIN_EXACT_COUNT_LIMIT = 10000
+ADMIN_INLINE_LIMIT = 50
+ADMIN_FILTER_CACHE_SECONDS = 60 * 60
+
+"""
+Entity resolution (see helpers/entity_resolution.py)
+    - RESOLUTION_BATCH_SIZE: unresolved people matched per transaction
+    - RESOLUTION_MIN_SIMILARITY: name similarity (0 to 1) above which a
+      person is the same individual as a candidate sharing a blocking key
+    - RESOLUTION_MIN_WORD_SIMILARITY: least similarity of every pair of
+      compared words ('علي' and 'ايلي' share a key, but are not alike)
+"""
+RESOLUTION_BATCH_SIZE = 2000
+RESOLUTION_MIN_SIMILARITY = 0.85
+RESOLUTION_MIN_WORD_SIMILARITY = 0.75
+
+"""
+Ownership graph (see helpers/ownership_graph.py)
+    - GRAPH_QUERY_CHUNK_SIZE: rows fetched at once while reading edges
+    - GRAPH_MAX_DELTA_COMPANIES: changed companies above which an update
+      rebuilds the graph from scratch
+    - GRAPH_MAX_HOPS: deepest traversal served by the API
+    - GRAPH_REFRESH_SECONDS: seconds between two checks of a serving
+      process for people written or resolved since its graph was built
+"""
+GRAPH_QUERY_CHUNK_SIZE = 10000
+GRAPH_MAX_DELTA_COMPANIES = 50000
+GRAPH_MAX_HOPS = 4
+GRAPH_REFRESH_SECONDS = 5 * 60
+
+"""
+Companies read per query (and per Parquet row group) by the dataset export
+"""
+EXPORT_CHUNK_SIZE = 2000
+
+"""
+Columnar snapshot (see helpers/snapshot.py)
+    - SNAPSHOT_CHUNK_SIZE: rows read per query and converted to arrays at once
+    - SNAPSHOT_TOP_LIMIT: rows returned by top queries by default
+"""
+SNAPSHOT_CHUNK_SIZE = 10000
+SNAPSHOT_TOP_LIMIT = 20
+
+"""
+Defaults of the benchmark_scrape command: times every corpus page is
+scraped, companies written, and pages scraped end to end from the stub
+registry
+"""
+BENCHMARK_PARSE_REPEAT = 20
+BENCHMARK_WRITE_COMPANIES = 2000
+BENCHMARK_PAGES = 1000
+
+"""
+Scrape and task metrics (see helpers/metrics.py)
+    - METRICS_BUCKETS: histogram bucket upper bounds, in seconds
+    - METRICS_FLUSH_INTERVAL: seconds a process buffers metrics before
+      adding them to the totals in Redis
+    - METRICS_QUEUES: Celery queues whose length is reported
+    - METRICS_TOKEN: bearer token allowed to read the metrics besides
+      staff users, none when unset
+"""
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 300, 900)
+METRICS_FLUSH_INTERVAL = 10
+METRICS_QUEUES = ('celery',)
+METRICS_TOKEN = settings.METRICS_TOKEN
+
+"""
+Defaults of the synthetic registry (see helpers/synthetic_registry.py)
+    - SYNTHETIC_ID_SPACE: largest cr_sub_id of every governorate
+    - SYNTHETIC_MISSING_RATE: share of ids without a company
+    - SYNTHETIC_PERSONNEL_MEAN, SYNTHETIC_PERSONNEL_MAX: people per company
+    - SYNTHETIC_NO_PERSONNEL_RATE: share of companies without personnel table
+"""
+SYNTHETIC_ID_SPACE = 10000
+SYNTHETIC_MISSING_RATE = 0.02
+SYNTHETIC_PERSONNEL_MEAN = 4
+SYNTHETIC_PERSONNEL_MAX = 500
+SYNTHETIC_NO_PERSONNEL_RATE = 0.05
@@ -0,0 +1,293 @@
+from api.helpers.bulk_writer import BulkWriter
+from api.helpers.lcr_fetch import fetch_range
+from api.helpers.lcr_parse import LCRPage
+from api.helpers.lcr_scrape import LCRScrape
+from api.helpers.metrics import discard_metrics
+from api.tasks import scrape_results
+from api import constants
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import os
+import platform
+import statistics
+import subprocess
+import threading
+import time
+
+
+"""
+Recorded result.aspx pages, one file per kind of page:
+    small, typical, large (hundreds of personnel rows), no_personnel,
+    empty (id without a company), malformed (truncated response),
+    legacy_encoding (windows-1256 instead of utf-8)
+"""
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                          'benchmarks', 'pages')
+
+"""
+Ids the benchmark scrapes under, far past any registered company.
+Nothing the benchmark writes is kept (see run_benchmarks).
+"""
+BENCHMARK_GOVERNORATE = 1
+BENCHMARK_CR_SUB_ID_START = 900000000
+
+STAGES = ('parse', 'write', 'end_to_end')
+
+
+def load_corpus(directory=CORPUS_DIR):
+    """ {page name: content} of the .html files of a directory, by name """
+    return {
+        name[:-len('.html')]: open(os.path.join(directory, name), 'rb').read()
+        for name in sorted(os.listdir(directory)) if name.endswith('.html')
+    }
+
+
+class PageCollector:
+    """ Stands in for a BulkWriter, keeping what LCRScrape would write """
+
+    def __init__(self):
+        self.companies = []
+
+    def add(self, company, personnel=None):
+        self.companies.append((company, personnel))
+
+
+def milliseconds(timings):
+    return {
+        'median': round(statistics.median(timings) * 1000, 3),
+        'min': round(min(timings) * 1000, 3),
+    }
+
+
+def benchmark_parse(corpus, repeat=constants.BENCHMARK_PARSE_REPEAT):
+    """
+    Time per page, in milliseconds
+        - parse_ms: LCRPage alone (lxml parse and span index)
+        - scrape_ms: LCRScrape.extract_data up to the write (parse,
+          extraction, Company/Person objects, fingerprint), errors
+          recorded as ScrapeErrors included
+    """
+    pages = {}
+    for name, content in corpus.items():
+        parse_timings, scrape_timings = [], []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            LCRPage(content)
+            parse_timings.append(time.perf_counter() - started)
+
+            scrape = LCRScrape(BENCHMARK_CR_SUB_ID_START, BENCHMARK_GOVERNORATE,
+                               writer=PageCollector())
+            error = None
+            started = time.perf_counter()
+            try:
+                scrape.extract_data(content)
+            except Exception as e:
+                error = str(e)
+            scrape_timings.append(time.perf_counter() - started)
+        pages[name] = {
+            'bytes': len(content),
+            'persons': len(scrape.personnel),
+            'error': error,
+            'parse_ms': milliseconds(parse_timings),
+            'scrape_ms': milliseconds(scrape_timings),
+        }
+    scrape_seconds = sum(page['scrape_ms']['median'] for page in pages.values()) / 1000
+    return {
+        'repeat': repeat,
+        'pages': pages,
+        'pages_per_second': round(len(pages) / scrape_seconds, 1),
+    }
+
+
+def scrape_corpus(corpus, companies):
+    """ (Company, personnel) pairs of `companies` ids, scraped from the corpus in turn """
+    collector = PageCollector()
+    contents = list(corpus.values())
+    for index in range(companies):
+        scrape = LCRScrape(BENCHMARK_CR_SUB_ID_START + index, BENCHMARK_GOVERNORATE,
+                           writer=collector)
+        try:
+            scrape.extract_data(contents[index % len(contents)])
+        except Exception:
+            continue  # Empty and malformed pages are not written
+    return collector.companies
+
+
+def benchmark_write(corpus, companies=constants.BENCHMARK_WRITE_COMPANIES):
+    """
+    BulkWriter throughput for the companies of scrape_corpus
+        - insert: none of them stored yet
+        - update: the same companies again, personnel replaced
+    """
+    passes = {}
+    for name in ('insert', 'update'):
+        pairs = scrape_corpus(corpus, companies)
+        started = time.perf_counter()
+        with BulkWriter() as writer:
+            for company, personnel in pairs:
+                writer.add(company, personnel)
+        seconds = time.perf_counter() - started
+        passes[name] = {
+            'companies': writer.stats['companies'],
+            'persons': writer.stats['persons'],
+            'flushes': writer.stats['flushes'],
+            'seconds': round(seconds, 3),
+            'companies_per_second': round(writer.stats['companies'] / seconds, 1),
+            'rows_per_second': round(
+                (writer.stats['companies'] + writer.stats['persons']) / seconds, 1),
+        }
+    return passes
+
+
+class StubRegistry:
+    """
+    Local HTTP server standing in for the Commercial Registry:
+    result.aspx?id=<cr_id> answers with the corpus pages in turn,
+    after `latency` seconds
+
+    Usage:
+        with StubRegistry(corpus) as registry:
+            fetch_range(gov, 1, 501, base_url=registry.base_url)
+    """
+
+    def __init__(self, corpus, latency=0):
+        contents = list(corpus.values())
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, like the registry
+
+            def do_GET(self):
+                cr_id = parse_qs(urlsplit(self.path).query).get('id', ['0'])[0]
+                content = contents[int(cr_id[-9:] or 0) % len(contents)]
+                if latency:
+                    time.sleep(latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = (f'http://127.0.0.1:{self.server.server_port}'
+                         f'/search/result.aspx?id=')
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def benchmark_end_to_end(corpus, pages=constants.BENCHMARK_PAGES,
+                         concurrency=constants.FETCH_CONCURRENCY, latency=0):
+    """
+    Pages/sec of a scrape_lcr_range run against a StubRegistry:
+    LCRFetcher without rate limit, then scrape_results
+    """
+    stats = {'scraped': 0, 'unchanged': 0, 'fetch_errors': 0, 'scrape_errors': 0}
+    with StubRegistry(corpus, latency) as registry:
+        started = time.perf_counter()
+        results = fetch_range(BENCHMARK_GOVERNORATE, BENCHMARK_CR_SUB_ID_START,
+                              BENCHMARK_CR_SUB_ID_START + pages,
+                              base_url=registry.base_url, concurrency=concurrency)
+    fetched = time.perf_counter()
+    # Benchmark ids are far past the real ones, their bitmaps would be huge
+    scrape_results(results, stats, record=False)
+    finished = time.perf_counter()
+    return dict(
+        stats,
+        pages=pages,
+        concurrency=concurrency,
+        latency=latency,
+        fetch_seconds=round(fetched - started, 3),
+        scrape_seconds=round(finished - fetched, 3),
+        pages_per_second=round(pages / (finished - started), 1),
+    )
+
+
+def get_commit():
+    """ Short hash of the checked out commit, None outside a git checkout """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(stages=STAGES, corpus=None, repeat=constants.BENCHMARK_PARSE_REPEAT,
+                   companies=constants.BENCHMARK_WRITE_COMPANIES,
+                   pages=constants.BENCHMARK_PAGES,
+                   concurrency=constants.FETCH_CONCURRENCY, latency=0):
+    """
+    Runs the given stages on the corpus and returns their results with
+    what they ran on. Everything is written in one transaction that is
+    rolled back, so commits (and their fsync) are not measured, and the
+    metrics recorded meanwhile are discarded, Redis being shared with the
+    scrapes whose metrics are exported.
+    """
+    corpus = corpus or load_corpus()
+    results = {
+        'commit': get_commit(),
+        'created_at': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'database': connection.vendor,
+        'corpus': sorted(corpus),
+        'stages': {},
+    }
+    with transaction.atomic(), discard_metrics():
+        if 'parse' in stages:
+            results['stages']['parse'] = benchmark_parse(corpus, repeat)
+        if 'write' in stages:
+            results['stages']['write'] = benchmark_write(corpus, companies)
+        if 'end_to_end' in stages:
+            results['stages']['end_to_end'] = benchmark_end_to_end(
+                corpus, pages, concurrency, latency)
+        transaction.set_rollback(True)
+    return results
+
+
+def flatten(results, prefix=''):
+    """ {'parse.pages.typical.scrape_ms.median': value} of the numbers of results """
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def compare_results(previous, current):
+    """
+    [(metric, previous value, current value, change)] of the per-page
+    timings and the rates both results have, change being how much worse (> 0) or better
+    (< 0) the current value is, as a fraction of the previous one
+    """
+    before = flatten(previous['stages'])
+    after = flatten(current['stages'])
+    comparison = []
+    for metric in sorted(before.keys() & after.keys()):
+        if 'per_second' in metric:
+            higher_is_better = True
+        elif '_ms.' in metric:
+            higher_is_better = False
+        else:
+            continue  # Counts and durations, which depend on the run size
+        if not before[metric]:
+            continue
+        change = (after[metric] - before[metric]) / before[metric]
+        comparison.append((metric, before[metric], after[metric],
+                           -change if higher_is_better else change))
+    return comparison
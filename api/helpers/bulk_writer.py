@@ -0,0 +1,241 @@
+from api.models import Company, Person
+from api.helpers.lcr_writer import upsert_companies, replace_personnel
+from api.helpers.metrics import WRITE_ROWS_TOTAL, get_metrics, observe_stage
+from api.helpers.scrape_errors import record_scrape_error
+from api import constants
+
+from django.db import connection, transaction
+import csv
+import datetime
+import io
+import time
+
+
+COMPANY_STAGING_TABLE = 'lcr_company_staging'
+PERSON_STAGING_TABLE = 'lcr_person_staging'
+
+
+class BulkWriter:
+    """
+    Buffers scraped companies and their personnel across many pages
+    and writes them in large batches.
+        - PostgreSQL: COPY into temporary staging tables, then one upsert of
+          the companies on cr_id and one insert of the people joined to their
+          company by cr_id, so people of companies created in the same batch
+          get the right company_id
+        - Other databases: upsert_companies and replace_personnel
+    A batch is flushed once max_rows companies and people are buffered, or
+    on the first add more than flush_interval seconds after the last flush.
+    When a batch fails, its companies are written one by one so only the
+    faulty ones are recorded as ScrapeErrors (their cr_ids end up in failed).
+
+    Usage:
+        with BulkWriter() as writer:
+            writer.add(company, personnel)
+    """
+
+    def __init__(self, max_rows=constants.BULK_WRITE_MAX_ROWS,
+                 flush_interval=constants.BULK_WRITE_FLUSH_INTERVAL):
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.companies = {}
+        self.personnel = {}
+        self.buffered_rows = 0
+        self.last_flush = time.monotonic()
+        self.failed = set()
+        self.stats = {'companies': 0, 'persons': 0, 'flushes': 0, 'seconds': 0.0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, company, personnel=None):
+        """
+        Buffers an unsaved Company
+            - personnel: its unsaved Person objects, replacing the stored ones;
+              None keeps the stored people
+        """
+        if company.cr_id in self.companies:
+            self.buffered_rows -= 1 + len(self.personnel.get(company.cr_id) or [])
+        self.companies[company.cr_id] = company
+        self.personnel[company.cr_id] = personnel
+        self.buffered_rows += 1 + len(personnel or [])
+        if (self.buffered_rows >= self.max_rows
+                or time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        if self.companies:
+            started = time.monotonic()
+            written = self.stats['companies'] + self.stats['persons']
+            try:
+                with transaction.atomic():
+                    if connection.vendor == 'postgresql':
+                        persons = self.__copy_batch()
+                    else:
+                        persons = self.__write_batch(self.companies.values())
+                self.stats['companies'] += len(self.companies)
+                self.stats['persons'] += persons
+            except Exception:
+                self.__write_one_by_one()
+            seconds = time.monotonic() - started
+            self.stats['flushes'] += 1
+            self.stats['seconds'] += seconds
+            # Labelled with the batch's governorate (ranges are scraped one at a time)
+            governorates = {company.governorate for company in self.companies.values()}
+            governorate = governorates.pop() if len(governorates) == 1 else 'mixed'
+            observe_stage('write', governorate, seconds)
+            metrics = get_metrics()
+            metrics.increment(WRITE_ROWS_TOTAL,
+                              self.stats['companies'] + self.stats['persons'] - written,
+                              governorate=governorate)
+            metrics.flush_when_due()
+        self.companies = {}
+        self.personnel = {}
+        self.buffered_rows = 0
+        self.last_flush = time.monotonic()
+
+    def __write_batch(self, companies):
+        companies = list(companies)
+        upsert_companies(companies)
+        replaced = {}
+        for company in companies:
+            people = self.personnel[company.cr_id]
+            if people is not None:
+                for person in people:
+                    person.company_id = company.id
+                replaced[company.id] = people
+        replace_personnel(replaced)
+        return sum(len(people) for people in replaced.values())
+
+    def __write_one_by_one(self):
+        for company in self.companies.values():
+            try:
+                with transaction.atomic():
+                    persons = self.__write_batch([company])
+            except Exception as e:
+                record_scrape_error(company.cr_id, 'CO', e)
+                self.failed.add(company.cr_id)
+            else:
+                self.stats['companies'] += 1
+                self.stats['persons'] += persons
+
+    def __copy_batch(self):
+        """ PostgreSQL path, returns the number of people written """
+        company_fields = [field for field in Company._meta.concrete_fields
+                          if not field.primary_key]
+        person_fields = [field for field in Person._meta.concrete_fields
+                         if not field.primary_key and field.name != 'company']
+        company_columns = [field.column for field in company_fields]
+        person_columns = [field.column for field in person_fields]
+        quote = connection.ops.quote_name
+        company_table = quote(Company._meta.db_table)
+        person_table = quote(Person._meta.db_table)
+
+        with connection.cursor() as cursor:
+            self.__create_staging_tables(cursor, company_columns, person_columns)
+            cursor.copy_expert(
+                self.__copy_sql(COMPANY_STAGING_TABLE, company_fields),
+                self.__csv(self.companies.values(), company_fields))
+            company_list = ', '.join(quote(column) for column in company_columns)
+            updates = ', '.join(
+                f'{quote(field.column)} = EXCLUDED.{quote(field.column)}'
+                for field in company_fields
+                if field.name not in ('cr_id', 'created_at'))
+            cursor.execute(
+                f'INSERT INTO {company_table} ({company_list}) '
+                f'SELECT {company_list} FROM {COMPANY_STAGING_TABLE} '
+                f'ON CONFLICT ("cr_id") DO UPDATE SET {updates} '
+                f'RETURNING "id", "cr_id"')
+            ids = dict((cr_id, pk) for pk, cr_id in cursor.fetchall())
+            for cr_id, company in self.companies.items():
+                company.pk = ids[cr_id]
+                company._state.adding = False
+
+            replaced = [cr_id for cr_id, people in self.personnel.items()
+                        if people is not None]
+            people = [(cr_id, person) for cr_id in replaced
+                      for person in self.personnel[cr_id]]
+            cursor.copy_expert(
+                self.__copy_sql(PERSON_STAGING_TABLE, person_fields, prefix=['cr_id']),
+                self.__csv(people, person_fields, with_cr_id=True))
+            # The old rows are deleted by the same statement, their
+            # individual is carried over like replace_personnel does
+            person_list = ', '.join(quote(column) for column in person_columns)
+            person_values = ', '.join(
+                'COALESCE(staging."individual_id", linked."individual_id")'
+                if column == 'individual_id' else 'staging.' + quote(column)
+                for column in person_columns)
+            cursor.execute(
+                f'WITH old AS ('
+                f'DELETE FROM {person_table} WHERE "company_id" = ANY(%s) '
+                f'RETURNING "company_id", "name", "nationality", "individual_id"), '
+                f'linked AS ('
+                f'SELECT DISTINCT ON ("company_id", "name", "nationality") * FROM old '
+                f'WHERE "individual_id" IS NOT NULL) '
+                f'INSERT INTO {person_table} ({person_list}, "company_id") '
+                f'SELECT {person_values}, company."id" FROM {PERSON_STAGING_TABLE} staging '
+                f'JOIN {company_table} company ON company."cr_id" = staging."cr_id" '
+                f'LEFT JOIN linked ON linked."company_id" = company."id" '
+                f'AND linked."name" = staging."name" '
+                f'AND linked."nationality" = staging."nationality"',
+                [[ids[cr_id] for cr_id in replaced]])
+        return len(people)
+
+    @staticmethod
+    def __create_staging_tables(cursor, company_columns, person_columns):
+        """
+        Column types are copied from the real tables, rows vanish at commit.
+        They are emptied anyway, for batches flushed inside an outer
+        transaction (savepoints do not commit).
+        """
+        cursor.execute(
+            f'CREATE TEMPORARY TABLE IF NOT EXISTS {COMPANY_STAGING_TABLE} '
+            f'ON COMMIT DELETE ROWS AS SELECT {", ".join(company_columns)} '
+            f'FROM {Company._meta.db_table} WITH NO DATA')
+        cursor.execute(
+            f'CREATE TEMPORARY TABLE IF NOT EXISTS {PERSON_STAGING_TABLE} '
+            f'ON COMMIT DELETE ROWS AS SELECT company."cr_id", '
+            f'{", ".join("person." + column for column in person_columns)} '
+            f'FROM {Person._meta.db_table} person, {Company._meta.db_table} company '
+            f'WITH NO DATA')
+        cursor.execute(f'DELETE FROM {COMPANY_STAGING_TABLE}; '
+                       f'DELETE FROM {PERSON_STAGING_TABLE}')
+
+    @staticmethod
+    def __copy_sql(table, fields, prefix=()):
+        """
+        The csv module quotes None like an empty string, so the nullable
+        columns (none of them holds text) read "" as NULL
+        """
+        columns = list(prefix) + [field.column for field in fields]
+        null_columns = [field.column for field in fields if field.null]
+        options = 'FORMAT csv'
+        if null_columns:
+            options += f', FORCE_NULL ({", ".join(null_columns)})'
+        return f'COPY {table} ({", ".join(columns)}) FROM STDIN WITH ({options})'
+
+    @staticmethod
+    def __csv(objects, fields, with_cr_id=False):
+        """ CSV for COPY: strings always quoted, None written as "" (see __copy_sql) """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+        for item in objects:
+            prefix = []
+            if with_cr_id:
+                cr_id, item = item
+                prefix = [cr_id]
+            values = []
+            for field in fields:
+                value = field.get_db_prep_save(field.pre_save(item, True), connection)
+                if isinstance(value, (datetime.date, datetime.datetime)):
+                    value = value.isoformat()
+                elif isinstance(value, bool):
+                    value = 'true' if value else 'false'
+                values.append(value)
+            writer.writerow(prefix + values)
+        buffer.seek(0)
+        return buffer
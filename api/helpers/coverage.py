@@ -0,0 +1,205 @@
+from api.models import Company, ScrapeError
+from api.helpers.lcr_parse import EmptyPageError
+from api.helpers.lcr_scrape import split_cr_id
+from api import constants
+
+from collections import defaultdict
+
+from django.conf import settings
+import numpy as np
+import redis
+import time
+
+
+_coverage_index = None
+
+"""
+States of a cr_sub_id in the coverage index, in code order (0 is
+uncovered). An id stays covered for the TTL of its state:
+    - scraped: company written or unchanged, stale after COVERAGE_SCRAPED_TTL
+    - missing: the registry has no company under the id
+    - failed: fetch or scrape error, retried by retry_scrape_errors meanwhile
+"""
+UNCOVERED = 0
+SCRAPED, MISSING, FAILED = 'scraped', 'missing', 'failed'
+STATES = (SCRAPED, MISSING, FAILED)
+
+
+def state_ttls():
+    return {
+        SCRAPED: constants.COVERAGE_SCRAPED_TTL,
+        MISSING: constants.COVERAGE_MISSING_TTL,
+        FAILED: constants.COVERAGE_FAILED_TTL,
+    }
+
+
+def error_state(error):
+    """ State of an id whose scrape raised error (raised from the original one) """
+    return MISSING if isinstance(error.__context__ or error, EmptyPageError) else FAILED
+
+
+class CoverageIndex:
+    """
+    Which cr_sub_ids of each governorate were scraped, are missing from
+    the registry or failed recently, shared by every worker through Redis.
+
+    States are recorded in bitmaps (bit n is cr_sub_id n, 125 KB per
+    million ids), one per governorate, state and time bucket of
+    COVERAGE_BUCKET_SECONDS. Buckets expire with the TTL of their state,
+    so entries age out without any cleanup, and the newest bucket an id
+    is set in gives its state.
+    Lookups read the bytes of a range from every live bucket in one
+    pipeline: deciding on 50,000 ids costs a few round trips, not 50,000.
+    """
+    KEY_PREFIX = 'lcr:coverage'
+
+    def __init__(self, client=None):
+        self.redis = client or redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+    @classmethod
+    def key(cls, gov, state, bucket):
+        return f'{cls.KEY_PREFIX}:{gov}:{state}:{bucket}'
+
+    @staticmethod
+    def bucket(timestamp=None):
+        return int((timestamp or time.time()) // constants.COVERAGE_BUCKET_SECONDS)
+
+    def record(self, states, timestamp=None):
+        """
+        Records {(gov, cr_sub_id): state} as of timestamp (now by default),
+        replacing the ids' other states of that bucket
+        """
+        if not states:
+            return
+        bucket = self.bucket(timestamp)
+        ttls = state_ttls()
+        pipe = self.redis.pipeline(transaction=False)
+        governorates = set()
+        for (gov, cr_sub_id), state in states.items():
+            governorates.add(gov)
+            for other in STATES:
+                pipe.setbit(self.key(gov, other, bucket), cr_sub_id, int(other == state))
+        for gov in governorates:
+            for state in STATES:
+                # The bucket's last ids stay covered for the whole TTL
+                pipe.expireat(self.key(gov, state, bucket),
+                              (bucket + 1) * constants.COVERAGE_BUCKET_SECONDS + ttls[state])
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            pass  # Coverage only saves fetches, it never stops a scrape
+
+    def states(self, gov, start, end):
+        """ Array of the state codes (index in STATES + 1, 0 uncovered) of start <= id < end """
+        codes = np.zeros(max(end - start, 0), dtype=np.int8)
+        if not len(codes):
+            return codes
+        first_byte, last_byte = start // 8, (end - 1) // 8
+        now = time.time()
+        current = self.bucket(now)
+        reads = []  # (bucket, state code)
+        pipe = self.redis.pipeline(transaction=False)
+        for code, (state, ttl) in enumerate(state_ttls().items(), 1):
+            oldest = self.bucket(now - ttl)
+            for bucket in range(current, oldest - 1, -1):
+                pipe.getrange(self.key(gov, state, bucket), first_byte, last_byte)
+                reads.append((bucket, code))
+        newest = np.full(len(codes), -1, dtype=np.int64)  # Bucket of each id's state
+        offset = start - first_byte * 8
+        try:
+            values = pipe.execute()
+        except redis.RedisError:
+            return codes  # Everything is fetched again
+        for (bucket, code), data in zip(reads, values):
+            if not data:
+                continue
+            bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))[offset:offset + len(codes)]
+            present = np.flatnonzero(bits)
+            newer = present[newest[present] < bucket]
+            codes[newer] = code
+            newest[newer] = bucket
+        return codes
+
+    def uncovered(self, gov, start, end):
+        """ Array of the ids in start <= id < end that are neither fresh, missing nor failed """
+        return np.flatnonzero(self.states(gov, start, end) == UNCOVERED) + start
+
+    def next_chunk(self, gov, start, end, size):
+        """
+        (chunk end, uncovered ids) of the chunk starting at start holding
+        the next `size` uncovered ids before end, reading at most
+        COVERAGE_SCAN_SIZE ids at a time
+        """
+        found = []
+        count = 0
+        position = start
+        while position < end and count < size:
+            window_end = min(position + constants.COVERAGE_SCAN_SIZE, end)
+            ids = self.uncovered(gov, position, window_end)[:size - count]
+            found.append(ids)
+            count += len(ids)
+            position = int(ids[-1]) + 1 if count == size else window_end
+        ids = np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+        return position, ids
+
+    def summary(self, gov, end):
+        """ {state: ids} of 1 <= id < end, uncovered included """
+        counts = np.zeros(len(STATES) + 1, dtype=np.int64)
+        for position in range(1, end, constants.COVERAGE_SCAN_SIZE):
+            counts += np.bincount(
+                self.states(gov, position, min(position + constants.COVERAGE_SCAN_SIZE, end)),
+                minlength=len(counts))
+        return dict(zip(('uncovered',) + STATES, counts.tolist()))
+
+    def reset(self, gov=None):
+        """ Deletes every bucket (of one governorate), returns how many """
+        pattern = f'{self.KEY_PREFIX}:{gov if gov is not None else "*"}:*'
+        keys = list(self.redis.scan_iter(match=pattern, count=1000))
+        if keys:
+            self.redis.delete(*keys)
+        return len(keys)
+
+
+def seed_coverage(coverage=None):
+    """
+    Records the stored companies as scraped and the empty ScrapeErrors as
+    missing, as of their last update, so the first crawl after the index
+    was lost does not fetch every id again. Entries past their TTL are left
+    out. Returns {state: ids recorded}.
+    """
+    coverage = coverage or get_coverage_index()
+    ttls = state_ttls()
+    now = time.time()
+    counts = dict.fromkeys(STATES, 0)
+    rows = [
+        (SCRAPED, ((gov, cr_sub_id, updated_at) for gov, cr_sub_id, updated_at in
+                   Company.objects.values_list('governorate', 'cr_sub_id', 'updated_at')
+                   .iterator(chunk_size=constants.COVERAGE_SCAN_SIZE))),
+        (MISSING, ((*split_cr_id(cr_id), updated_at) for cr_id, updated_at in
+                   ScrapeError.objects.filter(error_class=ScrapeError.ErrorClass.EMPTY)
+                   .values_list('cr_id', 'updated_at')
+                   .iterator(chunk_size=constants.COVERAGE_SCAN_SIZE))),
+    ]
+    for state, entries in rows:
+        buckets = defaultdict(dict)  # {bucket timestamp: {(gov, cr_sub_id): state}}
+        for gov, cr_sub_id, updated_at in entries:
+            timestamp = updated_at.timestamp()
+            if timestamp < now - ttls[state]:
+                continue
+            states = buckets[timestamp - timestamp % constants.COVERAGE_BUCKET_SECONDS]
+            states[(gov, cr_sub_id)] = state
+            counts[state] += 1
+            if len(states) >= constants.COVERAGE_SCAN_SIZE:
+                coverage.record(states, timestamp)
+                states.clear()
+        for timestamp, states in buckets.items():
+            coverage.record(states, timestamp)
+    return counts
+
+
+def get_coverage_index():
+    """ CoverageIndex of this process """
+    global _coverage_index
+    if _coverage_index is None:
+        _coverage_index = CoverageIndex()
+    return _coverage_index
@@ -0,0 +1,328 @@
+from api.models import ScrapeCheckpoint, ScrapeChunk
+from api.helpers.coverage import get_coverage_index
+from api import constants
+
+from datetime import timedelta
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+import redis
+import threading
+import uuid
+
+
+_dispatch_loop = None
+
+"""
+Sets the loop token to ARGV[1] for ARGV[2] seconds unless another
+loop's token is set. Returns 1 when set.
+"""
+RENEW_LOOP_SCRIPT = '''
+local token = redis.call('GET', KEYS[1])
+if token and token ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', tonumber(ARGV[2]))
+return 1
+'''
+
+"""
+Deletes the loop token if it is still ARGV[1]
+"""
+STOP_LOOP_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+
+def start_crawl(gov, start, end, refresh=False):
+    """
+    Starts a new crawl of start <= cr_sub_id < end for one governorate
+        - If a crawl of the governorate is still running
+            - It is kept as is, so it resumes from its checkpoint
+        - Chunks that failed in the previous crawl are carried over
+    Returns the governorate's checkpoint
+    """
+    with transaction.atomic():
+        checkpoint = ScrapeCheckpoint.objects.select_for_update().filter(
+            governorate=gov).first()
+        if checkpoint and checkpoint.status == ScrapeCheckpoint.Status.RUNNING:
+            return checkpoint
+        chunks = ScrapeChunk.objects.filter(governorate=gov)
+        chunks.filter(status=ScrapeChunk.Status.DONE).delete()
+        chunks.filter(status=ScrapeChunk.Status.FAILED).update(
+            status=ScrapeChunk.Status.PENDING, attempts=0)
+        checkpoint, _ = ScrapeCheckpoint.objects.update_or_create(
+            governorate=gov,
+            defaults={
+                'cursor': start,
+                'end': end,
+                'refresh': refresh,
+                'status': ScrapeCheckpoint.Status.RUNNING,
+                'completed_at': None,
+            }
+        )
+    return checkpoint
+
+
+def dispatch_chunks(gov):
+    """
+    Advances the running crawl of one governorate by one step
+        - Chunks whose lease expired (dispatched more than CHUNK_TIMEOUT
+          seconds ago, or left by a lease_worker), and failed chunks with
+          attempts left, go back to pending
+        - New chunks are cut from the cursor while fewer than
+          MAX_CHUNKS_IN_FLIGHT are pending or dispatched (see cut_chunks)
+        - The crawl completes once the cursor reached the end and
+          no chunk is pending or dispatched
+    The checkpoint row lock keeps concurrent dispatchers from handing out
+    the same ids twice.
+    Returns the chunks to enqueue, already marked as dispatched
+    """
+    now = timezone.now()
+    Status = ScrapeChunk.Status
+    with transaction.atomic():
+        checkpoint = ScrapeCheckpoint.objects.select_for_update().get(
+            governorate=gov)
+        if checkpoint.status != ScrapeCheckpoint.Status.RUNNING:
+            return []
+        chunks = ScrapeChunk.objects.filter(governorate=gov)
+        chunks.filter(
+            status=Status.DISPATCHED, lease_expires_at__lt=now
+        ).update(status=Status.PENDING)
+        chunks.filter(
+            status=Status.FAILED, attempts__lt=constants.CHUNK_MAX_ATTEMPTS
+        ).update(status=Status.PENDING)
+
+        outstanding = chunks.filter(
+            status__in=[Status.PENDING, Status.DISPATCHED]).count()
+        cut_chunks(checkpoint, constants.MAX_CHUNKS_IN_FLIGHT - outstanding)
+
+        pending = list(chunks.filter(status=Status.PENDING).order_by('start'))
+        chunks.filter(id__in=[chunk.id for chunk in pending]).update(
+            status=Status.DISPATCHED, dispatched_at=now, lease_owner='',
+            lease_expires_at=now + timedelta(seconds=constants.CHUNK_TIMEOUT),
+            attempts=F('attempts') + 1)
+
+        if not pending:
+            complete_crawl(checkpoint, now)
+        checkpoint.save()
+    return pending
+
+
+def cut_chunks(checkpoint, count):
+    """
+    Cuts up to count pending chunks from the cursor of a locked checkpoint
+    (saved by the caller). A chunk spans the next SCRAPE_BATCH_SIZE ids
+    missing from the coverage index, ranges it fully covers are skipped
+    without cutting anything.
+    Ranges of the chunks already ahead of the cursor (carried over from
+    the previous crawl by start_crawl) are skipped too, new chunks end
+    where they start.
+    Returns the new chunks
+    """
+    new_chunks = []
+    coverage = get_coverage_index()
+    held = list(ScrapeChunk.objects.filter(
+        governorate=checkpoint.governorate, end__gt=checkpoint.cursor,
+        start__lt=checkpoint.end).order_by('start').values_list('start', 'end'))
+    while len(new_chunks) < count and checkpoint.cursor < checkpoint.end:
+        if held and held[0][1] <= checkpoint.cursor:
+            held.pop(0)
+            continue
+        if held and held[0][0] <= checkpoint.cursor:
+            checkpoint.cursor = held.pop(0)[1]
+            continue
+        end = min(held[0][0], checkpoint.end) if held else checkpoint.end
+        chunk_end, ids = coverage.next_chunk(
+            checkpoint.governorate, checkpoint.cursor, end, constants.SCRAPE_BATCH_SIZE)
+        if len(ids):
+            new_chunks.append(ScrapeChunk(
+                governorate=checkpoint.governorate, start=int(ids[0]), end=chunk_end))
+        checkpoint.cursor = chunk_end
+    return ScrapeChunk.objects.bulk_create(new_chunks)
+
+
+def complete_crawl(checkpoint, now):
+    """
+    Completes the crawl of a locked checkpoint (saved by the caller) once its
+    cursor reached the end and no chunk is left to scrape (failed chunks
+    out of attempts wait for the next crawl)
+    """
+    Status = ScrapeChunk.Status
+    if checkpoint.cursor < checkpoint.end or ScrapeChunk.objects.filter(
+            Q(status__in=[Status.PENDING, Status.DISPATCHED])
+            | Q(status=Status.FAILED, attempts__lt=constants.CHUNK_MAX_ATTEMPTS),
+            governorate=checkpoint.governorate).exists():
+        return
+    checkpoint.status = ScrapeCheckpoint.Status.COMPLETE
+    checkpoint.completed_at = now
+
+
+class DispatchLoop:
+    """
+    Token of the dispatch_scrape loop in Redis, so only one loop runs
+    however many times scrape_lcr is called
+        - start: a new loop only starts when no loop renewed the token in
+          the last DISPATCH_LOOP_TIMEOUT seconds (it died)
+        - renew: each pass of a loop renews its token, a loop that finds
+          another loop's token (it stalled and was replaced) stops
+        - stop: a loop without running crawl gives the token up
+    """
+    KEY = 'lcr:dispatch:loop'
+
+    def __init__(self, client=None):
+        self.redis = client or redis.Redis.from_url(settings.CELERY_BROKER_URL)
+        self.renew_loop = self.redis.register_script(RENEW_LOOP_SCRIPT)
+        self.stop_loop = self.redis.register_script(STOP_LOOP_SCRIPT)
+
+    def start(self):
+        """ Token of a new loop, None when a loop is running """
+        token = uuid.uuid4().hex
+        if self.redis.set(self.KEY, token, nx=True, ex=constants.DISPATCH_LOOP_TIMEOUT):
+            return token
+        return None
+
+    def renew(self, token):
+        """ Whether token is still the running loop's """
+        return bool(self.renew_loop(keys=[self.KEY],
+                                    args=[token, constants.DISPATCH_LOOP_TIMEOUT]))
+
+    def stop(self, token):
+        self.stop_loop(keys=[self.KEY], args=[token])
+
+
+def get_dispatch_loop():
+    """ DispatchLoop of this process """
+    global _dispatch_loop
+    if _dispatch_loop is None:
+        _dispatch_loop = DispatchLoop()
+    return _dispatch_loop
+
+
+def claim_chunk(owner):
+    """
+    Leases one chunk of a running crawl to owner (a lease_worker) for
+    LEASE_SECONDS, so every node pulls its own work and no dispatcher
+    has to stay up
+        - Pending chunks first, then failed ones with attempts left and
+          chunks whose lease expired (their worker is gone), lowest ids first
+        - Without any, the next MAX_CHUNKS_IN_FLIGHT chunks are cut from the
+          cursor of a running crawl, or the crawl completes once nothing is left
+    Rows locked by another claim are skipped, not waited for, so nodes
+    claiming at once get different chunks and never the same ids.
+    Returns the chunk, None when there is nothing to claim
+    """
+    now = timezone.now()
+    Status = ScrapeChunk.Status
+    with transaction.atomic():
+        governorates = list(ScrapeCheckpoint.objects.filter(
+            status=ScrapeCheckpoint.Status.RUNNING).values_list('governorate', flat=True))
+        chunk = ScrapeChunk.objects.select_for_update(skip_locked=True).filter(
+            Q(status=Status.PENDING)
+            | Q(status=Status.FAILED, attempts__lt=constants.CHUNK_MAX_ATTEMPTS)
+            | Q(status=Status.DISPATCHED, lease_expires_at__lt=now),
+            governorate__in=governorates,
+        ).order_by('start', 'governorate').first()
+        if chunk is None:
+            # Least recently advanced crawl first, so nodes spread over governorates
+            running = ScrapeCheckpoint.objects.filter(
+                status=ScrapeCheckpoint.Status.RUNNING).order_by('updated_at')
+            for gov in running.values_list('governorate', flat=True):
+                checkpoint = running.select_for_update(skip_locked=True).filter(
+                    governorate=gov).first()
+                if checkpoint is None:
+                    continue  # Being advanced by another node
+                # Nodes claiming meanwhile lease the rest instead of waiting
+                new_chunks = cut_chunks(checkpoint, constants.MAX_CHUNKS_IN_FLIGHT)
+                if not new_chunks:
+                    complete_crawl(checkpoint, now)
+                checkpoint.save()
+                if new_chunks:
+                    chunk = new_chunks[0]
+                    break
+        if chunk is None:
+            return None
+        chunk.status = Status.DISPATCHED
+        chunk.dispatched_at = now
+        chunk.lease_owner = owner
+        chunk.lease_expires_at = now + timedelta(seconds=constants.LEASE_SECONDS)
+        chunk.attempts += 1
+        chunk.save(update_fields=['status', 'dispatched_at', 'lease_owner',
+                                  'lease_expires_at', 'attempts', 'updated_at'])
+    return chunk
+
+
+def renew_lease(chunk_id, owner):
+    """
+    Pushes back the lease of a chunk owner still holds by LEASE_SECONDS,
+    returns False when it was taken over or is no longer dispatched
+    """
+    return bool(ScrapeChunk.objects.filter(
+        id=chunk_id, lease_owner=owner, status=ScrapeChunk.Status.DISPATCHED
+    ).update(lease_expires_at=timezone.now() + timedelta(seconds=constants.LEASE_SECONDS)))
+
+
+class LeaseHeartbeat:
+    """
+    Renews the lease of a chunk every LEASE_HEARTBEAT_INTERVAL seconds from
+    a thread while its owner scrapes it. lost is set once another worker
+    took the chunk over: the owner stops fetching, so both do not fetch
+    the same ids, and leaves the chunk to the new owner.
+
+    Usage:
+        with LeaseHeartbeat(chunk.id, owner) as heartbeat:
+            scrape_range(..., stopped=heartbeat.is_lost)
+    """
+
+    def __init__(self, chunk_id, owner, interval=None):
+        self.chunk_id = chunk_id
+        self.owner = owner
+        self.interval = interval or constants.LEASE_HEARTBEAT_INTERVAL
+        self.lost = False
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        self.thread.join()
+
+    def is_lost(self):
+        return self.lost
+
+    def __run(self):
+        try:
+            while not self.stop.wait(self.interval):
+                try:
+                    if not renew_lease(self.chunk_id, self.owner):
+                        self.lost = True
+                        return
+                except DatabaseError:
+                    pass  # Retried on the next beat, the lease outlives a few misses
+        finally:
+            connection.close()  # This thread's own connection
+
+
+def complete_chunk(chunk_id, stats):
+    """ Completing a chunk twice (e.g. after a takeover) changes nothing """
+    ScrapeChunk.objects.filter(id=chunk_id).update(
+        status=ScrapeChunk.Status.DONE, stats=stats, lease_expires_at=None)
+
+
+def fail_chunk(chunk_id, owner=None):
+    """
+    The dispatcher retries the chunk while it has attempts left
+        - owner: only while the chunk is still leased to owner, a chunk
+          taken over by another worker is left to it
+    """
+    chunks = ScrapeChunk.objects.filter(id=chunk_id).exclude(status=ScrapeChunk.Status.DONE)
+    if owner is not None:
+        chunks = chunks.filter(lease_owner=owner)
+    chunks.update(status=ScrapeChunk.Status.FAILED)
@@ -0,0 +1,176 @@
+from api.models import BlockingKey, Individual, Person
+from api.helpers.locks import try_advisory_lock
+from api.helpers.search import latin_skeleton, normalize_text
+from api import constants
+
+from collections import defaultdict
+from difflib import SequenceMatcher
+from django.db import transaction
+from django.utils import timezone
+import hashlib
+
+
+"""
+PostgreSQL advisory lock held by the running resolver, so concurrent
+resolve_individuals tasks do not create the same individual twice
+"""
+RESOLUTION_LOCK_ID = 0x4c4352
+
+"""
+Arabic and Latin forms of the definite article, ignored when matching
+('الخوري' and 'el khoury' are 'khoury')
+"""
+ARTICLES = ('ال', 'al', 'el')
+
+
+def name_tokens(name):
+    """ Normalized words of a name, without definite articles """
+    tokens = []
+    for token in normalize_text(name).split():
+        if token in ARTICLES:
+            continue
+        if token.startswith('ال') and len(token) > 3:
+            token = token[2:]
+        tokens.append(token)
+    return tokens
+
+
+def blocking_keys(name, nationality):
+    """
+    Keys of a name: the Latin skeletons of its words, and when it has
+    three words or more the same with each middle word left out in turn
+    (middle names come and go between registrations).
+    Every key is prefixed with the normalized nationality and hashed.
+    """
+    skeletons = [latin_skeleton(token) or token for token in name_tokens(name)]
+    if not skeletons:
+        return set()
+    variants = {tuple(skeletons)}
+    for index in range(1, len(skeletons) - 1):
+        variants.add(tuple(skeletons[:index] + skeletons[index + 1:]))
+    prefix = normalize_text(nationality)
+    return {
+        hashlib.md5(f'{prefix}:{" ".join(variant)}'.encode()).hexdigest()
+        for variant in variants
+    }
+
+
+def name_similarity(tokens, other_tokens):
+    """
+    Similarity of two names (lists of name_tokens) between 0 and 1
+        - The first and the last words are compared together, the middle
+          words of the shorter name with those of the longer one
+        - A name may have one middle word more than the other
+        - 0 as soon as two compared words are less than
+          RESOLUTION_MIN_WORD_SIMILARITY alike
+    """
+    if len(tokens) > len(other_tokens):
+        tokens, other_tokens = other_tokens, tokens
+    if not tokens or len(other_tokens) - len(tokens) > 1:
+        return 0
+    if len(tokens) == 1:
+        pairs = [(tokens[0], other_tokens[0])] if len(other_tokens) == 1 else []
+    else:
+        pairs = [(tokens[0], other_tokens[0]), (tokens[-1], other_tokens[-1])]
+        middle = other_tokens[1:-1]
+        for token in tokens[1:-1]:
+            best = max(middle, key=lambda other: SequenceMatcher(None, token, other).ratio())
+            middle.remove(best)
+            pairs.append((token, best))
+    if not pairs:
+        return 0
+    ratios = [SequenceMatcher(None, token, other).ratio() for token, other in pairs]
+    if min(ratios) < constants.RESOLUTION_MIN_WORD_SIMILARITY:
+        return 0
+    return sum(ratios) / len(ratios)
+
+
+class Resolver:
+    """
+    Matches one batch of people to individuals.
+    Individuals created for the batch are indexed too, so people of the
+    same batch are grouped together, and are inserted at the end in bulk.
+    """
+
+    def __init__(self, min_similarity=constants.RESOLUTION_MIN_SIMILARITY):
+        self.min_similarity = min_similarity
+        self.keys = defaultdict(list)  # key: [Individual]
+        self.created = []  # [(Individual, keys)]
+
+    def resolve(self, persons):
+        """ Sets individual_id on every person, creating individuals as needed """
+        person_keys = {person.id: blocking_keys(person.name, person.nationality)
+                       for person in persons}
+        self.__load_candidates(set().union(*person_keys.values()))
+        matches = []
+        for person in persons:
+            keys = person_keys[person.id]
+            individual = self.__best_match(person, keys)
+            if individual is None:
+                individual = self.__create(person, keys)
+            matches.append((person, individual))
+
+        Individual.objects.bulk_create([individual for individual, _ in self.created])
+        BlockingKey.objects.bulk_create([
+            BlockingKey(key=key, individual_id=individual.id)
+            for individual, keys in self.created for key in keys
+        ])
+        now = timezone.now()
+        for person, individual in matches:
+            person.individual_id = individual.id
+            person.updated_at = now  # Picked up by update_graph
+        Person.objects.bulk_update(persons, ['individual', 'updated_at'])
+
+    def __load_candidates(self, keys):
+        rows = list(BlockingKey.objects.filter(key__in=keys).values_list(
+            'key', 'individual_id'))
+        individuals = Individual.objects.only(
+            'name', 'nationality', 'name_key').in_bulk(
+            {individual_id for _, individual_id in rows})
+        for key, individual_id in rows:
+            self.keys[key].append(individuals[individual_id])
+
+    def __best_match(self, person, keys):
+        tokens = name_tokens(person.name)
+        nationality = normalize_text(person.nationality)
+        candidates = {id(individual): individual
+                      for key in keys for individual in self.keys[key]}
+        best, best_similarity = None, self.min_similarity
+        for individual in candidates.values():
+            if normalize_text(individual.nationality) != nationality:
+                continue
+            similarity = name_similarity(tokens, individual.name_key.split())
+            if similarity >= best_similarity:
+                best, best_similarity = individual, similarity
+        return best
+
+    def __create(self, person, keys):
+        individual = Individual(
+            name=person.name, nationality=person.nationality,
+            name_key=' '.join(name_tokens(person.name)))
+        self.created.append((individual, keys))
+        for key in keys:
+            self.keys[key].append(individual)
+        return individual
+
+
+def resolve_individuals(batch_size=constants.RESOLUTION_BATCH_SIZE):
+    """
+    Groups every unresolved Person (individual is null) into an Individual.
+    People are only compared with individuals sharing a blocking key,
+    so a batch costs a constant number of queries.
+    Returns the number of people resolved, None when another resolver
+    is already running.
+    """
+    with try_advisory_lock(RESOLUTION_LOCK_ID) as acquired:
+        if not acquired:
+            return None
+        resolved = 0
+        while True:
+            with transaction.atomic():
+                persons = list(Person.objects.filter(individual__isnull=True).only(
+                    'name', 'nationality').order_by('id')[:batch_size])
+                if not persons:
+                    return resolved
+                Resolver().resolve(persons)
+            resolved += len(persons)
@@ -0,0 +1,217 @@
+from api.models import Company, Person
+from api import constants
+
+from datetime import date, datetime
+from decimal import Decimal
+import csv
+import io
+import json
+import zlib
+
+
+"""
+Exported columns. CSV and Parquet have one row per person, prefixed with
+the company columns (a company without people has one row with empty
+person columns). JSONL has one company per line with its personnel.
+"""
+COMPANY_COLUMNS = (
+    'id', 'cr_id', 'source_url', 'registration_number', 'name',
+    'additional_name', 'governorate', 'registration_date', 'record_type',
+    'company_status', 'company_duration', 'legal_form', 'capital', 'title',
+    'description', 'missing_personnel_data', 'updated_at',
+)
+PERSON_COLUMNS = (
+    'id', 'name', 'nationality', 'relationship', 'stock', 'quota', 'ratio',
+    'individual_id',
+)
+FLAT_COLUMNS = COMPANY_COLUMNS + tuple(f'person_{column}' for column in PERSON_COLUMNS)
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'parquet')
+COMPRESSIONS = ('none', 'gzip')
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+class ExportError(ValueError):
+    """ Unknown format or compression, or a missing optional dependency """
+
+
+def iter_chunks(chunk_size=constants.EXPORT_CHUNK_SIZE):
+    """
+    Yields lists of (company dict, [person dicts]) of at most chunk_size
+    companies, in id order. Companies come from a server-side cursor and
+    the people of each chunk from one query, so memory stays bounded.
+    """
+    companies = Company.objects.order_by('id').values_list(
+        *COMPANY_COLUMNS).iterator(chunk_size=chunk_size)
+    chunk = []
+    for row in companies:
+        chunk.append(dict(zip(COMPANY_COLUMNS, row)))
+        if len(chunk) == chunk_size:
+            yield with_personnel(chunk)
+            chunk = []
+    if chunk:
+        yield with_personnel(chunk)
+
+
+def with_personnel(companies):
+    personnel = {company['id']: [] for company in companies}
+    rows = Person.objects.filter(company_id__in=list(personnel)).order_by(
+        'company_id', 'id').values_list('company_id', *PERSON_COLUMNS)
+    for company_id, *row in rows:
+        personnel[company_id].append(dict(zip(PERSON_COLUMNS, row)))
+    return [(company, personnel[company['id']]) for company in companies]
+
+
+def flat_rows(chunk):
+    """ One tuple of FLAT_COLUMNS per person (or per company without people) """
+    empty = (None,) * len(PERSON_COLUMNS)
+    for company, personnel in chunk:
+        values = tuple(company[column] for column in COMPANY_COLUMNS)
+        if not personnel:
+            yield values + empty
+        for person in personnel:
+            yield values + tuple(person[column] for column in PERSON_COLUMNS)
+
+
+def to_text(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class CsvEncoder:
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.writer.writerow(FLAT_COLUMNS)
+
+    def encode(self, chunk):
+        for row in flat_rows(chunk):
+            self.writer.writerow([to_text(value) for value in row])
+        return self.drain()
+
+    def drain(self):
+        data = self.buffer.getvalue().encode()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+    def close(self):
+        return self.drain()
+
+
+class JsonlEncoder:
+    def encode(self, chunk):
+        return ''.join(
+            json.dumps(dict(company, personnel=personnel),
+                       default=to_text, ensure_ascii=False) + '\n'
+            for company, personnel in chunk
+        ).encode()
+
+    def close(self):
+        return b''
+
+
+class ParquetEncoder:
+    """ One row group per chunk, compressed by Parquet itself """
+
+    def __init__(self, compression):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ExportError('Parquet export requires pyarrow (pip install pyarrow)')
+        self.pyarrow = pyarrow
+        types = {
+            'registration_number': pyarrow.int64(),
+            'governorate': pyarrow.int16(),
+            'registration_date': pyarrow.timestamp('us', tz='UTC'),
+            'updated_at': pyarrow.timestamp('us', tz='UTC'),
+            'capital': pyarrow.decimal128(15, 2),
+            'missing_personnel_data': pyarrow.bool_(),
+            'id': pyarrow.int64(),
+            'person_id': pyarrow.int64(),
+            'person_stock': pyarrow.int64(),
+            'person_quota': pyarrow.int64(),
+            'person_ratio': pyarrow.int64(),
+            'person_individual_id': pyarrow.int64(),
+        }
+        self.schema = pyarrow.schema([(column, types.get(column, pyarrow.string()))
+                                      for column in FLAT_COLUMNS])
+        self.sink = io.BytesIO()
+        self.writer = pyarrow.parquet.ParquetWriter(
+            self.sink, self.schema,
+            compression='none' if compression == 'none' else compression)
+
+    def encode(self, chunk):
+        columns = list(zip(*flat_rows(chunk)))
+        self.writer.write_table(self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array(values, type=field.type)
+             for values, field in zip(columns, self.schema)],
+            schema=self.schema))
+        return self.drain()
+
+    def drain(self):
+        data = self.sink.getvalue()
+        self.sink.seek(0)
+        self.sink.truncate()
+        return data
+
+    def close(self):
+        self.writer.close()
+        return self.drain()
+
+
+def get_encoder(export_format, compression):
+    if export_format not in EXPORT_FORMATS:
+        raise ExportError(f'Unknown format {export_format!r}, '
+                          f'expected one of {", ".join(EXPORT_FORMATS)}')
+    if compression not in COMPRESSIONS:
+        raise ExportError(f'Unknown compression {compression!r}, '
+                          f'expected one of {", ".join(COMPRESSIONS)}')
+    if export_format == 'parquet':
+        return ParquetEncoder(compression)
+    return CsvEncoder() if export_format == 'csv' else JsonlEncoder()
+
+
+def get_file_name(export_format, compression):
+    name = f'lcr-export.{export_format}'
+    if compression == 'gzip' and export_format != 'parquet':
+        name += '.gz'
+    return name
+
+
+def export_dataset(export_format='csv', compression='none',
+                   chunk_size=constants.EXPORT_CHUNK_SIZE):
+    """
+    Yields the whole dataset as bytes, one piece per chunk of companies
+        - compression: gzip compresses the CSV/JSONL stream,
+          Parquet compresses its columns instead
+    Raises ExportError before yielding anything when the export cannot run.
+    """
+    encoder = get_encoder(export_format, compression)
+    gzip = compression == 'gzip' and export_format != 'parquet'
+
+    def _export():
+        compressor = zlib.compressobj(wbits=31) if gzip else None  # gzip header
+
+        def output(data):
+            return compressor.compress(data) if compressor else data
+
+        for chunk in iter_chunks(chunk_size):
+            data = output(encoder.encode(chunk))
+            if data:
+                yield data
+        data = output(encoder.close())
+        if compressor:
+            data += compressor.flush()
+        if data:
+            yield data
+
+    return _export()
@@ -0,0 +1,91 @@
+from api.models import Company, GovernorateIdSpace
+from api.helpers.lcr_fetch import LCRFetcher
+from api.helpers.lcr_parse import LCRPage
+from api import constants
+
+from django.db.models import Max
+import asyncio
+
+
+class DiscoveryError(Exception):
+    """ A probe failed to reach the registry, so no bound can be concluded """
+
+
+async def probe_window(fetcher, gov, cr_sub_id, gap_tolerance):
+    """
+    Largest existing id in cr_sub_id <= id < cr_sub_id + gap_tolerance,
+    None when every id of the window is empty
+    """
+    found = None
+    async for result in fetcher.fetch_range(gov, cr_sub_id, cr_sub_id + gap_tolerance):
+        if result.error is not None:
+            raise DiscoveryError(
+                f'Probe of {gov}/{result.cr_sub_id} failed: {result.error}')
+        if not LCRPage(result.content).is_empty():
+            found = max(found or 0, result.cr_sub_id)
+    return found
+
+
+async def find_upper_bound(fetcher, gov, lower,
+                           gap_tolerance=constants.DISCOVERY_GAP_TOLERANCE,
+                           initial_step=constants.DISCOVERY_INITIAL_STEP):
+    """
+    Largest existing cr_sub_id of a governorate, at least lower.
+
+    A probe at x looks at the whole window [x, x + gap_tolerance),
+    so sparse gaps shorter than gap_tolerance do not end the search.
+        - Exponential search: doubles the step from lower until a probe is empty
+        - Binary search between the last non-empty and the first empty probe
+    Costs O(log(bound) * gap_tolerance) requests.
+    """
+    low, bound = lower, lower
+    step = initial_step
+    high = low + step
+    while True:
+        found = await probe_window(fetcher, gov, high, gap_tolerance)
+        if found is None:
+            break
+        low, bound = high, found
+        step *= 2
+        high = low + step
+
+    while high - low > gap_tolerance:
+        middle = (low + high) // 2
+        found = await probe_window(fetcher, gov, middle, gap_tolerance)
+        if found is None:
+            high = middle
+        else:
+            low, bound = middle, max(bound, found)
+
+    if low == lower:
+        # lower's own window was never probed, cover the ids up to high
+        found = await probe_window(fetcher, gov, low + 1, high - low - 1)
+        bound = max(bound, found or 0)
+    return bound
+
+
+def discover_id_space(gov, **fetcher_kwargs):
+    """
+    Probes the registry for the end of a governorate's id space and records it.
+    The search starts from the larger of the recorded bound and the
+    largest scraped cr_sub_id, which are known to exist.
+    """
+    recorded = GovernorateIdSpace.objects.filter(governorate=gov).first()
+    scraped = Company.objects.filter(governorate=gov).aggregate(
+        Max('cr_sub_id'))['cr_sub_id__max'] or 0
+    lower = max(scraped, recorded.max_cr_sub_id if recorded else 0)
+
+    async def _discover():
+        async with LCRFetcher(**fetcher_kwargs) as fetcher:
+            return await find_upper_bound(fetcher, gov, lower)
+
+    max_cr_sub_id = asyncio.run(_discover())
+    GovernorateIdSpace.objects.update_or_create(
+        governorate=gov, defaults={'max_cr_sub_id': max_cr_sub_id})
+    return max_cr_sub_id
+
+
+def get_max_cr_sub_id(gov):
+    """ Recorded end of a governorate's id space, None when never probed """
+    return GovernorateIdSpace.objects.filter(governorate=gov).values_list(
+        'max_cr_sub_id', flat=True).first()
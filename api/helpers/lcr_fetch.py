@@ -0,0 +1,124 @@
+from api.helpers.lcr_scrape import build_cr_id
+from api.helpers.metrics import observe_stage
+from api.helpers.rate_limit import is_registry_failure
+from api import constants
+
+from collections import namedtuple
+import aiohttp
+import asyncio
+import time
+
+
+"""
+Outcome of fetching a single registry page.
+Exactly one of content (raw bytes) and error is set.
+"""
+FetchResult = namedtuple(
+    'FetchResult', ['governorate', 'cr_sub_id', 'content', 'error'])
+
+
+class LCRFetcher:
+    """
+    Fetches Commercial Registry pages concurrently from one process,
+    reusing a pool of keep-alive connections for every request.
+    With a limiter (RegistryRateLimiter) every request waits for a token
+    and reports its outcome so the shared rate can adapt.
+
+    Usage:
+        async with LCRFetcher() as fetcher:
+            async for result in fetcher.fetch_range(gov, 1, 501):
+                ...
+    """
+
+    def __init__(self, concurrency=constants.FETCH_CONCURRENCY,
+                 timeout=constants.FETCH_TIMEOUT,
+                 base_url=constants.COMMERCIAL_REGISTRY_URL, limiter=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.base_url = base_url
+        self.limiter = limiter
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            raise_for_status=True
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+
+    async def fetch(self, gov, cr_sub_id):
+        """ Fetches one page, returning errors instead of raising them """
+        url = self.base_url + build_cr_id(gov, cr_sub_id)
+        if self.limiter is not None:
+            await self.limiter.acquire_async()
+        started = time.monotonic()
+        try:
+            async with self.session.get(url) as response:
+                content = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if self.limiter is not None and is_registry_failure(e):
+                await self.__report(self.limiter.record_failure)
+            return FetchResult(gov, cr_sub_id, None, e)
+        latency = time.monotonic() - started
+        if self.limiter is not None:
+            await self.__report(self.limiter.record_success, latency)
+        observe_stage('fetch', gov, latency)
+        return FetchResult(gov, cr_sub_id, content, None)
+
+    async def __report(self, record, *args):
+        """ Limiter calls go to Redis, keep them off the event loop """
+        await asyncio.get_running_loop().run_in_executor(None, record, *args)
+
+    async def fetch_many(self, ids):
+        """
+        Yields a FetchResult for every (gov, cr_sub_id) pair in ids
+        as soon as it completes, with at most `concurrency` requests
+        in flight at any time
+        """
+        ids = iter(ids)
+        pending = set()
+        while True:
+            for gov, cr_sub_id in ids:
+                pending.add(asyncio.ensure_future(self.fetch(gov, cr_sub_id)))
+                if len(pending) >= self.concurrency:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+
+    def fetch_range(self, gov, start, end):
+        """ Same as fetch_many for cr_sub_ids start <= id < end """
+        return self.fetch_many((gov, cr_sub_id)
+                               for cr_sub_id in range(start, end))
+
+
+def fetch_range(gov, start, end, **kwargs):
+    """
+    Synchronous entry point for Celery tasks and management commands.
+    Fetches cr_sub_ids start <= id < end for one governorate and returns
+    their FetchResults ordered by cr_sub_id
+    """
+    return fetch_ids([(gov, cr_sub_id) for cr_sub_id in range(start, end)], **kwargs)
+
+
+def fetch_ids(ids, **kwargs):
+    """
+    Same as fetch_range for arbitrary (gov, cr_sub_id) pairs,
+    FetchResults are ordered by (gov, cr_sub_id)
+    """
+    async def _fetch():
+        async with LCRFetcher(**kwargs) as fetcher:
+            return [result async for result in fetcher.fetch_many(ids)]
+
+    results = asyncio.run(_fetch())
+    return sorted(results, key=lambda result: (result.governorate, result.cr_sub_id))
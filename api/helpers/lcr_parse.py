@@ -0,0 +1,201 @@
+from bs4 import UnicodeDammit
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+from lxml import etree
+import hashlib
+import json
+import time
+
+
+"""
+Only elements whose id starts with one of these prefixes are indexed
+"""
+INDEXED_ID_PREFIXES = ('DataList1_', 'Relations_ListView_')
+
+"""
+Header row of the personnel table, missing when the registry has no personnel data
+"""
+PERSONNEL_TABLE_ID = 'Relations_ListView_Tr1'
+
+COMPANY_FIELDS = (
+    ('registration_number', 'DataList1_Label1_0', 'string'),
+    ('name', 'DataList1_Label2_0', 'string'),
+    ('additional_name', 'DataList1_Label3_0', 'string'),
+    ('record_type', 'DataList1_Label6_0', 'string'),
+    ('company_status', 'DataList1_Label7_0', 'string'),
+    ('company_duration', 'DataList1_Label8_0', 'string'),
+    ('legal_form', 'DataList1_Label9_0', 'string'),
+    ('capital', 'DataList1_Label10_0', 'decimal'),
+    ('title', 'DataList1_Label11_0', 'string'),
+    ('description', 'DataList1_Label12_0', 'string'),
+)
+
+REGISTRATION_DATE_ID = 'DataList1_Label5_0'
+REGISTRATION_DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+
+"""
+Records of a page extracted by parse_page. When extraction failed, error
+is set and error_stage is the LCRScrape step it failed in ('page',
+'company' or 'personnel'), the records extracted before it are kept.
+seconds is the time parse_page took.
+"""
+ParsedPage = namedtuple(
+    'ParsedPage', ['company_record', 'personnel_records', 'error_stage', 'error', 'seconds'])
+
+
+class EmptyPageError(ValueError):
+    """ The registry has no company under the requested id """
+
+
+class LCRPage:
+    """
+    Single-pass extractor for Commercial Registry company pages.
+
+    The document is parsed once with lxml (libxml2) and every
+    DataList1_* / Relations_ListView_* span is indexed by id, so each
+    field lookup afterwards is a dict access instead of a full-tree search.
+    """
+
+    def __init__(self, content):
+        self.spans = {}
+        self.has_personnel_table = False
+        root = etree.HTML(self.__decode(content))
+        if root is None:
+            return  # Empty document
+        for element in root.iter('span', 'tr'):
+            tag_id = element.get('id')
+            if not tag_id or not tag_id.startswith(INDEXED_ID_PREFIXES):
+                continue
+            if element.tag == 'span':
+                self.spans[tag_id] = element.text or ''
+            elif tag_id == PERSONNEL_TABLE_ID:
+                self.has_personnel_table = True
+
+    @staticmethod
+    def __decode(content):
+        """
+        Registry pages are utf-8, only guess the encoding when they are not
+        (starting with the charset the page declares)
+        """
+        if isinstance(content, str):
+            return content
+        try:
+            return content.decode('utf-8')
+        except UnicodeDecodeError:
+            return UnicodeDammit(content, is_html=True).unicode_markup
+
+    def is_empty(self):
+        """ Whether the page is the registry's answer for an id without a company """
+        return not self.spans.get(COMPANY_FIELDS[0][1])
+
+    def get_value(self, tag_id, cast_type='string'):
+        """ Helper for span value casting """
+        try:
+            contents = self.spans[tag_id]
+        except KeyError:
+            raise ValueError(f'No span with id {tag_id} on page')
+        if contents:
+            if cast_type == 'string':
+                return contents
+            elif cast_type == 'decimal':
+                return Decimal(contents)
+            elif cast_type == 'int':
+                return int(contents)
+        else:
+            return ''
+
+    def company_record(self):
+        """
+        Company field values keyed by Company model field name.
+        registration_date is naive, the registry does not publish a timezone.
+        """
+        if self.is_empty():
+            raise EmptyPageError('No company on page')
+        record = {
+            field: self.get_value(tag_id, cast_type)
+            for field, tag_id, cast_type in COMPANY_FIELDS
+        }
+        record['registration_date'] = datetime.strptime(
+            self.get_value(REGISTRATION_DATE_ID), REGISTRATION_DATE_FORMAT)
+        record['missing_personnel_data'] = not self.has_personnel_table
+        return record
+
+    def personnel_row_count(self):
+        count = 0
+        while 'Relations_ListView_desigLabel_' + str(count) in self.spans:
+            count += 1
+        return count
+
+    def personnel_records(self):
+        """
+        Person field values keyed by Person model field name, one per person
+            - If a person appears on several rows
+                - Relationships are joined and missing amounts filled
+                  from the later rows
+        """
+        person_dict = {}
+        for index in range(self.personnel_row_count()):
+            suffix = str(index)
+            name = self.get_value('Relations_ListView_desigLabel_' + suffix)
+            relationship = self.get_value(
+                'Relations_ListView_relLabel_' + suffix)
+            stock = self.get_value(
+                'Relations_ListView_a_valLabel_' + suffix, 'int')
+            quota = self.get_value(
+                'Relations_ListView_s_valLabel_' + suffix, 'int')
+            ratio = self.get_value(
+                'Relations_ListView_r_valLabel_' + suffix, 'int')
+            if name in person_dict:
+                person = person_dict[name]
+                person['relationship'] += ' \\ ' + relationship
+                if person['stock'] == 0:
+                    person['stock'] = stock
+                if person['quota'] == 0:
+                    person['quota'] = quota
+                if person['ratio'] == 0:
+                    person['ratio'] = ratio
+            else:
+                person_dict[name] = {
+                    'name': name,
+                    'nationality': self.get_value(
+                        'Relations_ListView_countryLabel_' + suffix),
+                    'relationship': relationship,
+                    'stock': stock,
+                    'quota': quota,
+                    'ratio': ratio,
+                }
+        return list(person_dict.values())
+
+
+def parse_page(content):
+    """
+    Extracts the records of a page, returning errors instead of raising
+    them. Needs neither Django nor the database, so it can run in a pool
+    of processes (see helpers/pipeline.py).
+    """
+    started = time.perf_counter()
+    company_record = personnel_records = None
+    stage = 'page'
+    try:
+        page = LCRPage(content)
+        stage = 'company'
+        company_record = page.company_record()
+        if not company_record['missing_personnel_data']:
+            stage = 'personnel'
+            personnel_records = page.personnel_records()
+    except Exception as e:
+        return ParsedPage(company_record, None, stage, e, time.perf_counter() - started)
+    return ParsedPage(company_record, personnel_records, None, None,
+                      time.perf_counter() - started)
+
+
+def page_fingerprint(company_record, personnel_records):
+    """
+    sha256 of the extracted company and personnel values.
+    Markup changes on the registry side do not change it, data changes do.
+    """
+    canonical = json.dumps([company_record, personnel_records],
+                           sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
@@ -1,166 +1,202 @@
-from api.models import Company, Person, ScrapeError
+from api.models import Company, Person
+from api.helpers.lcr_parse import LCRPage, page_fingerprint
+from api.helpers.lcr_writer import upsert_companies, replace_personnel
+from api.helpers.metrics import get_metrics, observe_stage, time_stage
+from api.helpers.page_archive import get_page_archive
+from api.helpers.rate_limit import get_rate_limiter, is_registry_failure
+from api.helpers.scrape_errors import record_scrape_error
+from api.helpers.search import search_key
 from api import constants
 
 from celery import shared_task
-from bs4 import BeautifulSoup
-from datetime import datetime
-from decimal import Decimal
+from django.db import transaction
 from django.utils.timezone import make_aware
 import requests
 import time
 
 
+def build_cr_id(gov, cr_sub_id):
+    """ Commercial Registry id, e.g. governorate 3 and sub id 42 -> 3000000042 """
+    return str(gov) + str(cr_sub_id).zfill(9)
+
+
+def split_cr_id(cr_id):
+    """ Inverse of build_cr_id, returns (gov, cr_sub_id) """
+    return int(cr_id[:-9]), int(cr_id[-9:])
+
+
 class LCRScrape:
-    def __init__(self, cr_sub_id, gov):
+    def __init__(self, cr_sub_id, gov, refresh=False, stored_fingerprint=None,
+                 writer=None):
+        """
+        refresh: only write the company when its page fingerprint differs
+        from stored_fingerprint (looked up in the database when not given,
+        '' for companies that are not stored yet)
+        writer: BulkWriter buffering the company instead of writing it
+        right away (write errors are then recorded when the writer flushes)
+        """
         self.cr_sub_id = cr_sub_id
         self.governorate = gov
-        self.cr_id = str(gov) + str(cr_sub_id).zfill(9)
+        self.cr_id = build_cr_id(gov, cr_sub_id)
         self.source_url = constants.COMMERCIAL_REGISTRY_URL + self.cr_id
-        self.soup = None
+        self.refresh = refresh
+        self.stored_fingerprint = stored_fingerprint
+        self.writer = writer
+        self.page = None
+        self.parsed = None
         self.company = None
-        self.personnel = {}
+        self.company_record = None
+        self.personnel = []
+        self.personnel_records = None
+        self.changed = None
 
-    def extract_data(self):
-        self.__get_soup()
-        self.__get_company()
-        self.__get_personnel()
+    def extract_data(self, content=None, fetch_error=None, parsed=None):
+        """
+        Scrapes the company page and saves it to the database
+            - content: page already fetched elsewhere (e.g. by LCRFetcher),
+              skips the request to the Commercial Registry
+            - fetch_error: exception raised while fetching elsewhere,
+              recorded like a failed request
+            - parsed: ParsedPage of the content extracted elsewhere
+              (e.g. by parse_page in a process pool), skips parsing
+        """
+        self.parsed = parsed
+        try:
+            self.__get_page(content, fetch_error)
+            self.__get_company()
+            self.__get_personnel()
+            self.__save_company()
+        finally:
+            get_metrics().flush_when_due()
 
-    def __get_soup(self):
+    def __get_page(self, content=None, fetch_error=None):
         try:
-            r = requests.get(self.source_url)
-            self.soup = BeautifulSoup(r.content, 'html.parser')
+            if fetch_error is not None:
+                raise fetch_error
+            if content is None:
+                content = self.__fetch()
+                archive = get_page_archive()
+                if archive is not None:
+                    archive.put(self.cr_id, content)
+            if self.parsed is not None:
+                observe_stage('parse', self.governorate, self.parsed.seconds)
+                if self.parsed.error_stage == 'page':
+                    raise self.parsed.error
+            else:
+                with time_stage('parse', self.governorate):
+                    self.page = LCRPage(content)
         except Exception as e:
-            scrape_error = ScrapeError(
-                cr_id=self.cr_id,
-                model_type='UK',
-                error_message=str(e)
-            )
-            scrape_error.save()
-            raise Exception("Failed to get soup from source url")
+            record_scrape_error(self.cr_id, 'UK', e)
+            raise Exception("Failed to get page from source url")
+
+    def __fetch(self):
+        """ Fetches the page once the shared rate limiter allows it """
+        limiter = get_rate_limiter()
+        limiter.acquire()
+        started = time.monotonic()
+        try:
+            r = requests.get(self.source_url, timeout=constants.FETCH_TIMEOUT)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            if is_registry_failure(e):
+                limiter.record_failure()
+            raise
+        latency = time.monotonic() - started
+        limiter.record_success(latency)
+        observe_stage('fetch', self.governorate, latency)
+        return r.content
 
     def __get_company(self):
         try:
-            self.__scrape_company()
+            with time_stage('company', self.governorate):
+                self.__scrape_company()
         except Exception as e:
-            company_scrape_error = ScrapeError(
-                cr_id=self.cr_id,
-                model_type='CO',
-                error_message=str(e)
-            )
-            company_scrape_error.save()
+            record_scrape_error(self.cr_id, 'CO', e)
             raise Exception("Failed to scrape company")
 
     def __get_personnel(self):
         if self.company.missing_personnel_data:
+            self.personnel_records = []
             return False
         try:
-            self.__scrape_personnel()
+            with time_stage('personnel', self.governorate):
+                self.__scrape_personnel()
         except Exception as e:
-            personnel_scrape_error = ScrapeError(
-                cr_id=self.cr_id,
-                model_type='PE',
-                error_message=str(e)
-            )
-            personnel_scrape_error.save()
+            # The company itself is still saved, without a fingerprint
+            self.__save_company()
+            record_scrape_error(self.cr_id, 'PE', e)
             raise Exception("Failed to scrape personnel table")
 
+    def __save_company(self):
+        try:
+            self.__write_company()
+        except Exception as e:
+            record_scrape_error(self.cr_id, 'CO', e)
+            raise Exception("Failed to save company")
+
     def __scrape_company(self):
         """
-        Scrapes company data from html elements
-        Creates a Company object and saves to database
+        Scrapes company data from the page index
+        Creates an unsaved Company object
         """
-        registration_date = self.__get_soup_value('DataList1_Label5_0')
-        registration_date = datetime.strptime(
-            registration_date, '%m/%d/%Y %I:%M:%S %p')
-        registration_date = make_aware(registration_date)
-        personnel_data = self.soup.find(
-            'tr', {'id': 'Relations_ListView_Tr1'})
-        missing_personnel_data = False if personnel_data else True
+        if self.parsed is not None:
+            if self.parsed.error_stage == 'company':
+                raise self.parsed.error
+            self.company_record = self.parsed.company_record
+        else:
+            self.company_record = self.page.company_record()
         self.company = Company(
             cr_id=self.cr_id,
             cr_sub_id=self.cr_sub_id,
             source_url=self.source_url,
-            registration_number=self.__get_soup_value('DataList1_Label1_0'),
-            name=self.__get_soup_value('DataList1_Label2_0'),
-            additional_name=self.__get_soup_value('DataList1_Label3_0'),
             governorate=self.governorate,
-            registration_date=registration_date,
-            record_type=self.__get_soup_value('DataList1_Label6_0'),
-            company_status=self.__get_soup_value('DataList1_Label7_0'),
-            company_duration=self.__get_soup_value('DataList1_Label8_0'),
-            legal_form=self.__get_soup_value('DataList1_Label9_0'),
-            capital=self.__get_soup_value('DataList1_Label10_0', 'decimal'),
-            title=self.__get_soup_value('DataList1_Label11_0'),
-            description=self.__get_soup_value('DataList1_Label12_0'),
-            missing_personnel_data=missing_personnel_data
+            search_name=search_key(self.company_record['name'],
+                                   self.company_record['additional_name']),
+            **dict(self.company_record, registration_date=make_aware(
+                self.company_record['registration_date']))
         )
-        self.company.save()
 
     def __scrape_personnel(self):
         """
-        Loops through personnel table on company website
-            - Scrapes person data from html elements
-            - If person has already been scraped
-                - Update Person object to include extra relationship
-            - Else
-                - Create Person object and add to database
+        Scrapes personnel table from the page index
+        (people on several rows are merged into one record)
+        Creates unsaved Person objects
         """
-        table_rows = self.soup.find(
-            'tr', {'id': 'Relations_ListView_Tr1'})
-        table_rows = table_rows.parent.findAll('tr')
-        table_rows = table_rows[1:]  # Ignore column names
-        person_dict = {}
-        for index, row in enumerate(table_rows):
-            name = self.__get_soup_value(
-                'Relations_ListView_desigLabel_' + str(index))
-            relationship = self.__get_soup_value(
-                'Relations_ListView_relLabel_' + str(index))
-            if name in person_dict.keys():
-                person = person_dict[name]
-                person = self.__update_person(person, relationship, index)
-
-            else:
-                person = Person(
-                    name=name,
-                    company_id=self.company.id,
-                    nationality=self.__get_soup_value(
-                        'Relations_ListView_countryLabel_' + str(index)),
-                    relationship=relationship,
-                    stock=self.__get_soup_value(
-                        'Relations_ListView_a_valLabel_' + str(index), 'int'),
-                    quota=self.__get_soup_value(
-                        'Relations_ListView_s_valLabel_' + str(index), 'int'),
-                    ratio=self.__get_soup_value(
-                        'Relations_ListView_r_valLabel_' + str(index), 'int')
-                )
-                person_dict[name] = person
-        self.personnel = person_dict.values()
-        Person.objects.bulk_create(self.personnel)
-
-    def __update_person(self, person, relationship, index):
-        person.relationship = person.relationship + ' \\ ' + relationship
-        stock = self.__get_soup_value(
-            'Relations_ListView_a_valLabel_' + str(index), 'int')
-        quota = self.__get_soup_value(
-            'Relations_ListView_s_valLabel_' + str(index), 'int')
-        ratio = self.__get_soup_value(
-            'Relations_ListView_r_valLabel_' + str(index), 'int')
-        if person.stock == 0:
-            person.stock = stock
-        if person.quota == 0:
-            person.quota = quota
-        if person.ratio == 0:
-            person.ratio = ratio
-
-    def __get_soup_value(self, tag_id, cast_type='string'):
-        """ Helper for soup element casting """
-        contents = self.soup.find('span', {'id': tag_id}).contents
-        if contents:
-            if cast_type == 'string':
-                return str(contents[0])
-            elif cast_type == 'decimal':
-                return Decimal(contents[0])
-            elif cast_type == 'int':
-                return int(contents[0])
+        if self.parsed is not None:
+            if self.parsed.error_stage == 'personnel':
+                raise self.parsed.error
+            self.personnel_records = self.parsed.personnel_records
         else:
-            return ''
+            self.personnel_records = self.page.personnel_records()
+        self.personnel = [Person(search_name=search_key(record['name']), **record)
+                          for record in self.personnel_records]
+
+    def __write_company(self):
+        """
+        Upserts the company on cr_id and replaces its personnel
+            - In refresh mode
+                - Nothing is written when the page fingerprint
+                  matches the stored one
+        """
+        if self.personnel_records is not None:
+            self.company.fingerprint = page_fingerprint(
+                self.company_record, self.personnel_records)
+        if self.refresh:
+            if self.stored_fingerprint is None:
+                self.stored_fingerprint = Company.objects.filter(
+                    cr_id=self.cr_id).values_list('fingerprint', flat=True).first() or ''
+            self.changed = (not self.company.fingerprint
+                            or self.company.fingerprint != self.stored_fingerprint)
+            if not self.changed:
+                return
+        self.changed = True
+        if self.writer is not None:
+            self.writer.add(self.company, self.personnel
+                            if self.personnel_records is not None else None)
+            return
+        with time_stage('write', self.governorate), transaction.atomic():
+            upsert_companies([self.company])
+            if self.personnel_records is not None:
+                for person in self.personnel:
+                    person.company_id = self.company.id
+                replace_personnel({self.company.id: self.personnel})
@@ -0,0 +1,80 @@
+from api.models import Company, Person
+
+from django.db import connection
+from operator import attrgetter
+
+
+"""
+Rows per INSERT statement, keeps statements well under the
+65535 parameter limit of PostgreSQL
+"""
+UPSERT_BATCH_SIZE = 1000
+
+
+def upsert_companies(companies):
+    """
+    Inserts unsaved Company objects in bulk
+        - If a company with the same cr_id is already stored
+            - Its row is updated in place (created_at is kept)
+    Sets the primary key of every object.
+    Writing the same companies twice is harmless.
+    Relies on INSERT ... ON CONFLICT, supported by PostgreSQL and SQLite.
+    """
+    # A statement cannot update the same row twice, the last object wins.
+    # Rows are locked in cr_id order, so writers of overlapping batches
+    # (a chunk delivered twice) wait for each other instead of deadlocking
+    companies = sorted({company.cr_id: company for company in companies}.values(),
+                       key=attrgetter('cr_id'))
+    fields = [field for field in Company._meta.concrete_fields
+              if not field.primary_key]
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(field.column) for field in fields)
+    updates = ', '.join(
+        f'{quote(field.column)} = EXCLUDED.{quote(field.column)}'
+        for field in fields if field.name not in ('cr_id', 'created_at'))
+    row_placeholder = '(' + ', '.join(['%s'] * len(fields)) + ')'
+
+    for start in range(0, len(companies), UPSERT_BATCH_SIZE):
+        batch = companies[start:start + UPSERT_BATCH_SIZE]
+        params = []
+        for company in batch:
+            params.extend(
+                field.get_db_prep_save(field.pre_save(company, True), connection)
+                for field in fields)
+        sql = (
+            f'INSERT INTO {quote(Company._meta.db_table)} ({columns}) '
+            f'VALUES {", ".join([row_placeholder] * len(batch))} '
+            f'ON CONFLICT ({quote("cr_id")}) DO UPDATE SET {updates} '
+            f'RETURNING {quote("id")}, {quote("cr_id")}'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            ids = {cr_id: pk for pk, cr_id in cursor.fetchall()}
+        for company in batch:
+            company.pk = ids[company.cr_id]
+            company._state.adding = False
+
+
+def replace_personnel(personnel):
+    """
+    Replaces the stored people of companies
+        - personnel: {company id: [unsaved Person objects]}
+        - A person keeps the individual (see helpers/entity_resolution.py)
+          of the stored person of its company with the same name and
+          nationality, so rewritten companies need no resolution again
+    """
+    stored = Person.objects.filter(company_id__in=list(personnel))
+    individuals = dict(
+        ((company_id, name, nationality), individual_id)
+        for company_id, name, nationality, individual_id in stored.filter(
+            individual__isnull=False).values_list(
+                'company_id', 'name', 'nationality', 'individual_id'))
+    stored.delete()
+    for company_id, people in personnel.items():
+        for person in people:
+            if person.individual_id is None:
+                person.individual_id = individuals.get(
+                    (company_id, person.name, person.nationality))
+    Person.objects.bulk_create(
+        [person for people in personnel.values() for person in people],
+        batch_size=UPSERT_BATCH_SIZE)
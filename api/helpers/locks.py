@@ -0,0 +1,44 @@
+from contextlib import contextmanager
+from django.db import connection
+import fcntl
+import os
+
+
+@contextmanager
+def try_advisory_lock(lock_id):
+    """
+    Holds a PostgreSQL session advisory lock for the duration of the block,
+    yields whether it was acquired (other databases always acquire it)
+    """
+    if connection.vendor != 'postgresql':
+        yield True
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [lock_id])
+        acquired = cursor.fetchone()[0]
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [lock_id])
+
+
+@contextmanager
+def try_file_lock(path):
+    """
+    Holds an exclusive lock on a file for the duration of the block, yields
+    whether it was acquired. Unlike advisory locks it is only shared by the
+    processes of one machine, for files on its local disk.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,349 @@
+from api.helpers.rate_limit import RegistryRateLimiter
+from api import constants
+
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from collections import defaultdict
+from contextlib import contextmanager
+from django.conf import settings
+import bisect
+import os
+import redis
+import threading
+import time
+
+
+_metrics = None
+_task_started = {}  # task id: perf_counter when it started
+
+"""
+Metrics, with their labels
+    lcr_scrape_stage_seconds{stage, governorate}: histogram of the time
+        taken by fetch (registry response), parse (LCRPage), company and
+        personnel (extraction) for one page, and by write (one page, or
+        one BulkWriter batch)
+    lcr_scrape_pages_total{governorate, outcome}: counter, outcome is
+        scraped, unchanged, fetch_errors or scrape_errors
+    lcr_write_rows_total{governorate}: counter of companies and people
+        written in BulkWriter batches
+    lcr_task_wait_seconds{task}: histogram, queued to started
+    lcr_task_run_seconds{task}: histogram
+    lcr_tasks_total{task, state}: counter
+Gauges are read when metrics are rendered:
+    lcr_queue_length{queue}: tasks waiting in a Celery queue
+    lcr_registry_rate: requests/sec allowed by the shared rate limiter
+    lcr_registry_circuit_open: 1 while fetching is paused
+"""
+STAGE_SECONDS = 'lcr_scrape_stage_seconds'
+PAGES_TOTAL = 'lcr_scrape_pages_total'
+WRITE_ROWS_TOTAL = 'lcr_write_rows_total'
+TASK_WAIT_SECONDS = 'lcr_task_wait_seconds'
+TASK_RUN_SECONDS = 'lcr_task_run_seconds'
+TASKS_TOTAL = 'lcr_tasks_total'
+
+HELP = {
+    STAGE_SECONDS: 'Seconds taken by a scrape stage',
+    PAGES_TOTAL: 'Registry pages scraped, by outcome',
+    WRITE_ROWS_TOTAL: 'Companies and people written in batches',
+    TASK_WAIT_SECONDS: 'Seconds a Celery task waited in its queue',
+    TASK_RUN_SECONDS: 'Seconds a Celery task ran',
+    TASKS_TOTAL: 'Celery tasks run, by final state',
+    'lcr_queue_length': 'Tasks waiting in a Celery queue',
+    'lcr_registry_rate': 'Requests/sec allowed by the shared rate limiter',
+    'lcr_registry_circuit_open': 'Whether fetching is paused after registry errors',
+}
+
+"""
+Redis layout: one hash per series (metric and label values), listed in
+SERIES_KEY
+    - Histograms: a count per bucket (not cumulative, the bucket of a
+      value is the first bound it does not exceed), sum and count
+    - Counters: value
+"""
+SERIES_KEY = 'lcr:metrics:series'
+SERIES_PREFIX = 'lcr:metrics:'
+INF = '+Inf'
+
+
+def format_labels(labels):
+    """ {'stage': 'parse', 'governorate': 1} -> 'governorate=1,stage=parse' """
+    return ','.join(f'{name}={value}' for name, value in sorted(labels.items()))
+
+
+def parse_labels(labels):
+    return dict(label.split('=', 1) for label in labels.split(',') if label)
+
+
+def series_key(metric, labels):
+    return f'{SERIES_PREFIX}{metric}:{labels}'
+
+
+class MetricsRecorder:
+    """
+    Buffers the metrics of this process and adds them to the shared
+    totals in Redis in one pipeline, so instrumenting a page costs no
+    round trip. Recording never flushes (it may happen on an event loop):
+    the scrape code calls flush_when_due between pages, and every task
+    flushes when it ends.
+    Metrics are best effort: when Redis is unreachable the buffer is dropped.
+    Threads of a process share its recorder (see helpers/pipeline.py).
+    """
+
+    def __init__(self, client=None):
+        self.redis = client or redis.Redis.from_url(settings.CELERY_BROKER_URL)
+        self.pid = os.getpid()
+        self.histograms = {}  # (metric, labels): [bucket counts, sum, count]
+        self.counters = defaultdict(float)  # (metric, labels): value
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def observe(self, metric, value, **labels):
+        """ Adds a value (seconds) to a histogram """
+        key = (metric, format_labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [
+                    [0] * (len(constants.METRICS_BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(constants.METRICS_BUCKETS, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def increment(self, metric, amount=1, **labels):
+        with self.lock:
+            self.counters[(metric, format_labels(labels))] += amount
+
+    @contextmanager
+    def timer(self, metric, **labels):
+        """ Observes the time spent in the block, exceptions included """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(metric, time.perf_counter() - started, **labels)
+
+    def flush_when_due(self):
+        """ Flushes at most every METRICS_FLUSH_INTERVAL seconds """
+        if time.monotonic() - self.last_flush >= constants.METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            histograms, counters = self.histograms, self.counters
+            self.histograms, self.counters = {}, defaultdict(float)
+        self.last_flush = time.monotonic()
+        if not histograms and not counters:
+            return
+        bounds = [str(bound) for bound in constants.METRICS_BUCKETS] + [INF]
+        pipe = self.redis.pipeline(transaction=False)
+        for (metric, labels), (buckets, total, count) in histograms.items():
+            key = series_key(metric, labels)
+            for bound, bucket_count in zip(bounds, buckets):
+                if bucket_count:
+                    pipe.hincrby(key, bound, bucket_count)
+            pipe.hincrbyfloat(key, 'sum', total)
+            pipe.hincrby(key, 'count', count)
+            pipe.sadd(SERIES_KEY, key)
+        for (metric, labels), value in counters.items():
+            key = series_key(metric, labels)
+            pipe.hincrbyfloat(key, 'value', value)
+            pipe.sadd(SERIES_KEY, key)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            pass  # Metrics never stop a scrape
+
+
+def get_metrics():
+    """ MetricsRecorder of this process """
+    global _metrics
+    if _metrics is None or _metrics.pid != os.getpid():
+        _metrics = MetricsRecorder()  # Never share buffers with a forked parent
+    return _metrics
+
+
+class DiscardingMetricsRecorder(MetricsRecorder):
+    """ Recorder whose metrics are dropped instead of added to the totals """
+
+    def flush(self):
+        with self.lock:
+            self.histograms, self.counters = {}, defaultdict(float)
+        self.last_flush = time.monotonic()
+
+
+@contextmanager
+def discard_metrics():
+    """
+    Replaces the recorder of this process with a DiscardingMetricsRecorder
+    for the duration of the block, so synthetic runs (benchmarks) never
+    show in the Prometheus series. Metrics buffered before are kept.
+    """
+    global _metrics
+    previous = get_metrics()
+    _metrics = DiscardingMetricsRecorder(previous.redis)
+    try:
+        yield _metrics
+    finally:
+        _metrics = previous
+
+
+def time_stage(stage, governorate):
+    """ Context manager observing a scrape stage of a governorate """
+    return get_metrics().timer(STAGE_SECONDS, stage=stage, governorate=governorate)
+
+
+def observe_stage(stage, governorate, seconds):
+    get_metrics().observe(STAGE_SECONDS, seconds, stage=stage, governorate=governorate)
+
+
+# Celery tasks
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    """ Wall clock time the task was queued, read by the worker """
+    if headers is not None:
+        headers['published_at'] = time.time()
+
+
+@task_prerun.connect
+def record_task_start(task_id=None, task=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+    published_at = getattr(task.request, 'published_at', None)
+    if published_at is not None:
+        get_metrics().observe(TASK_WAIT_SECONDS, max(0, time.time() - published_at),
+                              task=task.name)
+
+
+@task_postrun.connect
+def record_task_end(task_id=None, task=None, state=None, **kwargs):
+    metrics = get_metrics()
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        metrics.observe(TASK_RUN_SECONDS, time.perf_counter() - started, task=task.name)
+    metrics.increment(TASKS_TOTAL, task=task.name, state=state or 'UNKNOWN')
+    metrics.flush()
+
+
+# Reading
+
+def read_series(client=None):
+    """
+    [(metric, labels dict, values)] of every series in Redis, by metric
+    and labels. values is {'buckets': [(bound, cumulative count)], 'sum',
+    'count'} for histograms, {'value'} for counters.
+    """
+    client = client or get_metrics().redis
+    keys = sorted(key.decode() for key in client.smembers(SERIES_KEY))
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    bounds = [str(bound) for bound in constants.METRICS_BUCKETS] + [INF]
+    series = []
+    for key, fields in zip(keys, pipe.execute()):
+        if not fields:
+            continue
+        fields = {name.decode(): value.decode() for name, value in fields.items()}
+        metric, labels = key[len(SERIES_PREFIX):].split(':', 1)
+        if 'value' in fields:
+            values = {'value': float(fields['value'])}
+        else:
+            cumulative, buckets = 0, []
+            for bound in bounds:
+                cumulative += int(fields.get(bound, 0))
+                buckets.append((bound, cumulative))
+            values = {'buckets': buckets, 'sum': float(fields.get('sum', 0)),
+                      'count': int(fields.get('count', 0))}
+        series.append((metric, parse_labels(labels), values))
+    return series
+
+
+def histogram_quantile(quantile, buckets):
+    """
+    Estimated quantile of cumulative buckets, interpolating linearly
+    within the bucket it falls in (the last finite bound past them)
+    """
+    total = buckets[-1][1]
+    if not total:
+        return None
+    rank = quantile * total
+    lower_bound, lower_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == INF:
+                return lower_bound
+            bound = float(bound)
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = float(bound), count
+    return lower_bound
+
+
+def queue_lengths(client=None):
+    """
+    {queue: waiting tasks} of the METRICS_QUEUES. The Redis transport
+    keeps each priority level of a queue in its own list.
+    """
+    client = client or get_metrics().redis
+    pipe = client.pipeline(transaction=False)
+    for queue in constants.METRICS_QUEUES:
+        pipe.llen(queue)
+        for priority in (3, 6, 9):
+            pipe.llen(f'{queue}\x06\x16{priority}')
+    lengths = pipe.execute()
+    levels = len(lengths) // len(constants.METRICS_QUEUES)
+    return {queue: sum(lengths[index * levels:(index + 1) * levels])
+            for index, queue in enumerate(constants.METRICS_QUEUES)}
+
+
+def read_gauges(client=None):
+    """ [(metric, labels dict, value)] of the gauges """
+    client = client or get_metrics().redis
+    limiter = RegistryRateLimiter(client)
+    gauges = [('lcr_queue_length', {'queue': queue}, length)
+              for queue, length in queue_lengths(client).items()]
+    gauges.append(('lcr_registry_rate', {}, limiter.current_rate()))
+    gauges.append(('lcr_registry_circuit_open', {}, int(limiter.is_open())))
+    return gauges
+
+
+def render_prometheus(client=None):
+    """ Every metric in the Prometheus text exposition format """
+    def labels_text(labels, **extra):
+        labels = dict(labels, **extra)
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+    lines = []
+    described = set()
+
+    def describe(metric, metric_type):
+        if metric not in described:
+            described.add(metric)
+            lines.append(f'# HELP {metric} {HELP.get(metric, metric)}')
+            lines.append(f'# TYPE {metric} {metric_type}')
+
+    for metric, labels, values in read_series(client):
+        if 'value' in values:
+            describe(metric, 'counter')
+            lines.append(f'{metric}{labels_text(labels)} {values["value"]:g}')
+            continue
+        describe(metric, 'histogram')
+        for bound, count in values['buckets']:
+            lines.append(f'{metric}_bucket{labels_text(labels, le=bound)} {count}')
+        lines.append(f'{metric}_sum{labels_text(labels)} {values["sum"]}')
+        lines.append(f'{metric}_count{labels_text(labels)} {values["count"]}')
+    for metric, labels, value in read_gauges(client):
+        describe(metric, 'gauge')
+        lines.append(f'{metric}{labels_text(labels)} {value:g}')
+    return '\n'.join(lines) + '\n'
+
+
+def reset_metrics(client=None):
+    """ Deletes every stored series, returns how many there were """
+    client = client or get_metrics().redis
+    keys = list(client.smembers(SERIES_KEY))
+    if keys:
+        client.delete(*keys)
+    client.delete(SERIES_KEY)
+    return len(keys)
@@ -0,0 +1,309 @@
+from api.models import Person
+from api.helpers.locks import try_file_lock
+from api import constants
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import json
+import numpy as np
+import os
+import shutil
+import threading
+import time
+import uuid
+
+
+_ownership_graph = None
+_refresh_thread = None
+_refreshed_at = None
+
+GRAPH_FILES = ('companies', 'individuals', 'indptr', 'indices')
+
+
+class OwnershipGraph:
+    """
+    Bipartite graph of companies and the individuals in them, stored as
+    compact arrays that are memory-mapped rather than read.
+
+    Nodes are numbered 0..C-1 for companies and C..C+I-1 for individuals,
+    in the order of their database ids:
+        companies.npy, individuals.npy: sorted database ids
+        indptr.npy, indices.npy: CSR adjacency, the neighbours of node n
+                                 are indices[indptr[n]:indptr[n + 1]]
+        meta.json: built_at, people written or resolved after it are not
+                   indexed yet
+    Two companies are one hop apart when they share an individual.
+    """
+
+    def __init__(self, root=None):
+        self.root = os.path.realpath(
+            root or os.path.join(settings.GRAPH_INDEX_DIR, 'current'))
+        with open(os.path.join(self.root, 'meta.json')) as meta:
+            self.meta = json.load(meta)
+        for name in GRAPH_FILES:
+            setattr(self, name, np.load(os.path.join(self.root, f'{name}.npy'),
+                                        mmap_mode='r'))
+        self.built_at = parse_datetime(self.meta['built_at'])
+        self.company_count = len(self.companies)
+
+    # Node numbering
+
+    def company_node(self, company_id):
+        """ Node of a company, KeyError when it is not in the graph """
+        return self.__node(self.companies, company_id, 0)
+
+    def individual_node(self, individual_id):
+        return self.__node(self.individuals, individual_id, self.company_count)
+
+    @staticmethod
+    def __node(ids, database_id, offset):
+        position = int(np.searchsorted(ids, database_id))
+        if position == len(ids) or ids[position] != database_id:
+            raise KeyError(database_id)
+        return position + offset
+
+    def database_id(self, node):
+        """ ('company' or 'individual', database id) of a node """
+        if node < self.company_count:
+            return 'company', int(self.companies[node])
+        return 'individual', int(self.individuals[node - self.company_count])
+
+    def neighbors(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def __expand(self, frontier):
+        """ Every neighbour of an array of nodes, duplicates included """
+        starts = self.indptr[frontier]
+        lengths = self.indptr[frontier + 1] - starts
+        # Position of every neighbour in indices: start of its node's run
+        # plus its rank within the run
+        run_starts = np.cumsum(lengths) - lengths
+        positions = (np.repeat(starts - run_starts, lengths)
+                     + np.arange(lengths.sum()))
+        return self.indices[positions]
+
+    # Queries on database ids
+
+    def individuals_of(self, company_id):
+        return [int(self.individuals[node - self.company_count])
+                for node in self.neighbors(self.company_node(company_id))]
+
+    def companies_of(self, individual_id):
+        return [int(self.companies[node])
+                for node in self.neighbors(self.individual_node(individual_id))]
+
+    def connected_companies(self, company_id, hops=1):
+        """
+        {company id: hops} of the companies at most `hops` hops away,
+        found breadth first one level of nodes at a time
+        """
+        start = self.company_node(company_id)
+        visited = np.zeros(len(self.indptr) - 1, dtype=bool)
+        visited[start] = True
+        frontier = np.array([start], dtype=self.indices.dtype)
+        found = {}
+        for hop in range(1, hops + 1):
+            for _ in range(2):  # company -> individual -> company
+                frontier = np.unique(self.__expand(frontier))
+                frontier = frontier[~visited[frontier]]
+                visited[frontier] = True
+            if not len(frontier):
+                break
+            found.update((int(self.companies[node]), hop) for node in frontier)
+        return found
+
+    def component(self, company_id):
+        """ Company ids of the connected component of a company """
+        return sorted(self.connected_companies(company_id, hops=len(self.indptr)))
+
+    def shortest_path(self, company_id, other_company_id):
+        """
+        Alternating company and individual ids of a shortest path between
+        two companies, [('company', id), ('individual', id), ...],
+        None when they are not connected
+        """
+        start = self.company_node(company_id)
+        goal = self.company_node(other_company_id)
+        parents = np.full(len(self.indptr) - 1, -1, dtype=np.int64)
+        parents[start] = start
+        frontier = np.array([start], dtype=np.int64)
+        while len(frontier) and parents[goal] < 0:
+            sources = np.repeat(frontier, self.indptr[frontier + 1] - self.indptr[frontier])
+            targets = self.__expand(frontier).astype(np.int64)
+            new = parents[targets] < 0
+            sources, targets = sources[new], targets[new]
+            # First parent wins for nodes reached from several sources
+            targets, first = np.unique(targets, return_index=True)
+            parents[targets] = sources[first]
+            frontier = targets
+        if parents[goal] < 0:
+            return None
+        path = [goal]
+        while path[-1] != start:
+            path.append(int(parents[path[-1]]))
+        return [self.database_id(node) for node in reversed(path)]
+
+    def component_labels(self):
+        """
+        Connected component label (smallest node) of every node, by
+        minimum label propagation with pointer jumping
+        """
+        sources = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        labels = np.arange(len(self.indptr) - 1)
+        while True:
+            updated = labels.copy()
+            np.minimum.at(updated, sources, labels[self.indices])
+            while True:
+                jumped = updated[updated]
+                if np.array_equal(jumped, updated):
+                    break
+                updated = jumped
+            if np.array_equal(updated, labels):
+                return labels
+            labels = updated
+
+    # Building
+
+    def edges(self):
+        """ (company ids, individual ids) of every edge """
+        degrees = np.diff(self.indptr[:self.company_count + 1])
+        company_nodes = np.repeat(np.arange(self.company_count), degrees)
+        individual_nodes = self.indices[:self.indptr[self.company_count]]
+        return (np.asarray(self.companies)[company_nodes],
+                np.asarray(self.individuals)[individual_nodes - self.company_count])
+
+
+def load_edges(persons):
+    """ (company ids, individual ids) arrays of the resolved people of a queryset """
+    rows = np.array(list(persons.filter(individual__isnull=False).values_list(
+        'company_id', 'individual_id').iterator(
+            chunk_size=constants.GRAPH_QUERY_CHUNK_SIZE)), dtype=np.int64)
+    if not len(rows):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return rows[:, 0], rows[:, 1]
+
+
+def write_graph(company_ids, individual_ids, built_at, root=None):
+    """
+    Writes the graph of an edge list to a new directory, then swaps it
+    in as current so readers never see a partial graph
+    """
+    root = root or settings.GRAPH_INDEX_DIR
+    edges = np.unique(np.stack([company_ids, individual_ids]), axis=1)
+    companies, company_nodes = np.unique(edges[0], return_inverse=True)
+    individuals, individual_nodes = np.unique(edges[1], return_inverse=True)
+    individual_nodes = individual_nodes + len(companies)
+    node_count = len(companies) + len(individuals)
+    index_type = np.int32 if node_count < 2 ** 31 else np.int64
+
+    # Both directions of every edge, sorted by source node
+    sources = np.concatenate([company_nodes, individual_nodes])
+    targets = np.concatenate([individual_nodes, company_nodes])
+    order = np.lexsort((targets, sources))
+    indptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=node_count), out=indptr[1:])
+
+    directory = os.path.join(root, f'build-{uuid.uuid4().hex}')
+    os.makedirs(directory)
+    arrays = {
+        'companies': companies,
+        'individuals': individuals,
+        'indptr': indptr,
+        'indices': targets[order].astype(index_type),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f'{name}.npy'), array)
+    with open(os.path.join(directory, 'meta.json'), 'w') as meta:
+        json.dump({
+            'built_at': built_at.isoformat(),
+            'companies': len(companies),
+            'individuals': len(individuals),
+            'edges': edges.shape[1],
+        }, meta)
+
+    current = os.path.join(root, 'current')
+    link = os.path.join(root, f'link-{uuid.uuid4().hex}')
+    previous = os.path.realpath(current) if os.path.islink(current) else None
+    os.symlink(directory, link)
+    os.replace(link, current)
+    if previous and previous != directory:
+        shutil.rmtree(previous, ignore_errors=True)
+    return OwnershipGraph(current)
+
+
+def update_graph(full=False):
+    """
+    Brings the graph up to date with the database
+        - No graph yet, or full: built from every resolved Person
+        - Otherwise only the companies with people written or resolved
+          since the last build (personnel is replaced as a whole) are
+          read again, and merged into the edges of the current graph.
+          Past GRAPH_MAX_DELTA_COMPANIES such companies, everything is
+          read again. Companies that lost all their people are only
+          dropped by a full build.
+    The graph is local to the machine, processes sharing its disk take
+    turns through a file lock.
+    Returns the new OwnershipGraph (the current one when nothing changed),
+    None when another update is running
+    """
+    with try_file_lock(os.path.join(settings.GRAPH_INDEX_DIR, '.lock')) as acquired:
+        if acquired:
+            return _update_graph(full)
+
+
+def _update_graph(full):
+    built_at = timezone.now()
+    try:
+        graph = None if full else OwnershipGraph()
+    except FileNotFoundError:
+        graph = None
+    if graph is not None:
+        changed = np.array(list(Person.objects.filter(
+            updated_at__gte=graph.built_at).values_list('company_id', flat=True).distinct()),
+            dtype=np.int64)
+        if not len(changed):
+            return graph
+    if graph is None or len(changed) > constants.GRAPH_MAX_DELTA_COMPANIES:
+        return write_graph(*load_edges(Person.objects.all()), built_at)
+
+    company_ids, individual_ids = graph.edges()
+    kept = ~np.isin(company_ids, changed)
+    new_company_ids, new_individual_ids = load_edges(
+        Person.objects.filter(company_id__in=changed.tolist()))
+    return write_graph(np.concatenate([company_ids[kept], new_company_ids]),
+                       np.concatenate([individual_ids[kept], new_individual_ids]),
+                       built_at)
+
+
+def refresh_graph():
+    """ Body of the refresh thread of get_ownership_graph """
+    try:
+        update_graph()
+    finally:
+        connection.close()  # This thread's own connection
+
+
+def get_ownership_graph():
+    """
+    OwnershipGraph of this process, reopened when a newer graph was
+    swapped in, None when no graph was built yet.
+    The process serving the graph keeps it up to date itself: every
+    GRAPH_REFRESH_SECONDS a thread merges the people written or resolved
+    since it was built, or builds it when there is none, while requests
+    keep reading the current graph.
+    """
+    global _ownership_graph, _refresh_thread, _refreshed_at
+    now = time.monotonic()
+    if ((_refreshed_at is None or now - _refreshed_at >= constants.GRAPH_REFRESH_SECONDS)
+            and (_refresh_thread is None or not _refresh_thread.is_alive())):
+        _refreshed_at = now
+        _refresh_thread = threading.Thread(target=refresh_graph, daemon=True)
+        _refresh_thread.start()
+    current = os.path.join(settings.GRAPH_INDEX_DIR, 'current')
+    if not os.path.exists(current):
+        return None
+    if _ownership_graph is None or _ownership_graph.root != os.path.realpath(current):
+        _ownership_graph = OwnershipGraph(current)
+    return _ownership_graph
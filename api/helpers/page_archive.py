@@ -0,0 +1,144 @@
+from api import constants
+
+from django.conf import settings
+from django.utils import timezone
+import hashlib
+import os
+import socket
+import sqlite3
+import uuid
+import zlib
+
+
+_page_archive = None
+
+
+class PageArchive:
+    """
+    Compressed, content-addressed archive of raw Commercial Registry pages.
+
+    Layout of the archive directory:
+        index.sqlite3
+            - blobs: sha256 digest -> (segment, offset, length)
+            - fetches: (cr_id, fetched_at) -> digest
+        segments/*.seg
+            - zlib-compressed pages appended back to back
+    A page that did not change between fetches is stored once.
+    Every writing process appends to segments of its own,
+    so workers on one machine can share an archive directory.
+    """
+
+    def __init__(self, root=None, segment_size=constants.ARCHIVE_SEGMENT_SIZE):
+        self.root = root or settings.PAGE_ARCHIVE_DIR
+        self.segment_size = segment_size
+        self.segment_dir = os.path.join(self.root, 'segments')
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self.index = sqlite3.connect(
+            os.path.join(self.root, 'index.sqlite3'), timeout=60)
+        self.index.execute('PRAGMA journal_mode=WAL')
+        self.index.executescript('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS fetches (
+                cr_id TEXT NOT NULL,
+                fetched_at TEXT NOT NULL,
+                digest TEXT NOT NULL REFERENCES blobs (digest),
+                PRIMARY KEY (cr_id, fetched_at)
+            );
+        ''')
+        self.pid = os.getpid()
+        self.segment = None
+        self.readers = {}
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+        self.index.close()
+
+    def put(self, cr_id, content, fetched_at=None):
+        """ Archives one fetched page, returns its digest """
+        return self.put_many([(cr_id, content, fetched_at)])[0]
+
+    def put_many(self, pages):
+        """
+        Archives (cr_id, content, fetched_at) tuples in one index transaction,
+        returns their digests
+        """
+        digests = []
+        with self.index:
+            for cr_id, content, fetched_at in pages:
+                digest = hashlib.sha256(content).hexdigest()
+                known = self.index.execute(
+                    'SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone()
+                if not known:
+                    segment, offset, length = self.__append(
+                        zlib.compress(content))
+                    self.index.execute(
+                        'INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, ?)',
+                        (digest, segment, offset, length))
+                fetched_at = fetched_at or timezone.now()
+                self.index.execute(
+                    'INSERT OR REPLACE INTO fetches VALUES (?, ?, ?)',
+                    (cr_id, fetched_at.isoformat(), digest))
+                digests.append(digest)
+        return digests
+
+    def __append(self, data):
+        if self.segment is None or self.segment.tell() >= self.segment_size:
+            if self.segment is not None:
+                self.segment.close()
+            name = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}.seg'
+            self.segment = open(os.path.join(self.segment_dir, name), 'ab')
+        offset = self.segment.tell()
+        self.segment.write(data)
+        self.segment.flush()
+        return os.path.basename(self.segment.name), offset, len(data)
+
+    def get(self, digest):
+        """ Raw page content for a digest """
+        row = self.index.execute(
+            'SELECT segment, offset, length FROM blobs WHERE digest = ?',
+            (digest,)).fetchone()
+        if row is None:
+            raise KeyError(digest)
+        segment, offset, length = row
+        if segment not in self.readers:
+            self.readers[segment] = open(
+                os.path.join(self.segment_dir, segment), 'rb')
+        reader = self.readers[segment]
+        reader.seek(offset)
+        return zlib.decompress(reader.read(length))
+
+    def latest(self, governorate=None):
+        """
+        (cr_id, fetched_at, digest) of the most recent fetch of every
+        archived cr_id, optionally limited to one governorate
+        """
+        query = '''
+            SELECT cr_id, MAX(fetched_at), digest FROM fetches
+            {where} GROUP BY cr_id ORDER BY cr_id
+        '''
+        if governorate is None:
+            return self.index.execute(query.format(where=''))
+        # cr_ids are the governorate followed by a 9 digit sub id
+        return self.index.execute(
+            query.format(where='WHERE cr_id LIKE ?'),
+            (str(governorate) + '_' * 9,))
+
+
+def get_page_archive():
+    """ PageArchive of this process, None when archiving is disabled """
+    global _page_archive
+    if not settings.PAGE_ARCHIVE_DIR:
+        return None
+    if _page_archive is None or _page_archive.pid != os.getpid():
+        _page_archive = PageArchive()  # Never share handles with a forked parent
+    return _page_archive
@@ -0,0 +1,207 @@
+from api.helpers.lcr_fetch import FetchResult, LCRFetcher
+from api.helpers.lcr_parse import ParsedPage, parse_page
+from api import constants
+
+from collections import namedtuple
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+import asyncio
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+"""
+FetchResult with the ParsedPage of its content (None when fetching
+failed), taken by scrape_results
+"""
+ParsedResult = namedtuple('ParsedResult', FetchResult._fields + ('parsed',))
+
+DONE = object()  # Last item of a stage queue
+PUT_TIMEOUT = 0.1  # Seconds between two checks of the stop flag while a queue is full
+
+
+def make_parse_pool(processes=constants.PARSE_PROCESSES):
+    """
+    Pool of processes for parse_page, None when processes is 0 or this
+    process cannot start any (Celery prefork workers are daemonic).
+    Processes are spawned: they share no thread, socket or database
+    connection with this one.
+    """
+    if not processes or multiprocessing.current_process().daemon:
+        return None
+    return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+
+
+def get_parse_pool():
+    """ Parse pool of this process, shared by every task it runs """
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None or _parse_pool[0] != os.getpid():
+            _parse_pool = (os.getpid(), make_parse_pool())
+        return _parse_pool[1]
+
+
+class ImmediateResult:
+    """ Stands in for the Future of a page parsed without pool """
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+class ScrapePipeline:
+    """
+    Fetches and parses pages in stages running at the same time, so the
+    network and every core are busy while the caller writes:
+        - fetch: LCRFetcher, on an event loop in its own thread
+        - parse: parse_page in a process pool, fed by its own thread
+          (without pool, pages are parsed in that thread)
+        - write: the caller, iterating over stream() (e.g. scrape_results
+          in the thread that owns the database connection)
+    Stages are connected by queues of at most queue_size pages. A stage
+    whose queue is full waits for the stage after it (backpressure), so
+    memory stays bounded whatever their rates.
+    stats has the throughput of each stage once a stream ends: pages,
+    pages_per_second, waiting_seconds (for the stage before it) and
+    blocked_seconds (on the stage after it). The stage that neither
+    waits nor is blocked is the bottleneck.
+
+    Usage:
+        pipeline = ScrapePipeline(get_parse_pool(), limiter=get_rate_limiter())
+        scrape_results(pipeline.stream(ids), stats)
+    """
+
+    def __init__(self, pool=None, queue_size=constants.PIPELINE_QUEUE_SIZE, **fetch_options):
+        """ fetch_options: LCRFetcher arguments (concurrency, base_url, limiter...) """
+        self.pool = pool
+        self.queue_size = queue_size
+        self.fetch_options = fetch_options
+        self.stats = {}
+
+    def stream(self, ids):
+        """
+        Yields a ParsedResult for every (gov, cr_sub_id) pair in ids, in
+        the order they were fetched. Stopping early (or failing) stops
+        every stage; an error of the fetch or parse stage is raised here.
+        """
+        fetched = queue.Queue(self.queue_size)
+        parsed = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        errors = []
+        started = time.perf_counter()
+        self.stats = {stage: {'pages': 0, 'waiting_seconds': 0.0, 'blocked_seconds': 0.0}
+                      for stage in ('fetch', 'parse', 'write')}
+        threads = [
+            threading.Thread(target=self.__run_stage, daemon=True,
+                             args=(self.__fetch, ids, fetched, stop, errors)),
+            threading.Thread(target=self.__run_stage, daemon=True,
+                             args=(self.__parse, fetched, parsed, stop, errors)),
+        ]
+        for thread in threads:
+            thread.start()
+        stats = self.stats['write']
+        try:
+            while True:
+                waited = time.perf_counter()
+                item = parsed.get()
+                if item is DONE:
+                    break
+                result, future = item
+                page = self.__parse_result(future)
+                stats['waiting_seconds'] += time.perf_counter() - waited
+                stats['pages'] += 1
+                yield ParsedResult(*result, page)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            for stage in self.stats.values():
+                stage['pages_per_second'] = round(
+                    stage['pages'] / (time.perf_counter() - started), 1)
+                stage['waiting_seconds'] = round(stage['waiting_seconds'], 3)
+                stage['blocked_seconds'] = round(stage['blocked_seconds'], 3)
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def __parse_result(future):
+        if future is None:
+            return None  # Fetch error
+        try:
+            return future.result()
+        except BrokenExecutor:
+            raise
+        except Exception as e:
+            # The parse error itself could not be sent back
+            return ParsedPage(None, None, 'page', e, 0)
+
+    def __run_stage(self, stage, source, output, stop, errors):
+        """ Runs a stage in its thread, always ending its output with DONE """
+        try:
+            stage(source, output, stop)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            self.__put(output, DONE, stop, force=True)
+
+    @staticmethod
+    def __put(output, item, stop, force=False):
+        """
+        Waits for room in the output queue, returns how long. Gives up once
+        the pipeline is stopped, unless force (DONE is put in any case,
+        dropping the queued pages when the consumer is gone).
+        """
+        started = time.perf_counter()
+        while True:
+            try:
+                output.put(item, timeout=PUT_TIMEOUT)
+                return time.perf_counter() - started
+            except queue.Full:
+                if stop.is_set():
+                    if not force:
+                        return time.perf_counter() - started
+                    try:
+                        output.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def __fetch(self, ids, output, stop):
+        stats = self.stats['fetch']
+
+        async def fetch():
+            loop = asyncio.get_running_loop()
+            async with LCRFetcher(**self.fetch_options) as fetcher:
+                async for result in fetcher.fetch_many(ids):
+                    # Fetches in flight go on while the queue is full
+                    stats['blocked_seconds'] += await loop.run_in_executor(
+                        None, self.__put, output, result, stop)
+                    stats['pages'] += 1
+                    if stop.is_set():
+                        return
+
+        asyncio.run(fetch())
+
+    def __parse(self, source, output, stop):
+        stats = self.stats['parse']
+        while not stop.is_set():
+            waited = time.perf_counter()
+            result = source.get()
+            stats['waiting_seconds'] += time.perf_counter() - waited
+            if result is DONE:
+                return
+            future = None
+            if result.content is not None:
+                if self.pool is not None:
+                    future = self.pool.submit(parse_page, result.content)
+                else:
+                    future = ImmediateResult(parse_page(result.content))
+            stats['pages'] += 1
+            stats['blocked_seconds'] += self.__put(output, (result, future), stop)
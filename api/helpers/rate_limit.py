@@ -0,0 +1,168 @@
+from api import constants
+
+from django.conf import settings
+import asyncio
+import redis
+import time
+
+
+_rate_limiter = None
+
+"""
+Takes one token from the shared bucket.
+Returns 0 when a token was taken, otherwise the milliseconds to wait
+before trying again (the remaining open time while the circuit is open).
+Uses the Redis server clock (needs Redis 5+), so workers on different
+machines agree on the bucket state.
+"""
+TAKE_TOKEN_SCRIPT = '''
+local circuit_ttl = redis.call('PTTL', KEYS[3])
+if circuit_ttl > 0 then
+    return circuit_ttl
+end
+local initial_rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local rate = tonumber(redis.call('GET', KEYS[2])) or initial_rate
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], 60000)
+return wait
+'''
+
+"""
+AIMD adjustment of the shared rate.
+ARGV[1] is 'increase' or 'decrease', multiplicative decreases are
+applied at most once per cooldown so a burst of concurrent failures
+halves the rate once instead of collapsing it to the minimum.
+"""
+ADJUST_RATE_SCRIPT = '''
+local initial_rate = tonumber(ARGV[2])
+local min_rate, max_rate = tonumber(ARGV[3]), tonumber(ARGV[4])
+local rate = tonumber(redis.call('GET', KEYS[1])) or initial_rate
+if ARGV[1] == 'increase' then
+    rate = math.min(max_rate, rate + tonumber(ARGV[5]))
+elseif redis.call('SET', KEYS[2], 1, 'PX', tonumber(ARGV[7]), 'NX') then
+    rate = math.max(min_rate, rate * tonumber(ARGV[6]))
+end
+redis.call('SET', KEYS[1], tostring(rate))
+return tostring(rate)
+'''
+
+
+class RegistryRateLimiter:
+    """
+    Token bucket shared by every worker through Redis, limiting how fast
+    all of them together hit the Commercial Registry.
+
+    The rate adapts to the registry (AIMD):
+        - Fast successful responses add RATE_LIMIT_INCREASE requests/sec
+        - Slow responses and errors multiply it by RATE_LIMIT_DECREASE
+    After CIRCUIT_FAILURE_THRESHOLD consecutive errors the circuit opens:
+    every worker stops fetching for CIRCUIT_OPEN_SECONDS and starts again
+    at the minimum rate.
+    """
+    BUCKET_KEY = 'lcr:ratelimit:bucket'
+    RATE_KEY = 'lcr:ratelimit:rate'
+    CIRCUIT_KEY = 'lcr:ratelimit:circuit'
+    FAILURES_KEY = 'lcr:ratelimit:failures'
+    DECREASE_COOLDOWN_KEY = 'lcr:ratelimit:decreased'
+
+    def __init__(self, client=None):
+        self.redis = client or redis.Redis.from_url(settings.CELERY_BROKER_URL)
+        self.take_token = self.redis.register_script(TAKE_TOKEN_SCRIPT)
+        self.adjust_rate = self.redis.register_script(ADJUST_RATE_SCRIPT)
+
+    def try_acquire(self):
+        """ Returns 0 when a request may be made now, otherwise seconds to wait """
+        wait = self.take_token(
+            keys=[self.BUCKET_KEY, self.RATE_KEY, self.CIRCUIT_KEY],
+            args=[constants.RATE_LIMIT_INITIAL, constants.RATE_LIMIT_BURST])
+        return wait / 1000
+
+    def acquire(self):
+        """ Blocks until a request may be made """
+        wait = self.try_acquire()
+        while wait:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    async def acquire_async(self):
+        """ Same as acquire without blocking the event loop """
+        loop = asyncio.get_running_loop()
+        wait = await loop.run_in_executor(None, self.try_acquire)
+        while wait:
+            await asyncio.sleep(wait)
+            wait = await loop.run_in_executor(None, self.try_acquire)
+
+    def record_success(self, latency):
+        """ latency: seconds the registry took to answer """
+        self.redis.delete(self.FAILURES_KEY)
+        if latency > constants.RATE_LIMIT_LATENCY_TARGET:
+            self.__adjust('decrease')
+        else:
+            self.__adjust('increase')
+
+    def record_failure(self):
+        """ Called for timeouts, connection errors and HTTP 5xx/429 responses """
+        self.__adjust('decrease')
+        failures = self.redis.incr(self.FAILURES_KEY)
+        if failures >= constants.CIRCUIT_FAILURE_THRESHOLD:
+            self.trip()
+
+    def trip(self):
+        """ Opens the circuit, fetching resumes at the minimum rate """
+        pipe = self.redis.pipeline()
+        pipe.set(self.CIRCUIT_KEY, 1, px=int(constants.CIRCUIT_OPEN_SECONDS * 1000))
+        pipe.set(self.RATE_KEY, constants.RATE_LIMIT_MIN)
+        pipe.delete(self.FAILURES_KEY)
+        pipe.execute()
+
+    def is_open(self):
+        return bool(self.redis.exists(self.CIRCUIT_KEY))
+
+    def current_rate(self):
+        rate = self.redis.get(self.RATE_KEY)
+        return float(rate) if rate is not None else float(constants.RATE_LIMIT_INITIAL)
+
+    def __adjust(self, direction):
+        self.adjust_rate(
+            keys=[self.RATE_KEY, self.DECREASE_COOLDOWN_KEY],
+            args=[direction, constants.RATE_LIMIT_INITIAL,
+                  constants.RATE_LIMIT_MIN, constants.RATE_LIMIT_MAX,
+                  constants.RATE_LIMIT_INCREASE, constants.RATE_LIMIT_DECREASE,
+                  int(constants.RATE_LIMIT_DECREASE_COOLDOWN * 1000)])
+
+
+def get_http_status(error):
+    """ HTTP status of an aiohttp or requests error response, None for other errors """
+    status = getattr(error, 'status', None)  # aiohttp
+    if status is None and getattr(error, 'response', None) is not None:
+        status = error.response.status_code  # requests
+    return status
+
+
+def is_registry_failure(error):
+    """
+    Whether a fetch error means the registry is struggling:
+    anything but an HTTP error response below 500 (other than 429)
+    """
+    status = get_http_status(error)
+    return status is None or status >= 500 or status == 429
+
+
+def get_rate_limiter():
+    """ RegistryRateLimiter of this process """
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RegistryRateLimiter()
+    return _rate_limiter
@@ -0,0 +1,218 @@
+from api.models import Company, GovernorateIdSpace, RecrawlSchedule
+from api.helpers.lcr_scrape import build_cr_id, split_cr_id
+from api import constants
+
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+import math
+import redis
+
+
+_recrawl_budget = None
+
+
+def get_priority(company_status, registration_date, checks, changes, now):
+    """
+    Value of checking a company again, 0 to 1: the mean of
+        - its observed change rate, (changes + 1) / (checks + 2) so a
+          company never checked again counts 0.5
+        - how recently it registered, 1 for a new company halving every
+          RECRAWL_AGE_HALF_LIFE years
+    weighted by RECRAWL_STATUS_WEIGHTS (struck off companies hardly change)
+    """
+    weight = constants.RECRAWL_STATUS_WEIGHTS.get(
+        company_status, constants.RECRAWL_DEFAULT_STATUS_WEIGHT)
+    age = max((now - registration_date).days / 365.25, 0) if registration_date else 0
+    recency = 0.5 ** (age / constants.RECRAWL_AGE_HALF_LIFE)
+    change_rate = (changes + 1) / (checks + 2)
+    return weight * (recency + change_rate) / 2
+
+
+def get_recrawl_interval(priority):
+    """ RECRAWL_MIN_INTERVAL for priority 1, longer as it drops, up to RECRAWL_MAX_INTERVAL """
+    return timedelta(seconds=min(constants.RECRAWL_MIN_INTERVAL / max(priority, 1e-6),
+                                 constants.RECRAWL_MAX_INTERVAL))
+
+
+def schedule_checks(checks, refresh=True, now=None):
+    """
+    Schedules the next check of scraped companies
+        - checks: {cr_id: whether the page changed}
+        - refresh: whether changed compares with the stored page; a
+          company first seen, or scraped without refresh, only gets its
+          next check without counting one
+    Returns how many companies were scheduled
+    """
+    if not checks:
+        return 0
+    now = now or timezone.now()
+    companies = Company.objects.filter(cr_id__in=list(checks)).values_list(
+        'cr_id', 'company_status', 'registration_date')
+    schedules = RecrawlSchedule.objects.in_bulk(list(checks), field_name='cr_id')
+    created, updated = [], []
+    for cr_id, company_status, registration_date in companies:
+        schedule = schedules.get(cr_id)
+        if schedule is None:
+            schedule = RecrawlSchedule(cr_id=cr_id)
+            created.append(schedule)
+        else:
+            if refresh:
+                schedule.checks += 1
+                schedule.changes += bool(checks[cr_id])
+            updated.append(schedule)
+        schedule.priority = get_priority(
+            company_status, registration_date, schedule.checks, schedule.changes, now)
+        schedule.checked_at = now
+        schedule.next_check_at = now + get_recrawl_interval(schedule.priority)
+    RecrawlSchedule.objects.bulk_create(created, ignore_conflicts=True)
+    RecrawlSchedule.objects.bulk_update(
+        updated, ['priority', 'checks', 'changes', 'checked_at', 'next_check_at'])
+    return len(created) + len(updated)
+
+
+def reschedule_companies(batch_size=constants.RECRAWL_BATCH_SIZE):
+    """
+    Recomputes the priority and next check of every company (after tuning
+    the weights), adding the companies scraped before they were scheduled.
+    A company is next checked its interval after it was last checked
+    (or updated, when never).
+    Returns how many companies were scheduled
+    """
+    now = timezone.now()
+    scheduled = 0
+    companies = Company.objects.order_by('id').values_list(
+        'id', 'cr_id', 'company_status', 'registration_date', 'updated_at')
+    last_id = 0
+    while True:
+        batch = list(companies.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return scheduled
+        last_id = batch[-1][0]
+        schedules = RecrawlSchedule.objects.in_bulk(
+            [row[1] for row in batch], field_name='cr_id')
+        created, updated = [], []
+        for _, cr_id, company_status, registration_date, updated_at in batch:
+            schedule = schedules.get(cr_id)
+            if schedule is None:
+                schedule = RecrawlSchedule(cr_id=cr_id, checked_at=updated_at)
+                created.append(schedule)
+            else:
+                updated.append(schedule)
+            schedule.priority = get_priority(
+                company_status, registration_date, schedule.checks, schedule.changes, now)
+            schedule.next_check_at = ((schedule.checked_at or updated_at)
+                                      + get_recrawl_interval(schedule.priority))
+        with transaction.atomic():
+            RecrawlSchedule.objects.bulk_create(created, ignore_conflicts=True)
+            RecrawlSchedule.objects.bulk_update(updated, ['priority', 'next_check_at'])
+        scheduled += len(batch)
+
+
+def get_known_ends():
+    """ {governorate: largest cr_sub_id known to exist}, scraped or probed """
+    ends = dict.fromkeys(Company.Governorate.values, 0)
+    for gov, max_cr_sub_id in Company.objects.values_list('governorate').annotate(
+            Max('cr_sub_id')):
+        ends[gov] = max_cr_sub_id
+    for gov, max_cr_sub_id in GovernorateIdSpace.objects.values_list(
+            'governorate', 'max_cr_sub_id'):
+        ends[gov] = max(ends.get(gov, 0), max_cr_sub_id)
+    return ends
+
+
+def claim_due(limit, now=None):
+    """
+    cr_ids of the limit due companies of highest priority. They are not
+    due again before RECRAWL_CLAIM_TIMEOUT seconds, by when their check
+    scheduled the next one unless it failed.
+    """
+    if limit <= 0:
+        return []
+    now = now or timezone.now()
+    with transaction.atomic():
+        due = list(RecrawlSchedule.objects.select_for_update(skip_locked=True).filter(
+            next_check_at__lte=now
+        ).order_by('-priority', 'next_check_at').values_list('id', 'cr_id')[:limit])
+        RecrawlSchedule.objects.filter(id__in=[schedule_id for schedule_id, _ in due]).update(
+            next_check_at=now + timedelta(seconds=constants.RECRAWL_CLAIM_TIMEOUT))
+    return [cr_id for _, cr_id in due]
+
+
+def plan_recrawl(budget=None):
+    """
+    Takes this pass's share of the daily budget (see RecrawlBudget) and
+    spends it, highest value first:
+        - RECRAWL_NEW_IDS ids past the known end of each governorate, where
+          new registrations appear
+        - due companies by priority
+    Returns {governorate: [cr_sub_id, ...]} to scrape, the unspent share
+    is given back to the budget
+    """
+    budget = budget or get_recrawl_budget()
+    granted = budget.take(math.ceil(
+        constants.RECRAWL_DAILY_BUDGET * constants.RECRAWL_INTERVAL / (24 * 60 * 60)))
+    ids = defaultdict(list)
+    planned = 0
+    for gov, end in get_known_ends().items():
+        new_ids = range(end + 1, end + 1 + constants.RECRAWL_NEW_IDS)[:granted - planned]
+        ids[gov].extend(new_ids)
+        planned += len(new_ids)
+    for cr_id in claim_due(granted - planned):
+        gov, cr_sub_id = split_cr_id(cr_id)
+        ids[gov].append(cr_sub_id)
+        planned += 1
+    budget.give_back(granted - planned)
+    return {gov: cr_sub_ids for gov, cr_sub_ids in ids.items() if cr_sub_ids}
+
+
+class RecrawlBudget:
+    """
+    Registry requests left for recrawls today (UTC), RECRAWL_DAILY_BUDGET
+    a day shared by every worker through Redis, so concurrent or late
+    recrawl passes never spend more than the day's budget
+    """
+    KEY = 'lcr:recrawl:spent'
+
+    def __init__(self, client=None):
+        self.redis = client or redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+    def key(self):
+        return f'{self.KEY}:{timezone.now():%Y-%m-%d}'
+
+    def spent(self):
+        return int(self.redis.get(self.key()) or 0)
+
+    def take(self, requests):
+        """ Takes up to requests from today's budget, returns how many it got """
+        key = self.key()
+        pipe = self.redis.pipeline()
+        pipe.incrby(key, requests)
+        pipe.expire(key, 2 * 24 * 60 * 60)
+        spent, _ = pipe.execute()
+        over = min(max(spent - constants.RECRAWL_DAILY_BUDGET, 0), requests)
+        if over:
+            self.redis.decrby(key, over)
+        return requests - over
+
+    def give_back(self, requests):
+        if requests > 0:
+            self.redis.decrby(self.key(), requests)
+
+
+def get_recrawl_budget():
+    """ RecrawlBudget of this process """
+    global _recrawl_budget
+    if _recrawl_budget is None:
+        _recrawl_budget = RecrawlBudget()
+    return _recrawl_budget
+
+
+def get_recrawl_fingerprints(gov, cr_sub_ids):
+    """ {cr_sub_id: fingerprint} of the stored companies among cr_sub_ids """
+    cr_ids = [build_cr_id(gov, cr_sub_id) for cr_sub_id in cr_sub_ids]
+    return dict(Company.objects.filter(cr_id__in=cr_ids).values_list(
+        'cr_sub_id', 'fingerprint'))
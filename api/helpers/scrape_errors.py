@@ -0,0 +1,67 @@
+from api.models import ScrapeError
+from api.helpers.lcr_parse import EmptyPageError
+from api.helpers.rate_limit import get_http_status
+from api import constants
+
+from datetime import timedelta
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+import aiohttp
+import asyncio
+import requests
+
+
+def classify_error(error):
+    """ ScrapeError.ErrorClass of an exception raised while scraping """
+    ErrorClass = ScrapeError.ErrorClass
+    if isinstance(error, EmptyPageError):
+        return ErrorClass.EMPTY
+    if isinstance(error, (asyncio.TimeoutError, requests.Timeout)):
+        return ErrorClass.TIMEOUT
+    status = get_http_status(error)
+    if status is not None:
+        return ErrorClass.SERVER if status >= 500 else ErrorClass.HTTP
+    if isinstance(error, (aiohttp.ClientError, requests.RequestException, OSError)):
+        return ErrorClass.NETWORK
+    if isinstance(error, DatabaseError):
+        return ErrorClass.DATABASE
+    return ErrorClass.PARSE
+
+
+def get_retry_delay(error_class, attempts):
+    """
+    Exponential backoff: RETRY_BASE_DELAY doubled for every earlier attempt,
+    capped at RETRY_MAX_DELAY. Empty records start from EMPTY_RETRY_DELAY,
+    a registration may take its id later on.
+    """
+    base = (constants.EMPTY_RETRY_DELAY if error_class == ScrapeError.ErrorClass.EMPTY
+            else constants.RETRY_BASE_DELAY)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1),
+                                 constants.RETRY_MAX_DELAY))
+
+
+def record_scrape_error(cr_id, model_type, error):
+    """
+    Creates the ScrapeError of a cr_id, or counts one more attempt on it
+    Schedules the next retry, none once RETRY_MAX_ATTEMPTS is reached
+    """
+    error_class = classify_error(error)
+    with transaction.atomic():
+        scrape_error, created = ScrapeError.objects.select_for_update().get_or_create(
+            cr_id=cr_id, defaults={'attempts': 0})
+        scrape_error.attempts += 1
+        scrape_error.model_type = model_type
+        scrape_error.error_class = error_class
+        scrape_error.error_message = str(error) or type(error).__name__
+        if scrape_error.attempts < constants.RETRY_MAX_ATTEMPTS:
+            scrape_error.next_retry_at = timezone.now() + get_retry_delay(
+                error_class, scrape_error.attempts)
+        else:
+            scrape_error.next_retry_at = None
+        scrape_error.save()
+    return scrape_error
+
+
+def clear_scrape_errors(cr_ids):
+    """ Deletes the ScrapeErrors of successfully scraped cr_ids """
+    ScrapeError.objects.filter(cr_id__in=list(cr_ids)).delete()
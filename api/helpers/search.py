@@ -0,0 +1,151 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import (ExpressionWrapper, F, FloatField, Func, Q,
+                              TextField, Value)
+from django.db.models.functions import Greatest
+from django.db.models.lookups import PostgresOperatorLookup
+import re
+import unicodedata
+
+
+"""
+Arabic normalization
+    - Diacritics (tashkeel) and tatweel are dropped
+    - Letter variants are folded: alef with hamza or madda to bare alef,
+      alef maqsura to ya, ta marbuta to ha, hamza on waw/ya to waw/ya
+The same folding is done in SQL by api_normalize_text (migration 0014)
+for the descriptions, keep both in sync (see SearchNormalizationTests).
+"""
+ARABIC_DIACRITICS = re.compile('[\u064b-\u065f\u0670\u0640]')
+ARABIC_VARIANTS = str.maketrans('أإآٱىةؤئ', 'اااايهوي')
+ARABIC_DIGITS = str.maketrans('٠١٢٣٤٥٦٧٨٩', '0123456789')
+NON_WORD = re.compile(r'[^\w]+')
+
+"""
+Latin transliteration of normalized Arabic letters.
+Short vowels are not written in Arabic, so names are compared on
+their consonant skeleton (see latin_skeleton).
+"""
+ARABIC_TO_LATIN = {
+    'ا': 'a', 'ب': 'b', 'ت': 't', 'ث': 'th', 'ج': 'j', 'ح': 'h', 'خ': 'kh',
+    'د': 'd', 'ذ': 'dh', 'ر': 'r', 'ز': 'z', 'س': 's', 'ش': 'sh', 'ص': 's',
+    'ض': 'd', 'ط': 't', 'ظ': 'z', 'ع': '', 'غ': 'gh', 'ف': 'f', 'ق': 'q',
+    'ك': 'k', 'ل': 'l', 'م': 'm', 'ن': 'n', 'ه': 'h', 'و': 'w', 'ي': 'y',
+    'ء': '',
+}
+LATIN_SOUNDS = (
+    (re.compile(r'ph'), 'f'),
+    (re.compile(r'ch'), 'sh'),
+    (re.compile(r'ck|[cq]'), 'k'),
+    (re.compile(r'g(?!h)'), 'j'),
+    (re.compile(r'x'), 'ks'),
+    (re.compile(r'p'), 'b'),
+    (re.compile(r'v'), 'f'),
+    (re.compile(r'[aeiouwy]'), ''),
+    (re.compile(r'(.)\1+'), r'\1'),
+)
+
+
+def normalize_text(text):
+    """
+    Lowercased text with Arabic letter variants folded, diacritics
+    (Arabic and Latin) dropped and punctuation replaced by spaces
+    """
+    text = unicodedata.normalize('NFKC', text or '')
+    text = ARABIC_DIACRITICS.sub('', text).translate(ARABIC_VARIANTS)
+    text = ''.join(char for char in unicodedata.normalize('NFKD', text)
+                   if not unicodedata.combining(char))
+    text = text.translate(ARABIC_DIGITS).lower()
+    return ' '.join(NON_WORD.sub(' ', text).replace('_', ' ').split())
+
+
+def latin_skeleton(word):
+    """
+    Consonant skeleton of a normalized word, in Latin letters:
+    'خوري', 'khoury' and 'khouri' all give 'khr'
+    """
+    word = ''.join(ARABIC_TO_LATIN.get(char, char) for char in word)
+    for pattern, replacement in LATIN_SOUNDS:
+        word = pattern.sub(replacement, word)
+    return word
+
+
+def search_key(*values):
+    """
+    Searchable form of names: their normalized words followed by the
+    skeletons of those words, stored in the search_name columns
+    """
+    words = normalize_text(' '.join(values)).split()
+    skeletons = [latin_skeleton(word) for word in words]
+    return ' '.join(dict.fromkeys(words + [skeleton for skeleton in skeletons
+                                           if skeleton and skeleton not in words]))
+
+
+class TrigramWordSimilar(PostgresOperatorLookup):
+    """
+    field %> query: some extent of the field is trigram-similar to the
+    query (pg_trgm word similarity), served by gin_trgm_ops indexes
+    """
+    lookup_name = 'trigram_word_similar'
+    postgres_operator = '%%>'
+
+
+TextField.register_lookup(TrigramWordSimilar)
+
+
+class WordSimilarity(Func):
+    function = 'WORD_SIMILARITY'
+    output_field = FloatField()
+
+
+def get_search_terms(query):
+    """ Normalized query and its Latin skeleton ('' when same as the query) """
+    normalized = normalize_text(query)
+    skeleton = ' '.join(latin_skeleton(word) for word in normalized.split())
+    return normalized, (skeleton if skeleton != normalized else '')
+
+
+def name_condition(normalized, skeleton):
+    """ search_name word-similar to the normalized query or its skeleton """
+    condition = Q(search_name__trigram_word_similar=normalized)
+    if skeleton:
+        condition |= Q(search_name__trigram_word_similar=skeleton)
+    return condition
+
+
+def name_similarity(normalized, skeleton):
+    similarity = WordSimilarity(Value(normalized), F('search_name'))
+    if skeleton:
+        similarity = Greatest(
+            similarity, WordSimilarity(Value(skeleton), F('search_name')),
+            output_field=FloatField())
+    return similarity
+
+
+def search_companies(queryset, query):
+    """
+    Companies matching a query, best first
+        - Fuzzy match on name and additional name (search_name trigrams)
+        - Full-text match on name, additional name and description
+          (search_vector, names weigh more)
+    """
+    normalized, skeleton = get_search_terms(query)
+    if not normalized:
+        return queryset.none()
+    text_query = SearchQuery(normalized, config='simple')
+    return queryset.filter(
+        name_condition(normalized, skeleton) | Q(search_vector=text_query)
+    ).annotate(rank=ExpressionWrapper(
+        SearchRank(F('search_vector'), text_query)
+        + name_similarity(normalized, skeleton),
+        output_field=FloatField()
+    )).order_by('-rank', 'id')
+
+
+def search_persons(queryset, query):
+    """ People whose name matches a query, most similar first """
+    normalized, skeleton = get_search_terms(query)
+    if not normalized:
+        return queryset.none()
+    return queryset.filter(name_condition(normalized, skeleton)).annotate(
+        rank=name_similarity(normalized, skeleton)
+    ).order_by('-rank', 'id')
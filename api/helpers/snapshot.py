@@ -0,0 +1,361 @@
+from api.models import Company, Person
+from api.helpers.locks import try_file_lock
+from api import constants
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import json
+import numpy as np
+import os
+import shutil
+import uuid
+
+
+_snapshot = None
+
+"""
+Columns of the snapshot, one .npy file each: (file, dtype).
+Categorical text columns are stored as int32 codes into the sorted
+labels kept in meta.json, dates as days since 1970-01-01.
+DERIVED_COLUMNS are computed from them once, when the snapshot is built.
+"""
+COMPANY_COLUMNS = (
+    ('company_id', np.int64),
+    ('governorate', np.int8),
+    ('legal_form', np.int32),
+    ('company_status', np.int32),
+    ('registration_date', 'datetime64[D]'),
+    ('capital', np.float64),
+    ('missing_personnel_data', np.bool_),
+)
+PERSON_COLUMNS = (
+    ('person_id', np.int64),
+    ('person_company', np.int32),  # Row of the person's company in the company columns
+    ('individual_id', np.int64),  # -1 until resolved
+    ('nationality', np.int32),
+    ('stock', np.int64),
+    ('quota', np.int64),
+    ('ratio', np.int64),
+)
+CATEGORIES = ('legal_form', 'company_status', 'nationality')
+DERIVED_COLUMNS = (
+    ('registration_year', np.int16),
+    ('registration_month', np.int32),  # Months since 1970-01
+    ('capital_magnitude', np.int8),  # floor(log10(capital)), 0 below 10
+)
+
+"""
+Columns queries can filter and group by. Company columns apply to people
+through their company.
+"""
+GROUP_COLUMNS = ('governorate', 'legal_form', 'company_status', 'registration_year',
+                 'registration_month', 'capital_magnitude', 'missing_personnel_data')
+PERSON_GROUP_COLUMNS = ('nationality',)
+COMPANY_VALUES = ('capital',)
+PERSON_VALUES = ('stock', 'quota', 'ratio')
+AGGREGATES = ('sum', 'mean', 'min', 'max')
+
+
+class SnapshotQueryError(ValueError):
+    """ Unknown column or aggregate in a snapshot query """
+
+
+class Snapshot:
+    """
+    Columnar copy of every company and person, memory-mapped: queries
+    read the pages of the columns they use, never the database.
+    Queries run on whole columns with NumPy (boolean masks to filter,
+    bincount to group), so they allocate a few arrays, not one object
+    per row.
+    Filters are keyword arguments:
+        - a group column (see GROUP_COLUMNS) and the label to keep,
+          e.g. governorate=1, legal_form='شركة محدودة المسؤولية'
+        - registered_from, registered_to: dates, the second one excluded
+        - capital_min, capital_max: capital_min <= capital < capital_max
+    """
+
+    def __init__(self, root=None):
+        self.root = os.path.realpath(
+            root or os.path.join(settings.SNAPSHOT_DIR, 'current'))
+        with open(os.path.join(self.root, 'meta.json')) as meta:
+            self.meta = json.load(meta)
+        for name, dtype in COMPANY_COLUMNS + PERSON_COLUMNS + DERIVED_COLUMNS:
+            setattr(self, name, np.load(os.path.join(self.root, f'{name}.npy'),
+                                        mmap_mode='r'))
+        self.built_at = parse_datetime(self.meta['built_at'])
+        self.categories = self.meta['categories']
+
+    # Columns
+
+    def group_column(self, name, persons=False):
+        """ (codes, labels): the label of row n is labels[codes[n]] """
+        if persons and name in PERSON_GROUP_COLUMNS:
+            return self.nationality, self.categories[name]
+        if name not in GROUP_COLUMNS:
+            raise SnapshotQueryError(f'Cannot group by {name}')
+        codes, labels = self.__company_group_column(name)
+        return (codes[self.person_company] if persons else codes), labels
+
+    def __company_group_column(self, name):
+        if name in CATEGORIES:
+            return getattr(self, name), self.categories[name]
+        if name == 'governorate':
+            return self.governorate, list(range(int(self.governorate.max(initial=0)) + 1))
+        if name == 'missing_personnel_data':
+            return self.missing_personnel_data.view(np.int8), [False, True]
+        if name == 'capital_magnitude':
+            return self.capital_magnitude, list(range(int(self.capital_magnitude.max(initial=0)) + 1))
+        periods = getattr(self, name)
+        first = int(periods.min(initial=0))
+        labels = range(first, int(periods.max(initial=0)) + 1)
+        if name == 'registration_month':
+            labels = [str(np.datetime64(month, 'M')) for month in labels]
+        return periods - first, list(labels)
+
+    def value_column(self, name, persons=False):
+        if persons and name in PERSON_VALUES:
+            return getattr(self, name)
+        if name not in COMPANY_VALUES:
+            raise SnapshotQueryError(f'Cannot aggregate {name}')
+        return self.capital[self.person_company] if persons else self.capital
+
+    # Queries
+
+    def mask(self, persons=False, **filters):
+        """ Boolean array of the companies (or people) matching the filters """
+        size = len(self.person_id if persons else self.company_id)
+        mask = np.ones(size, dtype=bool)
+        dates = self.registration_date
+        capital = self.capital
+        if persons and set(filters) & {'registered_from', 'registered_to',
+                                       'capital_min', 'capital_max'}:
+            dates = dates[self.person_company]
+            capital = capital[self.person_company]
+        for name, value in filters.items():
+            if value is None:
+                continue
+            if name == 'registered_from':
+                mask &= dates >= np.datetime64(value, 'D')
+            elif name == 'registered_to':
+                mask &= dates < np.datetime64(value, 'D')
+            elif name == 'capital_min':
+                mask &= capital >= float(value)
+            elif name == 'capital_max':
+                mask &= capital < float(value)
+            else:
+                codes, labels = self.group_column(name, persons)
+                code = {str(label): code for code, label in enumerate(labels)}.get(str(value))
+                if code is None:
+                    mask[:] = False
+                else:
+                    mask &= codes == code
+        return mask
+
+    def aggregate(self, by=(), value=None, aggregate='sum', persons=False,
+                  order_by_count=True, **filters):
+        """
+        Groups the companies (or people) matching the filters by the `by`
+        columns: [{column: label..., 'count': rows, '<aggregate>_<value>':
+        aggregated value}], empty groups left out. Groups come largest
+        first, or in label order without order_by_count (for histograms).
+        """
+        if aggregate not in AGGREGATES:
+            raise SnapshotQueryError(f'Unknown aggregate {aggregate}')
+        mask = self.mask(persons, **filters)
+        columns = [self.group_column(name, persons) for name in by]
+        sizes = [max(len(labels), 1) for codes, labels in columns]
+        groups = int(np.prod(sizes))
+        if columns:
+            keys = np.ravel_multi_index([codes[mask] for codes, labels in columns], sizes)
+        else:
+            keys = np.zeros(int(mask.sum()), dtype=np.int64)
+        counts = np.bincount(keys, minlength=groups)
+        present = np.flatnonzero(counts)
+        results = None
+        if value is not None:
+            values = self.value_column(value, persons)[mask].astype(np.float64)
+            if aggregate in ('sum', 'mean'):
+                results = np.bincount(keys, weights=values, minlength=groups)
+                if aggregate == 'mean':
+                    results[present] /= counts[present]
+            else:
+                extreme = np.maximum if aggregate == 'max' else np.minimum
+                results = np.full(groups, -np.inf if aggregate == 'max' else np.inf)
+                extreme.at(results, keys, values)
+        if order_by_count:
+            present = present[np.argsort(-counts[present], kind='stable')]
+        rows = []
+        positions = zip(*np.unravel_index(present, sizes)) if columns else [()] * len(present)
+        for key, indices in zip(present, positions):
+            row = {name: labels[index] for name, (codes, labels), index
+                   in zip(by, columns, indices)}
+            row['count'] = int(counts[key])
+            if results is not None:
+                row[f'{aggregate}_{value}'] = float(results[key])
+            rows.append(row)
+        return rows
+
+    def top(self, value, limit=constants.SNAPSHOT_TOP_LIMIT, by_individual=False, **filters):
+        """
+        The people (or resolved individuals, summing over their companies)
+        with the largest value among those matching the filters:
+        [{'person_id' or 'individual_id', 'company_id' or 'companies', value}]
+        """
+        values = self.value_column(value, persons=True)
+        if by_individual:
+            mask = self.mask(True, **filters) & (self.individual_id >= 0)
+            # Individual ids are dense database ids, bincount beats sorting them
+            individuals = self.individual_id[mask]
+            totals = np.bincount(individuals, weights=values[mask].astype(np.float64))
+            companies = np.bincount(individuals, minlength=len(totals))
+            best = self.__largest(totals, limit)
+            return [{'individual_id': int(index),
+                     'companies': int(companies[index]),
+                     value: float(totals[index])} for index in best if companies[index]]
+        if filters:
+            rows = np.flatnonzero(self.mask(True, **filters))
+            best = rows[self.__largest(values[rows], limit)]
+        else:
+            best = self.__largest(values, limit)
+        return [{'person_id': int(self.person_id[row]),
+                 'company_id': int(self.company_id[self.person_company[row]]),
+                 value: int(values[row])} for row in best]
+
+    @staticmethod
+    def __largest(values, limit):
+        """ Positions of the `limit` largest values, largest first """
+        if len(values) > limit:
+            candidates = np.argpartition(values, len(values) - limit)[-limit:]
+        else:
+            candidates = np.arange(len(values))
+        return candidates[np.argsort(-values[candidates], kind='stable')]
+
+
+class ColumnBuilder:
+    """ Accumulates rows in chunks of NumPy arrays, coding categorical values """
+
+    def __init__(self, columns, categories):
+        self.columns = columns
+        self.categories = categories  # {column: {label: code}}, shared between builders
+        self.chunks = {name: [] for name, dtype in columns}
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) == constants.SNAPSHOT_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        for index, (name, dtype) in enumerate(self.columns):
+            values = [row[index] for row in self.rows]
+            if name in self.categories:
+                codes = self.categories[name]
+                values = [codes.setdefault(value, len(codes)) for value in values]
+            self.chunks[name].append(np.array(values, dtype=dtype))
+        self.rows = []
+
+    def arrays(self):
+        self.flush()
+        return {name: np.concatenate(self.chunks[name]) for name, dtype in self.columns}
+
+
+def read_columns(chunk_size=constants.SNAPSHOT_CHUNK_SIZE):
+    """
+    Column arrays of every company and person, read through server-side
+    cursors in one REPEATABLE READ transaction (on PostgreSQL), so people
+    and companies are consistent; categorical codes are sorted by label.
+    Inside a transaction already, its isolation level is kept.
+    """
+    categories = {name: {} for name in CATEGORIES}
+    companies = ColumnBuilder(COMPANY_COLUMNS, categories)
+    persons = ColumnBuilder(PERSON_COLUMNS, categories)
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if connection.vendor == 'postgresql' and outermost:
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        for row in Company.objects.order_by('id').values_list(
+                'id', 'governorate', 'legal_form', 'company_status', 'registration_date',
+                'capital', 'missing_personnel_data').iterator(chunk_size=chunk_size):
+            registration_date = row[4].astimezone(timezone.utc).date()
+            companies.add(row[:4] + (registration_date, float(row[5]), row[6]))
+        for row in Person.objects.order_by('id').values_list(
+                'id', 'company_id', 'individual_id', 'nationality', 'stock', 'quota',
+                'ratio').iterator(chunk_size=chunk_size):
+            persons.add((row[0], row[1], -1 if row[2] is None else row[2]) + row[3:])
+    arrays = dict(companies.arrays(), **persons.arrays())
+    arrays['person_company'] = np.searchsorted(
+        arrays['company_id'], arrays['person_company']).astype(np.int32)
+
+    labels = {}
+    for name, codes in categories.items():
+        ordered = sorted(codes)
+        labels[name] = ordered
+        recode = np.zeros(len(codes), dtype=np.int32)
+        recode[[codes[label] for label in ordered]] = np.arange(len(ordered))
+        arrays[name] = recode[arrays[name]] if len(codes) else arrays[name]
+    return arrays, labels
+
+
+def write_snapshot(arrays, labels, built_at, root=None):
+    """
+    Adds the DERIVED_COLUMNS to the columns of read_columns, writes them
+    to a new directory, then swaps it in as current
+    so readers never see a partial snapshot
+    """
+    root = root or settings.SNAPSHOT_DIR
+    dates = arrays['registration_date']
+    arrays['registration_year'] = (dates.astype('datetime64[Y]').astype(np.int64)
+                                   + 1970).astype(np.int16)
+    arrays['registration_month'] = dates.astype('datetime64[M]').astype(np.int32)
+    arrays['capital_magnitude'] = np.floor(
+        np.log10(np.maximum(arrays['capital'], 1))).astype(np.int8)
+    directory = os.path.join(root, f'build-{uuid.uuid4().hex}')
+    os.makedirs(directory)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f'{name}.npy'), array)
+    with open(os.path.join(directory, 'meta.json'), 'w') as meta:
+        json.dump({
+            'built_at': built_at.isoformat(),
+            'companies': len(arrays['company_id']),
+            'persons': len(arrays['person_id']),
+            'categories': labels,
+        }, meta, ensure_ascii=False)
+
+    current = os.path.join(root, 'current')
+    link = os.path.join(root, f'link-{uuid.uuid4().hex}')
+    previous = os.path.realpath(current) if os.path.islink(current) else None
+    os.symlink(directory, link)
+    os.replace(link, current)
+    if previous and previous != directory:
+        shutil.rmtree(previous, ignore_errors=True)
+    return Snapshot(current)
+
+
+def build_snapshot(root=None):
+    """
+    Snapshots the database, returns the new Snapshot, None when another
+    build is running. The snapshot is local to the machine, processes
+    sharing its disk take turns through a file lock.
+    """
+    root = root or settings.SNAPSHOT_DIR
+    with try_file_lock(os.path.join(root, '.lock')) as acquired:
+        if acquired:
+            built_at = timezone.now()
+            return write_snapshot(*read_columns(), built_at, root)
+
+
+def get_snapshot():
+    """
+    Snapshot of this process, reopened when a newer snapshot was swapped
+    in, None when no snapshot was built yet
+    """
+    global _snapshot
+    current = os.path.join(settings.SNAPSHOT_DIR, 'current')
+    if not os.path.exists(current):
+        return None
+    if _snapshot is None or _snapshot.root != os.path.realpath(current):
+        _snapshot = Snapshot(current)
+    return _snapshot
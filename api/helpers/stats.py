@@ -0,0 +1,122 @@
+from api.models import CapitalStats, CompanyStats, NationalityStats
+
+from django.db import connection, transaction
+from django.db.models import Sum
+
+
+"""
+Statistics computed from scratch, with the same groups as the triggers
+of migration 0011 that keep them up to date (keep both in sync):
+(model, group columns, value columns, query)
+"""
+STATS_TABLES = (
+    (CompanyStats,
+     ('governorate', 'legal_form', 'company_status', 'registration_year'),
+     ('companies', 'capital'),
+     """
+     SELECT governorate, legal_form, company_status,
+            EXTRACT(YEAR FROM registration_date AT TIME ZONE 'UTC')::integer,
+            COUNT(*), SUM(capital)
+     FROM api_company
+     GROUP BY 1, 2, 3, 4
+     """),
+    (CapitalStats,
+     ('governorate', 'capital_magnitude'),
+     ('companies',),
+     """
+     SELECT governorate, floor(log(greatest(capital, 1)))::integer, COUNT(*)
+     FROM api_company
+     GROUP BY 1, 2
+     """),
+    (NationalityStats,
+     ('governorate', 'nationality'),
+     ('persons',),
+     """
+     SELECT company.governorate, person.nationality, COUNT(*)
+     FROM api_person person JOIN api_company company ON company.id = person.company_id
+     GROUP BY 1, 2
+     """),
+)
+
+
+def lock_stats(cursor, mode):
+    """
+    Writers update the statistics in the statement that changes companies
+    or people, so once the statistics are locked every committed change
+    is in them and no other one can be
+    """
+    tables = ', '.join(model._meta.db_table for model, *_ in STATS_TABLES)
+    cursor.execute(f'LOCK TABLE {tables} IN {mode} MODE')
+
+
+def rebuild_stats():
+    """ Recomputes every statistics table, returns {model name: rows} """
+    rows = {}
+    with transaction.atomic(), connection.cursor() as cursor:
+        lock_stats(cursor, 'EXCLUSIVE')
+        for model, groups, values, query in STATS_TABLES:
+            table = model._meta.db_table
+            cursor.execute(f'DELETE FROM {table}')
+            cursor.execute(f'INSERT INTO {table} ({", ".join(groups + values)}) {query}')
+            rows[model.__name__] = cursor.rowcount
+    return rows
+
+
+def check_stats():
+    """
+    Compares the statistics tables with the statistics computed from
+    scratch, returns [(model name, group, stored values, computed values)]
+    of the groups that differ (nothing when they are consistent)
+    """
+    differences = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        lock_stats(cursor, 'SHARE')
+        for model, groups, values, query in STATS_TABLES:
+            cursor.execute(query)
+            computed = {tuple(row[:len(groups)]): tuple(row[len(groups):])
+                        for row in cursor.fetchall()}
+            stored = {tuple(row[:len(groups)]): tuple(row[len(groups):])
+                      for row in model.objects.exclude(**{values[0]: 0}).values_list(
+                          *groups, *values)}
+            for group in sorted(computed.keys() | stored.keys(), key=str):
+                if computed.get(group) != stored.get(group):
+                    differences.append((model.__name__, group, stored.get(group),
+                                        computed.get(group)))
+    return differences
+
+
+def summarize_stats(governorate=None, legal_form=None, company_status=None):
+    """
+    Totals and breakdowns of the companies matching the filters, and the
+    nationalities of their personnel (filtered by governorate only).
+    Reads the statistics tables, a few thousand rows, never Company.
+    """
+    filters = {field: value for field, value in (
+        ('governorate', governorate), ('legal_form', legal_form),
+        ('company_status', company_status)) if value is not None}
+    companies = CompanyStats.objects.filter(companies__gt=0, **filters)
+
+    def breakdown(field):
+        return list(companies.values(field).annotate(
+            companies=Sum('companies'), capital=Sum('capital')).order_by('-companies', field))
+
+    totals = companies.aggregate(companies=Sum('companies'), capital=Sum('capital'))
+    summary = {
+        'companies': totals['companies'] or 0,
+        'capital': totals['capital'] or 0,
+        'by_governorate': breakdown('governorate'),
+        'by_legal_form': breakdown('legal_form'),
+        'by_status': breakdown('company_status'),
+        'by_registration_year': list(companies.values('registration_year').annotate(
+            companies=Sum('companies'), capital=Sum('capital')).order_by('registration_year')),
+    }
+    governorate_filter = {'governorate': governorate} if governorate is not None else {}
+    if legal_form is None and company_status is None:
+        summary['capital_distribution'] = list(
+            CapitalStats.objects.filter(companies__gt=0, **governorate_filter).values(
+                'capital_magnitude').annotate(companies=Sum('companies')).order_by(
+                'capital_magnitude'))
+    summary['nationalities'] = list(
+        NationalityStats.objects.filter(persons__gt=0, **governorate_filter).values(
+            'nationality').annotate(persons=Sum('persons')).order_by('-persons', 'nationality'))
+    return summary
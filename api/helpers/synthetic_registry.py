@@ -0,0 +1,227 @@
+from api.helpers.lcr_scrape import split_cr_id
+from api import constants
+
+from aiohttp import web
+from html import escape
+import asyncio
+import random
+
+
+"""
+Words synthetic pages are made of. Person names are drawn from
+FIRST_NAMES x FIRST_NAMES x LAST_NAMES, so the same people show up in
+many companies (with or without their middle name), like on the registry.
+"""
+FIRST_NAMES = (
+    'محمد', 'علي', 'حسن', 'حسين', 'أحمد', 'خليل', 'إبراهيم', 'يوسف', 'جورج',
+    'إيلي', 'طوني', 'ميشال', 'جوزيف', 'بيار', 'سامي', 'نبيل', 'وليد', 'كمال',
+    'فادي', 'رامي', 'فاطمة', 'زينب', 'مريم', 'ماري', 'ريتا', 'نادين', 'رنا',
+    'ليلى', 'هدى', 'سعاد',
+)
+LAST_NAMES = (
+    'الخوري', 'حداد', 'الحسيني', 'نصر', 'عيسى', 'سعد', 'الزين', 'شمعون',
+    'فرنجية', 'عون', 'الأسعد', 'حمادة', 'بيضون', 'شهاب', 'أبو جودة', 'سلامة',
+    'الحلبي', 'قاسم', 'يونس', 'منصور', 'غانم', 'صفير', 'الصلح', 'كرم',
+    'معوض', 'طربيه', 'بستاني', 'جعجع', 'رزق', 'فياض',
+)
+NATIONALITIES = ('لبنان',) * 8 + ('سوريا', 'فرنسا', 'الولايات المتحدة')
+RELATIONSHIPS = ('مساهم', 'شريك', 'رئيس مجلس الادارة', 'عضو مجلس ادارة',
+                 'مدير', 'مفوض بالتوقيع', 'مدقق حسابات')
+COMPANY_WORDS = ('التجارة', 'الصناعة', 'الاستثمار', 'العقارات', 'البناء',
+                 'النقل', 'الخدمات', 'الاستيراد والتصدير', 'المقاولات',
+                 'السياحة', 'الصيرفة', 'التأمين', 'الاغذية', 'الادوية')
+LATIN_WORDS = ('Trading', 'Industries', 'Investment', 'Real Estate',
+               'Contracting', 'Services', 'Holding', 'Group', 'Development')
+LEGAL_FORMS = ('شركة مساهمة لبنانية', 'شركة محدودة المسؤولية', 'شركة تضامن',
+               'شركة توصية بسيطة', 'مؤسسة فردية', 'شركة اوف شور', 'شركة هولدنغ')
+STATUSES = ('قائمة',) * 6 + ('مشطوبة', 'قيد التصفية')
+RECORD_TYPES = ('اساسي',) * 5 + ('فرعي',)
+GOVERNORATE_TOWNS = {
+    1: ('بيروت - الحمرا', 'بيروت - الاشرفية', 'بيروت - فردان'),
+    2: ('جونية', 'جبيل', 'بعبدا', 'الشوف'),
+    3: ('طرابلس', 'البترون', 'زغرتا'),
+    4: ('زحلة', 'شتورا', 'بعلبك'),
+    5: ('صيدا', 'صور', 'جزين'),
+    6: ('النبطية', 'مرجعيون', 'بنت جبيل'),
+}
+
+"""
+Labels of the DataList1_Label<n>_0 spans, in page order
+"""
+COMPANY_LABELS = (
+    (1, 'رقم التسجيل'), (2, 'الاسم'), (3, 'الاسم الاضافي'),
+    (5, 'تاريخ التسجيل'), (6, 'نوع السجل'), (7, 'الوضع'), (8, 'المدة'),
+    (9, 'الشكل القانوني'), (10, 'رأس المال'), (11, 'العنوان'),
+    (12, 'موضوع الشركة'),
+)
+
+PAGE_HEADER = (
+    '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+    '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n'
+    '<html xmlns="http://www.w3.org/1999/xhtml" dir="rtl"><head>'
+    '<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />'
+    '<title>السجل التجاري</title></head><body>'
+    '<form name="form1" method="post" action="result.aspx?id={cr_id}" id="form1">'
+    '<div><input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="{viewstate}" /></div>'
+    '<div class="page"><div class="main">'
+)
+PAGE_FOOTER = '</div></div></form></body></html>\n'
+PERSONNEL_HEADER = (
+    '<table id="Relations_ListView_itemPlaceholderContainer" border="1">'
+    '<tr id="Relations_ListView_Tr1"><th>الاسم</th><th>الجنسية</th><th>الصفة</th>'
+    '<th>عدد الاسهم</th><th>الحصص</th><th>النسبة</th></tr>'
+)
+PERSONNEL_ROW = (
+    '<tr><td><span id="Relations_ListView_desigLabel_{index}">{name}</span></td>'
+    '<td><span id="Relations_ListView_countryLabel_{index}">{nationality}</span></td>'
+    '<td><span id="Relations_ListView_relLabel_{index}">{relationship}</span></td>'
+    '<td><span id="Relations_ListView_a_valLabel_{index}">{stock}</span></td>'
+    '<td><span id="Relations_ListView_s_valLabel_{index}">{quota}</span></td>'
+    '<td><span id="Relations_ListView_r_valLabel_{index}">{ratio}</span></td></tr>'
+)
+VIEWSTATE = 'dDwtMTI3OTMzNDM4NDs7Pg' * 200
+
+
+def render_page(cr_id, company, personnel):
+    """
+    Registry page of a company: {label number: value} of the DataList1
+    spans, and [person dicts] of the personnel rows (None when the
+    registry has no personnel table)
+    """
+    parts = [PAGE_HEADER.format(cr_id=cr_id, viewstate=VIEWSTATE),
+             '<table id="DataList1" cellspacing="0" border="0">']
+    for number, label in COMPANY_LABELS:
+        parts.append(f'<tr><td>{label}</td><td><span id="DataList1_Label{number}_0">'
+                     f'{escape(str(company.get(number, "")))}</span></td></tr>')
+    parts.append('</table>')
+    if personnel is not None:
+        parts.append(PERSONNEL_HEADER)
+        for index, person in enumerate(personnel):
+            parts.append(PERSONNEL_ROW.format(index=index, **{
+                field: escape(str(value)) for field, value in person.items()}))
+        parts.append('</table>')
+    parts.append(PAGE_FOOTER)
+    return ''.join(parts).encode()
+
+
+def render_empty_page(cr_id):
+    """ The registry's answer for an id without a company: every span empty """
+    return render_page(cr_id, {}, None)
+
+
+class SyntheticRegistry:
+    """
+    Deterministic stand-in for the Commercial Registry: the page of an id
+    is always the same for a given seed
+        - id_spaces: {governorate: largest cr_sub_id}, ids past it are empty
+        - missing_rate: share of ids inside the id space without a company
+        - personnel_mean, personnel_max: people per company follow a
+          Pareto law, most have a few and some have hundreds
+        - no_personnel_rate: share of companies without personnel table
+    Errors and latency are drawn per request (see make_app), so
+    retried ids can succeed.
+    """
+
+    def __init__(self, id_spaces=None, seed=0,
+                 missing_rate=constants.SYNTHETIC_MISSING_RATE,
+                 personnel_mean=constants.SYNTHETIC_PERSONNEL_MEAN,
+                 personnel_max=constants.SYNTHETIC_PERSONNEL_MAX,
+                 no_personnel_rate=constants.SYNTHETIC_NO_PERSONNEL_RATE):
+        self.id_spaces = id_spaces or {}
+        self.seed = seed
+        self.missing_rate = missing_rate
+        self.personnel_mean = personnel_mean
+        self.personnel_max = personnel_max
+        self.no_personnel_rate = no_personnel_rate
+
+    def id_space(self, gov):
+        return self.id_spaces.get(gov, constants.SYNTHETIC_ID_SPACE)
+
+    def page(self, cr_id):
+        """ Content of result.aspx?id=cr_id """
+        try:
+            gov, cr_sub_id = split_cr_id(cr_id)
+        except ValueError:
+            return render_empty_page(cr_id)
+        if (gov not in GOVERNORATE_TOWNS or not 1 <= cr_sub_id <= self.id_space(gov)):
+            return render_empty_page(cr_id)
+        rnd = random.Random(self.seed * 10 ** 10 + int(cr_id))
+        if rnd.random() < self.missing_rate:
+            return render_empty_page(cr_id)
+        personnel = None
+        if rnd.random() >= self.no_personnel_rate:
+            personnel = self.__personnel(rnd)
+        return render_page(cr_id, self.__company(rnd, gov, cr_sub_id), personnel)
+
+    def __company(self, rnd, gov, cr_sub_id):
+        legal_form = rnd.choice(LEGAL_FORMS)
+        name = f'{legal_form.split()[0]} {rnd.choice(LAST_NAMES)} {rnd.choice(COMPANY_WORDS)}'
+        registration_year = 1950 + cr_sub_id * 70 // (self.id_space(gov) + 1)
+        return {
+            1: cr_sub_id,
+            2: name,
+            3: (f'{rnd.choice(LATIN_WORDS)} {rnd.choice(LATIN_WORDS)}'
+                if rnd.random() < 0.4 else ''),
+            5: f'{rnd.randint(1, 12)}/{rnd.randint(1, 28)}/{registration_year} 12:00:00 AM',
+            6: rnd.choice(RECORD_TYPES),
+            7: rnd.choice(STATUSES),
+            8: rnd.choice(('99 سنة', '50 سنة', 'غير محددة', '')),
+            9: legal_form,
+            10: rnd.choice((1, 5, 10, 30, 100, 1000)) * 1000000,
+            11: rnd.choice(GOVERNORATE_TOWNS[gov]),
+            12: ' و'.join(rnd.sample(COMPANY_WORDS, rnd.randint(1, 3))),
+        }
+
+    def __personnel(self, rnd):
+        # Pareto(1.5) scaled to personnel_mean: P(count > 100) ~ 0.2% for a mean of 4
+        scale = self.personnel_mean / 3
+        count = min(self.personnel_max, max(1, int(scale * rnd.paretovariate(1.5))))
+        rows, people = [], []
+        for _ in range(count):
+            if people and rnd.random() < 0.1:
+                # Same person again with another relationship, merged by LCRPage
+                name, nationality = rnd.choice(people)
+            else:
+                name = f'{rnd.choice(FIRST_NAMES)} {rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}'
+                if rnd.random() < 0.2:
+                    name = name.split(' ', 1)[0] + ' ' + name.rsplit(' ', 1)[-1]
+                nationality = rnd.choice(NATIONALITIES)
+                people.append((name, nationality))
+            rows.append({
+                'name': name,
+                'nationality': nationality,
+                'relationship': rnd.choice(RELATIONSHIPS),
+                'stock': rnd.choice((0, 0, rnd.randint(1, 10000))),
+                'quota': rnd.choice((0, 0, 0, rnd.randint(1, 100))),
+                'ratio': rnd.choice((0, rnd.randint(1, 100))),
+            })
+        return rows
+
+
+def make_app(registry, latency=0, latency_jitter=0, error_rate=0,
+             throttle_rate=0, malformed_rate=0):
+    """
+    aiohttp application serving /search/result.aspx?id=<cr_id>
+        - latency, latency_jitter: seconds before answering (normal law)
+        - error_rate: share of requests answered with HTTP 500
+        - throttle_rate: share of requests answered with HTTP 429
+        - malformed_rate: share of pages cut in the middle
+    """
+    async def result(request):
+        delay = rnd.gauss(latency, latency_jitter) if latency_jitter else latency
+        if delay > 0:
+            await asyncio.sleep(delay)
+        draw = rnd.random()
+        if draw < error_rate:
+            return web.Response(status=500, text='Server Error')
+        if draw < error_rate + throttle_rate:
+            return web.Response(status=429, text='Too Many Requests')
+        content = registry.page(request.query.get('id', ''))
+        if rnd.random() < malformed_rate:
+            content = content[:rnd.randrange(len(content))]
+        return web.Response(body=content, content_type='text/html', charset='utf-8')
+
+    rnd = random.Random()
+    app = web.Application()
+    app.router.add_get('/search/result.aspx', result)
+    return app
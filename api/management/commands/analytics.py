@@ -0,0 +1,74 @@
+from api.helpers.snapshot import (AGGREGATES, SnapshotQueryError, build_snapshot,
+                                  get_snapshot)
+from api import constants
+
+from django.core.management.base import BaseCommand, CommandError
+import json
+import time
+
+
+def parse_filter(value):
+    """ 'legal_form=...' -> ('legal_form', '...') """
+    name, separator, label = value.partition('=')
+    if not separator:
+        raise CommandError(f'Invalid --filter {value!r}, expected column=value')
+    return name, label
+
+
+class Command(BaseCommand):
+    help = ('Answers filter/group/aggregate queries from the columnar snapshot '
+            '(see build_snapshot), without querying the database. '
+            'E.g. --by legal_form --by capital_magnitude, '
+            '--by registration_year --filter governorate=1 --histogram, '
+            '--top stock --individuals')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--by', action='append', default=[],
+                            help='Column to group by, repeat for several')
+        parser.add_argument('--value', help='Column to aggregate, e.g. capital or stock')
+        parser.add_argument('--aggregate', choices=AGGREGATES, default='sum')
+        parser.add_argument('--persons', action='store_true',
+                            help='Query the people instead of the companies')
+        parser.add_argument('--filter', dest='filters', action='append', default=[],
+                            type=parse_filter,
+                            help='column=value, registered_from=YYYY-MM-DD, '
+                                 'capital_min=..., repeat for several')
+        parser.add_argument('--histogram', action='store_true',
+                            help='Groups in label order instead of largest first')
+        parser.add_argument('--top', metavar='VALUE',
+                            help='People with the largest stock, quota or ratio')
+        parser.add_argument('--individuals', action='store_true',
+                            help='With --top, sum over the companies of each individual')
+        parser.add_argument('--limit', type=int, default=constants.SNAPSHOT_TOP_LIMIT)
+        parser.add_argument('--json', action='store_true')
+        parser.add_argument('--build', action='store_true',
+                            help='Build the snapshot first, on this machine (see build_snapshot)')
+
+    def handle(self, *args, **options):
+        if options['build'] and build_snapshot() is None:
+            raise CommandError('Another snapshot is being built')
+        snapshot = get_snapshot()
+        if snapshot is None:
+            raise CommandError('No snapshot on this machine yet, run build_snapshot '
+                               'or pass --build')
+        filters = dict(options['filters'])
+        started = time.perf_counter()
+        try:
+            if options['top']:
+                rows = snapshot.top(options['top'], options['limit'],
+                                    options['individuals'], **filters)
+            else:
+                rows = snapshot.aggregate(
+                    options['by'], options['value'], options['aggregate'],
+                    options['persons'], not options['histogram'], **filters)
+        except SnapshotQueryError as e:
+            raise CommandError(e)
+        milliseconds = (time.perf_counter() - started) * 1000
+
+        if options['json']:
+            self.stdout.write(json.dumps(rows, ensure_ascii=False, indent=2))
+            return
+        for row in rows[:options['limit']] if options['top'] else rows:
+            self.stdout.write('  '.join(f'{name}={value}' for name, value in row.items()))
+        self.stdout.write(f'{len(rows)} rows in {milliseconds:.1f} ms '
+                          f"(snapshot of {snapshot.meta['built_at']})")
@@ -0,0 +1,124 @@
+from api.helpers.lcr_parse import (LCRPage, COMPANY_FIELDS, PERSONNEL_TABLE_ID,
+                                   REGISTRATION_DATE_ID, REGISTRATION_DATE_FORMAT)
+from api.helpers.benchmark import CORPUS_DIR, load_corpus
+
+from bs4 import BeautifulSoup
+from datetime import datetime
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+import os
+import time
+
+
+def legacy_extract(content):
+    """
+    The BeautifulSoup extraction LCRScrape used before LCRPage:
+    one full-tree soup.find per field, repeated for duplicate people
+    """
+    soup = BeautifulSoup(content, 'html.parser')
+
+    def get_soup_value(tag_id, cast_type='string'):
+        contents = soup.find('span', {'id': tag_id}).contents
+        if contents:
+            if cast_type == 'string':
+                return str(contents[0])
+            elif cast_type == 'decimal':
+                return Decimal(contents[0])
+            elif cast_type == 'int':
+                return int(contents[0])
+        else:
+            return ''
+
+    company = {
+        field: get_soup_value(tag_id, cast_type)
+        for field, tag_id, cast_type in COMPANY_FIELDS
+    }
+    company['registration_date'] = datetime.strptime(
+        get_soup_value(REGISTRATION_DATE_ID), REGISTRATION_DATE_FORMAT)
+    personnel_data = soup.find('tr', {'id': PERSONNEL_TABLE_ID})
+    company['missing_personnel_data'] = False if personnel_data else True
+    if not personnel_data:
+        return company, []
+
+    table_rows = personnel_data.parent.findAll('tr')[1:]
+    person_dict = {}
+    for index, row in enumerate(table_rows):
+        suffix = str(index)
+        name = get_soup_value('Relations_ListView_desigLabel_' + suffix)
+        relationship = get_soup_value('Relations_ListView_relLabel_' + suffix)
+        amounts = {
+            'stock': get_soup_value('Relations_ListView_a_valLabel_' + suffix, 'int'),
+            'quota': get_soup_value('Relations_ListView_s_valLabel_' + suffix, 'int'),
+            'ratio': get_soup_value('Relations_ListView_r_valLabel_' + suffix, 'int'),
+        }
+        if name in person_dict:
+            person = person_dict[name]
+            person['relationship'] += ' \\ ' + relationship
+            for field, value in amounts.items():
+                if person[field] == 0:
+                    person[field] = value
+        else:
+            person_dict[name] = dict(
+                name=name,
+                nationality=get_soup_value(
+                    'Relations_ListView_countryLabel_' + suffix),
+                relationship=relationship,
+                **amounts
+            )
+    return company, list(person_dict.values())
+
+
+def indexed_extract(content):
+    page = LCRPage(content)
+    company = page.company_record()
+    if company['missing_personnel_data']:
+        return company, []
+    return company, page.personnel_records()
+
+
+class Command(BaseCommand):
+    help = ('Compares per-page CPU time of the legacy BeautifulSoup extraction '
+            'with the single-pass LCRPage extraction on saved result.aspx pages')
+
+    def add_arguments(self, parser):
+        parser.add_argument('pages', nargs='*',
+                            help='Saved Commercial Registry pages, '
+                                 'the benchmark corpus by default')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Times each page is parsed per extractor')
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        totals = {'legacy': 0.0, 'indexed': 0.0}
+        page_count = 0
+        paths = options['pages'] or [os.path.join(CORPUS_DIR, f'{name}.html')
+                                     for name in load_corpus()]
+        for path in paths:
+            with open(path, 'rb') as f:
+                content = f.read()
+            try:
+                if legacy_extract(content) != indexed_extract(content):
+                    self.stderr.write(f'{path}: extractors disagree')
+            except Exception as e:
+                # Empty and malformed pages have nothing to compare
+                self.stderr.write(f'{path}: skipped, {e!r}')
+                continue
+            timings = {}
+            for label, extract in (('legacy', legacy_extract),
+                                   ('indexed', indexed_extract)):
+                started = time.process_time()
+                for _ in range(repeat):
+                    extract(content)
+                timings[label] = (time.process_time() - started) / repeat
+                totals[label] += timings[label]
+            page_count += 1
+            self.stdout.write(
+                f"{path}: legacy {timings['legacy'] * 1000:.2f} ms, "
+                f"indexed {timings['indexed'] * 1000:.2f} ms "
+                f"({timings['legacy'] / timings['indexed']:.1f}x)")
+        if not page_count:
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Mean per page: legacy {totals['legacy'] / page_count * 1000:.2f} ms, "
+            f"indexed {totals['indexed'] / page_count * 1000:.2f} ms "
+            f"({totals['legacy'] / totals['indexed']:.1f}x)"))
@@ -0,0 +1,114 @@
+from api.helpers.benchmark import (CORPUS_DIR, STAGES, compare_results,
+                                   load_corpus, run_benchmarks)
+from api import constants
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import json
+import os
+
+
+class Command(BaseCommand):
+    help = ('Measures parse time per page, DB write throughput and end-to-end '
+            'pages/sec against a local stub registry on the recorded page corpus, '
+            'and writes the results as JSON to compare them across commits')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stage', dest='stages', action='append',
+                            choices=STAGES, help='Stage to run, every stage by default')
+        parser.add_argument('--corpus', default=CORPUS_DIR,
+                            help='Directory of saved result.aspx pages')
+        parser.add_argument('--repeat', type=int,
+                            default=constants.BENCHMARK_PARSE_REPEAT,
+                            help='Times each page is scraped by the parse stage')
+        parser.add_argument('--companies', type=int,
+                            default=constants.BENCHMARK_WRITE_COMPANIES,
+                            help='Companies written by the write stage')
+        parser.add_argument('--pages', type=int, default=constants.BENCHMARK_PAGES,
+                            help='Pages scraped by the end_to_end stage')
+        parser.add_argument('--concurrency', type=int,
+                            default=constants.FETCH_CONCURRENCY)
+        parser.add_argument('--latency', type=float, default=0,
+                            help='Milliseconds the stub registry waits per page')
+        parser.add_argument('--output',
+                            help='Results file, a new file in BENCHMARK_RESULTS_DIR by default')
+        parser.add_argument('--compare', nargs='?', const='latest',
+                            help='Results file to compare with, the latest one '
+                                 'in BENCHMARK_RESULTS_DIR when no file is given')
+        parser.add_argument('--threshold', type=float, default=10,
+                            help='Percentage past which a slowdown is flagged')
+
+    def handle(self, *args, **options):
+        previous = self.load_previous(options['compare'])
+        results = run_benchmarks(
+            stages=options['stages'] or STAGES,
+            corpus=load_corpus(options['corpus']),
+            repeat=options['repeat'],
+            companies=options['companies'],
+            pages=options['pages'],
+            concurrency=options['concurrency'],
+            latency=options['latency'] / 1000,
+        )
+        self.write_summary(results['stages'])
+
+        output = options['output']
+        if output is None:
+            os.makedirs(settings.BENCHMARK_RESULTS_DIR, exist_ok=True)
+            stamp = results['created_at'][:19].replace(':', '')
+            output = os.path.join(settings.BENCHMARK_RESULTS_DIR,
+                                  f"{stamp}-{results['commit'] or 'unknown'}.json")
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        self.stdout.write(f'Wrote {output}')
+
+        if previous is not None:
+            self.write_comparison(previous, results, options['threshold'] / 100)
+
+    def load_previous(self, path):
+        if path == 'latest':
+            directory = settings.BENCHMARK_RESULTS_DIR
+            names = sorted(name for name in os.listdir(directory)
+                           if name.endswith('.json')) if os.path.isdir(directory) else []
+            if not names:
+                raise CommandError(f'No results in {directory} to compare with')
+            path = os.path.join(directory, names[-1])
+        if path is None:
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def write_summary(self, stages):
+        if 'parse' in stages:
+            for name, page in stages['parse']['pages'].items():
+                self.stdout.write(
+                    f"{name}: parse {page['parse_ms']['median']:.2f} ms, "
+                    f"scrape {page['scrape_ms']['median']:.2f} ms, "
+                    f"{page['persons']} persons"
+                    + (f" ({page['error']})" if page['error'] else ''))
+        if 'write' in stages:
+            for name, write in stages['write'].items():
+                self.stdout.write(
+                    f"write {name}: {write['companies_per_second']:.0f} companies/s, "
+                    f"{write['rows_per_second']:.0f} rows/s")
+        if 'end_to_end' in stages:
+            end_to_end = stages['end_to_end']
+            self.stdout.write(
+                f"end to end: {end_to_end['pages_per_second']:.0f} pages/s "
+                f"(fetch {end_to_end['fetch_seconds']} s, "
+                f"scrape {end_to_end['scrape_seconds']} s)")
+
+    def write_comparison(self, previous, results, threshold):
+        self.stdout.write(f"Compared with {previous['commit'] or 'unknown'} "
+                          f"({previous['created_at']}):")
+        regressions = 0
+        for metric, before, after, change in compare_results(previous, results):
+            line = (f'  {metric}: {before} -> {after} '
+                    f"({abs(change):.1%} {'slower' if change > 0 else 'faster'})")
+            if change > threshold:
+                regressions += 1
+                line = self.style.ERROR(line)
+            self.stdout.write(line)
+        if regressions:
+            self.stdout.write(self.style.ERROR(f'{regressions} metrics regressed'))
+        else:
+            self.stdout.write(self.style.SUCCESS('No regression'))
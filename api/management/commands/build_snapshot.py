@@ -0,0 +1,19 @@
+from api.helpers.snapshot import build_snapshot
+
+from django.core.management.base import BaseCommand, CommandError
+import time
+
+
+class Command(BaseCommand):
+    help = ('Writes every company and person to the memory-mapped columnar '
+            'snapshot queried by the analytics command')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        snapshot = build_snapshot()
+        if snapshot is None:
+            raise CommandError('Another snapshot is being built')
+        self.stdout.write(self.style.SUCCESS(
+            f"Snapshot of {snapshot.meta['companies']} companies and "
+            f"{snapshot.meta['persons']} persons in {time.monotonic() - started:.1f}s "
+            f'({snapshot.root})'))
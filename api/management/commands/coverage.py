@@ -0,0 +1,40 @@
+from api.models import Company
+from api.helpers.coverage import get_coverage_index, seed_coverage
+from api.helpers.id_discovery import get_max_cr_sub_id
+from api import constants
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ('Reports how many ids of each governorate the coverage index holds '
+            'as scraped, missing or failed, which crawls do not fetch again')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--governorate', type=int, choices=Company.Governorate.values)
+        parser.add_argument('--seed', action='store_true',
+                            help='Record the stored companies and empty records first')
+        parser.add_argument('--reset', action='store_true',
+                            help='Forget every entry, the next crawls fetch every id')
+
+    def handle(self, *args, **options):
+        coverage = get_coverage_index()
+        if options['reset']:
+            deleted = coverage.reset(options['governorate'])
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} coverage buckets'))
+            return
+        if options['seed']:
+            counts = seed_coverage(coverage)
+            self.stdout.write(self.style.SUCCESS(
+                ', '.join(f'{count} {state}' for state, count in counts.items()) + ' recorded'))
+
+        governorates = ([options['governorate']] if options['governorate']
+                        else Company.Governorate.values)
+        for gov in governorates:
+            max_cr_sub_id = get_max_cr_sub_id(gov)
+            end = (max_cr_sub_id if max_cr_sub_id is not None
+                   else constants.GOVERNORATE_SCRAPE_LIMIT[gov]) + 1
+            summary = coverage.summary(gov, end)
+            self.stdout.write(
+                f'{Company.Governorate(gov).label:<16} ' +
+                '  '.join(f'{state} {count:>9}' for state, count in summary.items()))
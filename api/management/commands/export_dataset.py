@@ -0,0 +1,39 @@
+from api.helpers.export import (COMPRESSIONS, EXPORT_FORMATS, ExportError,
+                                export_dataset)
+from api import constants
+
+from django.core.management.base import BaseCommand, CommandError
+import sys
+
+
+class Command(BaseCommand):
+    help = ('Streams every company with its personnel to a CSV, JSONL or '
+            'Parquet file (Parquet requires pyarrow)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="File to write, '-' for stdout")
+        parser.add_argument('--format', dest='export_format',
+                            choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--compression', choices=COMPRESSIONS, default='none')
+        parser.add_argument('--chunk-size', type=int,
+                            default=constants.EXPORT_CHUNK_SIZE,
+                            help='Companies read per query')
+
+    def handle(self, *args, **options):
+        try:
+            pieces = export_dataset(options['export_format'],
+                                    options['compression'], options['chunk_size'])
+        except ExportError as e:
+            raise CommandError(e)
+        output = options['output']
+        written = 0
+        stream = sys.stdout.buffer if output == '-' else open(output, 'wb')
+        try:
+            for piece in pieces:
+                stream.write(piece)
+                written += len(piece)
+        finally:
+            if stream is not sys.stdout.buffer:
+                stream.close()
+        if output != '-':
+            self.stdout.write(f'Wrote {written} bytes to {output}')
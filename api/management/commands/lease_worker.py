@@ -0,0 +1,59 @@
+from api.models import ScrapeCheckpoint
+from api.helpers.dispatcher import claim_chunk
+from api.tasks import scrape_lcr_range, start_crawls
+from api import constants
+
+from django.core.management.base import BaseCommand
+import os
+import socket
+import time
+import uuid
+
+
+class Command(BaseCommand):
+    help = ('Scrapes the running crawls on this node, leasing one chunk at a time. '
+            'Run one on every node: they share the work without dispatcher, and '
+            'the chunks of a node that stops are taken over once its leases expire')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', action='store_true',
+                            help='Start a crawl of every scraped governorate first, like '
+                                 'scrape_lcr (running crawls are kept)')
+        parser.add_argument('--refresh', action='store_true',
+                            help='With --start, also re-check the already scraped ids')
+        parser.add_argument('--exit-when-idle', action='store_true',
+                            help='Stop once no crawl is running instead of waiting for one')
+
+    def handle(self, *args, **options):
+        owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        if options['start']:
+            start_crawls(options['refresh'])
+
+        self.stdout.write(f'Leasing chunks as {owner}')
+        while True:
+            try:
+                chunk = claim_chunk(owner)
+            except Exception as e:
+                # Database down or failover, the node waits for it instead of exiting
+                self.stderr.write(f'Claiming a chunk failed: {e}')
+                time.sleep(constants.LEASE_IDLE_SECONDS)
+                continue
+            if chunk is None:
+                if options['exit_when_idle'] and not ScrapeCheckpoint.objects.filter(
+                        status=ScrapeCheckpoint.Status.RUNNING).exists():
+                    return
+                time.sleep(constants.LEASE_IDLE_SECONDS)
+                continue
+            try:
+                refresh = ScrapeCheckpoint.objects.filter(
+                    governorate=chunk.governorate).values_list('refresh', flat=True).first()
+                stats = scrape_lcr_range(chunk.governorate, chunk.start, chunk.end,
+                                         bool(refresh), chunk.id, owner)
+            except Exception as e:
+                self.stderr.write(f'{chunk} failed: {e}')
+                continue
+            self.stdout.write(
+                f"{chunk}: {stats['scraped']} scraped, {stats['unchanged']} unchanged, "
+                f"{stats['fetch_errors'] + stats['scrape_errors']} errors, "
+                f"{stats['skipped']} skipped in {stats['seconds']}s"
+                + (', lease lost to another node' if stats['lease_lost'] else ''))
@@ -0,0 +1,49 @@
+from api.helpers.metrics import (histogram_quantile, read_gauges, read_series,
+                                 reset_metrics)
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ('Summarizes the scrape stage timings, page outcomes and Celery task '
+            'latencies recorded by every worker, and the current queue depth')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help='Delete the recorded metrics after the summary')
+
+    def handle(self, *args, **options):
+        series = read_series()
+        histograms = [item for item in series if 'buckets' in item[2]]
+        counters = [item for item in series if 'value' in item[2]]
+
+        if histograms:
+            self.stdout.write(f"{'series':<60} {'count':>8} {'mean':>9} "
+                              f"{'p50':>9} {'p95':>9} {'p99':>9}")
+        for metric, labels, values in histograms:
+            count = values['count']
+            quantiles = [histogram_quantile(q, values['buckets']) for q in (0.5, 0.95, 0.99)]
+            self.stdout.write(
+                f'{self.series_name(metric, labels):<60} {count:>8} '
+                f"{self.seconds(values['sum'] / count if count else None):>9} "
+                + ' '.join(f'{self.seconds(quantile):>9}' for quantile in quantiles))
+        for metric, labels, values in counters:
+            self.stdout.write(f"{self.series_name(metric, labels):<60} {values['value']:>8g}")
+        for metric, labels, value in read_gauges():
+            self.stdout.write(f'{self.series_name(metric, labels):<60} {value:>8g}')
+
+        if options['reset']:
+            self.stdout.write(f'Deleted {reset_metrics()} series')
+
+    @staticmethod
+    def series_name(metric, labels):
+        if not labels:
+            return metric
+        return metric + '{' + ','.join(f'{name}={value}' for name, value in labels.items()) + '}'
+
+    @staticmethod
+    def seconds(value):
+        """ Milliseconds below a second """
+        if value is None:
+            return '-'
+        return f'{value * 1000:.1f}ms' if value < 1 else f'{value:.2f}s'
@@ -0,0 +1,24 @@
+from api.helpers.stats import check_stats, rebuild_stats
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the statistics tables from the companies and people, '
+            'or checks that the triggers kept them consistent')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Report the groups that differ instead of rebuilding')
+
+    def handle(self, *args, **options):
+        if options['check']:
+            differences = check_stats()
+            for model, group, stored, computed in differences:
+                self.stdout.write(f'{model} {group}: stored {stored}, computed {computed}')
+            if differences:
+                raise CommandError(f'{len(differences)} groups differ, run rebuild_stats')
+            self.stdout.write(self.style.SUCCESS('Statistics are consistent'))
+            return
+        for model, rows in rebuild_stats().items():
+            self.stdout.write(f'{model}: {rows} rows')
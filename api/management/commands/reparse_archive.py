@@ -0,0 +1,76 @@
+from api.models import ScrapeError
+from api.helpers.lcr_scrape import LCRScrape, split_cr_id
+from api.helpers.page_archive import PageArchive
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+import multiprocessing
+import time
+
+
+_archive = None
+
+
+def init_worker(archive_root):
+    global _archive
+    _archive = PageArchive(archive_root)
+
+
+def reparse_page(entry):
+    """
+    Replaces the stored company of one archived page with a fresh parse.
+    Nothing changes when the page fails to parse again.
+    Returns (cr_id, error message or None)
+    """
+    cr_id, fetched_at, digest = entry
+    gov, cr_sub_id = split_cr_id(cr_id)
+    try:
+        content = _archive.get(digest)
+        with transaction.atomic():
+            ScrapeError.objects.filter(cr_id=cr_id).delete()
+            LCRScrape(cr_sub_id, gov).extract_data(content)
+    except Exception as e:
+        return cr_id, str(e.__context__ or e)
+    return cr_id, None
+
+
+class Command(BaseCommand):
+    help = ('Re-runs company and personnel scraping over the latest archived '
+            'page of every cr_id, without touching the network')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--governorate', type=int,
+                            help='Only re-parse pages of this governorate')
+        parser.add_argument('--processes', type=int,
+                            default=multiprocessing.cpu_count())
+        parser.add_argument('--chunk-size', type=int, default=100,
+                            help='Pages handed to a worker process at a time')
+        parser.add_argument('--archive-dir', default=settings.PAGE_ARCHIVE_DIR)
+
+    def handle(self, *args, **options):
+        if not options['archive_dir']:
+            raise CommandError('No archive: set PAGE_ARCHIVE_DIR or --archive-dir')
+        archive = PageArchive(options['archive_dir'])
+        entries = list(archive.latest(options['governorate']))
+        archive.close()
+        self.stdout.write(f'Re-parsing {len(entries)} archived pages')
+
+        # Worker processes must open their own database connections
+        connections.close_all()
+        started = time.monotonic()
+        failures = []
+        with multiprocessing.Pool(options['processes'], initializer=init_worker,
+                                  initargs=(options['archive_dir'],)) as pool:
+            results = pool.imap_unordered(
+                reparse_page, entries, chunksize=options['chunk_size'])
+            for cr_id, error in results:
+                if error is not None:
+                    failures.append((cr_id, error))
+        seconds = time.monotonic() - started
+
+        for cr_id, error in failures[:20]:
+            self.stderr.write(f'{cr_id}: {error}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Re-parsed {len(entries) - len(failures)} pages, '
+            f'{len(failures)} failed, in {seconds:.1f}s'))
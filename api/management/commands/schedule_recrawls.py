@@ -0,0 +1,36 @@
+from api.models import RecrawlSchedule
+from api.helpers.recrawl import get_recrawl_budget, reschedule_companies
+from api import constants
+
+from django.core.management.base import BaseCommand
+from django.db.models import Avg, Count, Q
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the recrawl priority and next check of every company, '
+            'scheduling those scraped before, and reports what is due')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--report', action='store_true',
+                            help='Only report, without rescheduling')
+
+    def handle(self, *args, **options):
+        if not options['report']:
+            scheduled = reschedule_companies()
+            self.stdout.write(self.style.SUCCESS(f'{scheduled} companies scheduled'))
+
+        now = timezone.now()
+        tiers = ((0.5, 1.01), (0.2, 0.5), (0.05, 0.2), (0, 0.05))
+        for low, high in tiers:
+            tier = RecrawlSchedule.objects.filter(priority__gte=low, priority__lt=high)
+            summary = tier.aggregate(
+                companies=Count('id'), due=Count('id', filter=Q(next_check_at__lte=now)),
+                changes=Avg('changes'), checks=Avg('checks'))
+            self.stdout.write(
+                f"priority {low:.2f}-{min(high, 1):.2f}: {summary['companies']:>9} companies "
+                f"{summary['due']:>9} due  {summary['checks'] or 0:.1f} checks "
+                f"{summary['changes'] or 0:.1f} changes on average")
+        self.stdout.write(
+            f'{get_recrawl_budget().spent()} of {constants.RECRAWL_DAILY_BUDGET} '
+            'recrawl requests spent today')
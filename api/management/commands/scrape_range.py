@@ -0,0 +1,56 @@
+from api.helpers.pipeline import ScrapePipeline, make_parse_pool
+from api.helpers.rate_limit import get_rate_limiter
+from api.tasks import scrape_range
+from api import constants
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ('Scrapes cr_sub_ids start <= id < end of a governorate in this process '
+            'through the fetch/parse/write pipeline, parsing on every core, and '
+            'reports the throughput of each stage')
+
+    def add_arguments(self, parser):
+        parser.add_argument('governorate', type=int)
+        parser.add_argument('start', type=int)
+        parser.add_argument('end', type=int)
+        parser.add_argument('--refresh', action='store_true',
+                            help='Only write the companies whose page changed')
+        parser.add_argument('--processes', type=int, default=constants.PARSE_PROCESSES,
+                            help='Parse processes, 0 parses in a thread')
+        parser.add_argument('--concurrency', type=int, default=constants.FETCH_CONCURRENCY)
+        parser.add_argument('--queue-size', type=int, default=constants.PIPELINE_QUEUE_SIZE,
+                            help='Pages waiting between two stages')
+        parser.add_argument('--base-url', default=constants.COMMERCIAL_REGISTRY_URL,
+                            help='Registry URL the cr_id is appended to')
+        parser.add_argument('--no-rate-limit', action='store_true',
+                            help='Skip the shared rate limiter, for local registries')
+        parser.add_argument('--include-covered', action='store_true',
+                            help='Also fetch the ids the coverage index holds')
+
+    def handle(self, *args, **options):
+        pool = make_parse_pool(options['processes'])
+        try:
+            pipeline = ScrapePipeline(
+                pool, options['queue_size'],
+                concurrency=options['concurrency'],
+                base_url=options['base_url'],
+                limiter=None if options['no_rate_limit'] else get_rate_limiter())
+            stats = scrape_range(options['governorate'], options['start'], options['end'],
+                                 options['refresh'], pipeline,
+                                 skip_covered=not options['include_covered'])
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        for name, stage in stats['stages'].items():
+            self.stdout.write(
+                f"{name:<6} {stage['pages']:>8} pages {stage['pages_per_second']:>9.1f}/s  "
+                f"waiting {stage['waiting_seconds']:>8.1f}s  "
+                f"blocked {stage['blocked_seconds']:>8.1f}s")
+        self.stdout.write(self.style.SUCCESS(
+            f"{stats['scraped']} scraped, {stats['unchanged']} unchanged, "
+            f"{stats['fetch_errors']} fetch errors, {stats['scrape_errors']} scrape errors, "
+            f"{stats['skipped']} skipped "
+            f"in {stats['seconds']}s"))
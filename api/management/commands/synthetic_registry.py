@@ -0,0 +1,69 @@
+from api.helpers.synthetic_registry import SyntheticRegistry, make_app
+from api import constants
+
+from aiohttp import web
+from django.core.management.base import BaseCommand, CommandError
+
+
+def parse_id_spaces(value):
+    """ '1=50000,2=80000' -> {1: 50000, 2: 80000} """
+    try:
+        return {int(gov): int(size) for gov, size in
+                (item.split('=') for item in value.split(',') if item)}
+    except ValueError:
+        raise CommandError(f'Invalid --id-spaces {value!r}, expected e.g. 1=50000,2=80000')
+
+
+class Command(BaseCommand):
+    help = ('Serves deterministic synthetic Commercial Registry pages at '
+            '/search/result.aspx?id=, for load tests. Point the scraper at it with '
+            'COMMERCIAL_REGISTRY_URL=http://<host>:<port>/search/result.aspx?id=')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8080)
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Pages differ between seeds, never for the same seed')
+        parser.add_argument('--id-spaces', type=parse_id_spaces, default={},
+                            help='Largest cr_sub_id per governorate, e.g. 1=50000,2=80000 '
+                                 f'(default {constants.SYNTHETIC_ID_SPACE})')
+        parser.add_argument('--missing-rate', type=float,
+                            default=constants.SYNTHETIC_MISSING_RATE)
+        parser.add_argument('--personnel-mean', type=float,
+                            default=constants.SYNTHETIC_PERSONNEL_MEAN)
+        parser.add_argument('--personnel-max', type=int,
+                            default=constants.SYNTHETIC_PERSONNEL_MAX)
+        parser.add_argument('--no-personnel-rate', type=float,
+                            default=constants.SYNTHETIC_NO_PERSONNEL_RATE)
+        parser.add_argument('--latency', type=float, default=0,
+                            help='Milliseconds before every answer')
+        parser.add_argument('--latency-jitter', type=float, default=0,
+                            help='Standard deviation of the latency, in milliseconds')
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help='Share of requests answered with HTTP 500')
+        parser.add_argument('--throttle-rate', type=float, default=0,
+                            help='Share of requests answered with HTTP 429')
+        parser.add_argument('--malformed-rate', type=float, default=0,
+                            help='Share of pages cut short')
+
+    def handle(self, *args, **options):
+        registry = SyntheticRegistry(
+            id_spaces=options['id_spaces'],
+            seed=options['seed'],
+            missing_rate=options['missing_rate'],
+            personnel_mean=options['personnel_mean'],
+            personnel_max=options['personnel_max'],
+            no_personnel_rate=options['no_personnel_rate'],
+        )
+        app = make_app(
+            registry,
+            latency=options['latency'] / 1000,
+            latency_jitter=options['latency_jitter'] / 1000,
+            error_rate=options['error_rate'],
+            throttle_rate=options['throttle_rate'],
+            malformed_rate=options['malformed_rate'],
+        )
+        self.stdout.write(
+            f"COMMERCIAL_REGISTRY_URL=http://{options['host']}:{options['port']}"
+            f"/search/result.aspx?id=")
+        web.run_app(app, host=options['host'], port=options['port'], print=None)
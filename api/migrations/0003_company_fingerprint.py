@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-18 19:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_auto_20201218_0758'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
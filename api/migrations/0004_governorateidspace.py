@@ -0,0 +1,26 @@
+# Generated by Django 3.1.4 on 2026-10-18 19:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_company_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GovernorateIdSpace',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('governorate', models.IntegerField(choices=[(1, 'Beirut'), (2, 'Mount Lebanon'), (3, 'North Lebanon'), (4, 'Bekaa'), (5, 'South Lebanon'), (6, 'Nabatieh')], unique=True)),
+                ('max_cr_sub_id', models.IntegerField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
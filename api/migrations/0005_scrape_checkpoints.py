@@ -0,0 +1,53 @@
+# Generated by Django 3.1.4 on 2026-10-18 19:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_governorateidspace'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScrapeCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('governorate', models.IntegerField(choices=[(1, 'Beirut'), (2, 'Mount Lebanon'), (3, 'North Lebanon'), (4, 'Bekaa'), (5, 'South Lebanon'), (6, 'Nabatieh')], unique=True)),
+                ('cursor', models.IntegerField()),
+                ('end', models.IntegerField()),
+                ('refresh', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('RU', 'Running'), ('CO', 'Complete')], default='RU', max_length=2)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ScrapeChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('governorate', models.IntegerField(choices=[(1, 'Beirut'), (2, 'Mount Lebanon'), (3, 'North Lebanon'), (4, 'Bekaa'), (5, 'South Lebanon'), (6, 'Nabatieh')])),
+                ('start', models.IntegerField()),
+                ('end', models.IntegerField()),
+                ('status', models.CharField(choices=[('PE', 'Pending'), ('DI', 'Dispatched'), ('DO', 'Done'), ('FA', 'Failed')], default='PE', max_length=2)),
+                ('attempts', models.IntegerField(default=0)),
+                ('dispatched_at', models.DateTimeField(blank=True, null=True)),
+                ('stats', models.JSONField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='scrapechunk',
+            index=models.Index(fields=['governorate', 'status'], name='scrape_chunk_status_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='scrapechunk',
+            constraint=models.UniqueConstraint(fields=('governorate', 'start'), name='scrape_chunk_unique_start'),
+        ),
+    ]
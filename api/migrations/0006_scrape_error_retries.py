@@ -0,0 +1,40 @@
+# Generated by Django 3.1.4 on 2026-10-18 19:54
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def schedule_existing_errors(apps, schema_editor):
+    """ Errors recorded before retries existed are retried (and classified) once """
+    ScrapeError = apps.get_model('api', 'ScrapeError')
+    ScrapeError.objects.update(next_retry_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_scrape_checkpoints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scrapeerror',
+            name='attempts',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='scrapeerror',
+            name='error_class',
+            field=models.CharField(choices=[('TO', 'Network timeout'), ('NE', 'Network error'), ('5X', 'HTTP 5xx'), ('HT', 'Other HTTP error'), ('EM', 'Empty or nonexistent record'), ('PA', 'Parse failure'), ('DB', 'Database error')], default='PA', max_length=2),
+        ),
+        migrations.AddField(
+            model_name='scrapeerror',
+            name='next_retry_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='scrapeerror',
+            index=models.Index(fields=['next_retry_at'], name='scrape_error_retry_idx'),
+        ),
+        migrations.RunPython(schedule_existing_errors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.4 on 2026-10-18 19:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_scrape_error_retries'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='company',
+            index=models.Index(fields=['governorate', 'id'], name='company_governorate_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='company',
+            index=models.Index(fields=['legal_form', 'id'], name='company_legal_form_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='company',
+            index=models.Index(fields=['company_status', 'id'], name='company_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='company',
+            index=models.Index(fields=['registration_date', 'id'], name='company_reg_date_idx'),
+        ),
+    ]
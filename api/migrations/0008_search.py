@@ -0,0 +1,152 @@
+# Generated by Django 3.1.4 on 2026-10-18 20:00
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+import re
+import unicodedata
+
+
+BACKFILL_BATCH_SIZE = 1000
+
+# search_key of helpers/search.py as of this migration, frozen so later
+# changes to the normalization do not change what the migration writes
+ARABIC_DIACRITICS = re.compile('[\u064b-\u065f\u0670\u0640]')
+ARABIC_VARIANTS = str.maketrans('أإآٱىةؤئ', 'اااايهوي')
+ARABIC_DIGITS = str.maketrans('٠١٢٣٤٥٦٧٨٩', '0123456789')
+NON_WORD = re.compile(r'[^\w]+')
+ARABIC_TO_LATIN = {
+    'ا': 'a', 'ب': 'b', 'ت': 't', 'ث': 'th', 'ج': 'j', 'ح': 'h', 'خ': 'kh',
+    'د': 'd', 'ذ': 'dh', 'ر': 'r', 'ز': 'z', 'س': 's', 'ش': 'sh', 'ص': 's',
+    'ض': 'd', 'ط': 't', 'ظ': 'z', 'ع': '', 'غ': 'gh', 'ف': 'f', 'ق': 'q',
+    'ك': 'k', 'ل': 'l', 'م': 'm', 'ن': 'n', 'ه': 'h', 'و': 'w', 'ي': 'y',
+    'ء': '',
+}
+LATIN_SOUNDS = (
+    (re.compile(r'ph'), 'f'),
+    (re.compile(r'ch'), 'sh'),
+    (re.compile(r'ck|[cq]'), 'k'),
+    (re.compile(r'g(?!h)'), 'j'),
+    (re.compile(r'x'), 'ks'),
+    (re.compile(r'p'), 'b'),
+    (re.compile(r'v'), 'f'),
+    (re.compile(r'[aeiouwy]'), ''),
+    (re.compile(r'(.)\1+'), r'\1'),
+)
+
+
+def normalize_text(text):
+    text = unicodedata.normalize('NFKC', text or '')
+    text = ARABIC_DIACRITICS.sub('', text).translate(ARABIC_VARIANTS)
+    text = ''.join(char for char in unicodedata.normalize('NFKD', text)
+                   if not unicodedata.combining(char))
+    text = text.translate(ARABIC_DIGITS).lower()
+    return ' '.join(NON_WORD.sub(' ', text).replace('_', ' ').split())
+
+
+def latin_skeleton(word):
+    word = ''.join(ARABIC_TO_LATIN.get(char, char) for char in word)
+    for pattern, replacement in LATIN_SOUNDS:
+        word = pattern.sub(replacement, word)
+    return word
+
+
+def search_key(*values):
+    words = normalize_text(' '.join(values)).split()
+    skeletons = [latin_skeleton(word) for word in words]
+    return ' '.join(dict.fromkeys(words + [skeleton for skeleton in skeletons
+                                           if skeleton and skeleton not in words]))
+
+# Mirrors normalize_text for the description, which is only searched in SQL
+CREATE_SEARCH_TRIGGER = r"""
+CREATE FUNCTION api_normalize_text(text) RETURNS text AS $$
+    SELECT translate(
+        lower(regexp_replace($1, '[\u064b-\u065f\u0670\u0640]', '', 'g')),
+        'أإآٱىةؤئàáâãäåçèéêëìíîïñòóôõöùúûüýÿ',
+        'اااايهويaaaaaaceeeeiiiinooooouuuuyy')
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION api_company_search_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('simple', coalesce(NEW.search_name, '')), 'A') ||
+        setweight(to_tsvector('simple',
+                              api_normalize_text(coalesce(NEW.description, ''))), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER api_company_search
+    BEFORE INSERT OR UPDATE OF search_name, description ON api_company
+    FOR EACH ROW EXECUTE PROCEDURE api_company_search_update();
+"""
+
+DROP_SEARCH_TRIGGER = """
+DROP TRIGGER api_company_search ON api_company;
+DROP FUNCTION api_company_search_update();
+DROP FUNCTION api_normalize_text(text);
+"""
+
+
+def fill_search_names(apps, schema_editor):
+    """ The trigger fills search_vector as companies are updated """
+    Company = apps.get_model('api', 'Company')
+    Person = apps.get_model('api', 'Person')
+    batch = []
+    for company in Company.objects.only(
+            'name', 'additional_name').iterator(chunk_size=BACKFILL_BATCH_SIZE):
+        company.search_name = search_key(company.name, company.additional_name)
+        batch.append(company)
+        if len(batch) == BACKFILL_BATCH_SIZE:
+            Company.objects.bulk_update(batch, ['search_name'])
+            batch = []
+    Company.objects.bulk_update(batch, ['search_name'])
+    batch = []
+    for person in Person.objects.only('name').iterator(chunk_size=BACKFILL_BATCH_SIZE):
+        person.search_name = search_key(person.name)
+        batch.append(person)
+        if len(batch) == BACKFILL_BATCH_SIZE:
+            Person.objects.bulk_update(batch, ['search_name'])
+            batch = []
+    Person.objects.bulk_update(batch, ['search_name'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_company_api_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='company',
+            name='search_name',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='company',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='search_name',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunSQL(CREATE_SEARCH_TRIGGER, DROP_SEARCH_TRIGGER),
+        migrations.RunPython(fill_search_names, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='company',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_name'], name='company_search_name_idx', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='company',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='company_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='person',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_name'], name='person_search_name_idx', opclasses=['gin_trgm_ops']),
+        ),
+    ]
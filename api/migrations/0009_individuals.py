@@ -0,0 +1,45 @@
+# Generated by Django 3.1.4 on 2026-10-18 20:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Individual',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('name', models.CharField(max_length=255)),
+                ('nationality', models.CharField(max_length=128)),
+                ('name_key', models.TextField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='BlockingKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=32)),
+                ('individual', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='blocking_keys', to='api.individual')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='individual',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='persons', to='api.individual'),
+        ),
+        migrations.AddConstraint(
+            model_name='blockingkey',
+            constraint=models.UniqueConstraint(fields=('key', 'individual'), name='blocking_key_unique'),
+        ),
+    ]
@@ -0,0 +1,180 @@
+# Generated by Django 3.1.4 on 2026-10-18 20:30
+
+from django.db import migrations, models
+
+
+# Statement-level triggers: one upsert per statement with the net change of
+# each group (+1 per new row, -1 per old row), whatever the number of rows.
+# Groups are upserted in key order so concurrent writers cannot deadlock.
+# The groups mirror STATS_TABLES of helpers/stats.py, keep both in sync.
+CREATE_STATS_TRIGGERS = r"""
+CREATE FUNCTION api_stats_changes(operation text, columns text) RETURNS text AS $$
+    SELECT CASE operation
+        WHEN 'INSERT' THEN format('SELECT %1$s, 1 AS sign FROM new_rows', columns)
+        WHEN 'DELETE' THEN format('SELECT %1$s, -1 AS sign FROM old_rows', columns)
+        ELSE format('SELECT %1$s, 1 AS sign FROM new_rows '
+                    'UNION ALL SELECT %1$s, -1 AS sign FROM old_rows', columns)
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION api_company_stats_update() RETURNS trigger AS $$
+DECLARE
+    changes text := api_stats_changes(
+        TG_OP, 'governorate, legal_form, company_status, registration_date, capital');
+BEGIN
+    EXECUTE format($sql$
+        WITH changes AS (%s)
+        INSERT INTO api_companystats AS stats
+            (governorate, legal_form, company_status, registration_year, companies, capital)
+        SELECT governorate, legal_form, company_status,
+               EXTRACT(YEAR FROM registration_date AT TIME ZONE 'UTC')::integer,
+               SUM(sign), SUM(sign * capital)
+        FROM changes
+        GROUP BY 1, 2, 3, 4
+        HAVING SUM(sign) <> 0 OR SUM(sign * capital) <> 0
+        ORDER BY 1, 2, 3, 4
+        ON CONFLICT (governorate, legal_form, company_status, registration_year)
+        DO UPDATE SET companies = stats.companies + EXCLUDED.companies,
+                      capital = stats.capital + EXCLUDED.capital
+    $sql$, changes);
+    EXECUTE format($sql$
+        WITH changes AS (%s)
+        INSERT INTO api_capitalstats AS stats (governorate, capital_magnitude, companies)
+        SELECT governorate, floor(log(greatest(capital, 1)))::integer, SUM(sign)
+        FROM changes
+        GROUP BY 1, 2
+        HAVING SUM(sign) <> 0
+        ORDER BY 1, 2
+        ON CONFLICT (governorate, capital_magnitude)
+        DO UPDATE SET companies = stats.companies + EXCLUDED.companies
+    $sql$, changes);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION api_person_stats_update() RETURNS trigger AS $$
+BEGIN
+    EXECUTE format($sql$
+        WITH changes AS (%s)
+        INSERT INTO api_nationalitystats AS stats (governorate, nationality, persons)
+        SELECT company.governorate, changes.nationality, SUM(changes.sign)
+        FROM changes JOIN api_company company ON company.id = changes.company_id
+        GROUP BY 1, 2
+        HAVING SUM(changes.sign) <> 0
+        ORDER BY 1, 2
+        ON CONFLICT (governorate, nationality)
+        DO UPDATE SET persons = stats.persons + EXCLUDED.persons
+    $sql$, api_stats_changes(TG_OP, 'company_id, nationality'));
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- Transition tables need one trigger per event
+CREATE TRIGGER api_company_stats_insert AFTER INSERT ON api_company
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE api_company_stats_update();
+CREATE TRIGGER api_company_stats_update AFTER UPDATE ON api_company
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE api_company_stats_update();
+CREATE TRIGGER api_company_stats_delete AFTER DELETE ON api_company
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE api_company_stats_update();
+CREATE TRIGGER api_person_stats_insert AFTER INSERT ON api_person
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE api_person_stats_update();
+CREATE TRIGGER api_person_stats_update AFTER UPDATE ON api_person
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE api_person_stats_update();
+CREATE TRIGGER api_person_stats_delete AFTER DELETE ON api_person
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE api_person_stats_update();
+"""
+
+DROP_STATS_TRIGGERS = """
+DROP TRIGGER api_company_stats_insert ON api_company;
+DROP TRIGGER api_company_stats_update ON api_company;
+DROP TRIGGER api_company_stats_delete ON api_company;
+DROP TRIGGER api_person_stats_insert ON api_person;
+DROP TRIGGER api_person_stats_update ON api_person;
+DROP TRIGGER api_person_stats_delete ON api_person;
+DROP FUNCTION api_company_stats_update();
+DROP FUNCTION api_person_stats_update();
+DROP FUNCTION api_stats_changes(text, text);
+"""
+
+# Same queries as STATS_TABLES of helpers/stats.py, frozen at this migration
+FILL_STATS = """
+INSERT INTO api_companystats
+    (governorate, legal_form, company_status, registration_year, companies, capital)
+SELECT governorate, legal_form, company_status,
+       EXTRACT(YEAR FROM registration_date AT TIME ZONE 'UTC')::integer,
+       COUNT(*), SUM(capital)
+FROM api_company
+GROUP BY 1, 2, 3, 4;
+
+INSERT INTO api_capitalstats (governorate, capital_magnitude, companies)
+SELECT governorate, floor(log(greatest(capital, 1)))::integer, COUNT(*)
+FROM api_company
+GROUP BY 1, 2;
+
+INSERT INTO api_nationalitystats (governorate, nationality, persons)
+SELECT company.governorate, person.nationality, COUNT(*)
+FROM api_person person JOIN api_company company ON company.id = person.company_id
+GROUP BY 1, 2;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_person_updated_at_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CapitalStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('governorate', models.IntegerField(choices=[(1, 'Beirut'), (2, 'Mount Lebanon'), (3, 'North Lebanon'), (4, 'Bekaa'), (5, 'South Lebanon'), (6, 'Nabatieh')])),
+                ('capital_magnitude', models.IntegerField()),
+                ('companies', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CompanyStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('governorate', models.IntegerField(choices=[(1, 'Beirut'), (2, 'Mount Lebanon'), (3, 'North Lebanon'), (4, 'Bekaa'), (5, 'South Lebanon'), (6, 'Nabatieh')])),
+                ('legal_form', models.CharField(max_length=255)),
+                ('company_status', models.CharField(max_length=255)),
+                ('registration_year', models.IntegerField()),
+                ('companies', models.BigIntegerField(default=0)),
+                ('capital', models.DecimalField(decimal_places=2, default=0, max_digits=24)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='NationalityStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('governorate', models.IntegerField(choices=[(1, 'Beirut'), (2, 'Mount Lebanon'), (3, 'North Lebanon'), (4, 'Bekaa'), (5, 'South Lebanon'), (6, 'Nabatieh')])),
+                ('nationality', models.CharField(max_length=128)),
+                ('persons', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='nationalitystats',
+            constraint=models.UniqueConstraint(fields=('governorate', 'nationality'), name='nationality_stats_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='companystats',
+            constraint=models.UniqueConstraint(fields=('governorate', 'legal_form', 'company_status', 'registration_year'), name='company_stats_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='capitalstats',
+            constraint=models.UniqueConstraint(fields=('governorate', 'capital_magnitude'), name='capital_stats_unique'),
+        ),
+        migrations.RunSQL(
+            'LOCK TABLE api_company, api_person IN SHARE MODE;' + FILL_STATS,
+            migrations.RunSQL.noop),
+        migrations.RunSQL(CREATE_STATS_TRIGGERS, DROP_STATS_TRIGGERS),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.4 on 2026-10-18 20:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecrawlSchedule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('cr_id', models.CharField(max_length=128, unique=True)),
+                ('priority', models.FloatField()),
+                ('checks', models.IntegerField(default=0)),
+                ('changes', models.IntegerField(default=0)),
+                ('checked_at', models.DateTimeField(blank=True, null=True)),
+                ('next_check_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='recrawlschedule',
+            index=models.Index(fields=['next_check_at', '-priority'], name='recrawl_due_idx'),
+        ),
+    ]
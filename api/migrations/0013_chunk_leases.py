@@ -0,0 +1,33 @@
+# Generated by Django 3.1.4 on 2026-10-18 20:50
+
+from datetime import timedelta
+from django.db import migrations, models
+from django.db.models import F
+
+
+def lease_dispatched_chunks(apps, schema_editor):
+    """ Chunks dispatched before leases existed expire after CHUNK_TIMEOUT, as they used to """
+    ScrapeChunk = apps.get_model('api', 'ScrapeChunk')
+    ScrapeChunk.objects.filter(status='DI').update(
+        lease_expires_at=F('dispatched_at') + timedelta(hours=1))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_recrawl_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scrapechunk',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='scrapechunk',
+            name='lease_owner',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.RunPython(lease_dispatched_chunks, migrations.RunPython.noop),
+    ]
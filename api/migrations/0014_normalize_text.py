@@ -0,0 +1,52 @@
+from django.db import migrations
+
+
+# Same folding as normalize_text of helpers/search.py, so descriptions are
+# indexed the way queries are normalized: NFKC, Arabic diacritics dropped
+# and letter variants folded, NFKD without combining marks, Arabic digits,
+# lowercase, anything but letters and digits replaced by spaces.
+# Checked against normalize_text by api.tests.SearchNormalizationTests
+CREATE_NORMALIZE_TEXT = r"""
+CREATE OR REPLACE FUNCTION api_normalize_text(text) RETURNS text AS $$
+    SELECT btrim(regexp_replace(
+        lower(translate(regexp_replace(
+            normalize(translate(regexp_replace(
+                normalize($1, NFKC),
+                '[\u064b-\u065f\u0670\u0640]', '', 'g'),
+                'أإآٱىةؤئ', 'اااايهوي'), NFKD),
+            '[\u0300-\u036f\u0610-\u061a\u06d6-\u06dc\u06df-\u06e4\u06e7\u06e8\u06ea-\u06ed'
+            '\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]', '', 'g'),
+            '٠١٢٣٤٥٦٧٨٩', '0123456789')),
+        '[^[:alnum:]]+', ' ', 'g'))
+$$ LANGUAGE sql IMMUTABLE;
+"""
+
+# Definition of migration 0008
+RESTORE_NORMALIZE_TEXT = r"""
+CREATE OR REPLACE FUNCTION api_normalize_text(text) RETURNS text AS $$
+    SELECT translate(
+        lower(regexp_replace($1, '[\u064b-\u065f\u0670\u0640]', '', 'g')),
+        'أإآٱىةؤئàáâãäåçèéêëìíîïñòóôõöùúûüýÿ',
+        'اااايهويaaaaaaceeeeiiiinooooouuuuyy')
+$$ LANGUAGE sql IMMUTABLE;
+"""
+
+# Same expression as the api_company_search trigger, which an update of
+# search_vector alone does not fire
+UPDATE_SEARCH_VECTORS = """
+UPDATE api_company SET search_vector =
+    setweight(to_tsvector('simple', coalesce(search_name, '')), 'A') ||
+    setweight(to_tsvector('simple', api_normalize_text(coalesce(description, ''))), 'B');
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_chunk_leases'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_NORMALIZE_TEXT + UPDATE_SEARCH_VECTORS,
+                          RESTORE_NORMALIZE_TEXT + UPDATE_SEARCH_VECTORS),
+    ]
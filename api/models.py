@@ -1,3 +1,5 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
@@ -38,44 +40,310 @@ class Company(Base):
     title = models.CharField(max_length=255)
     description = models.TextField()
     missing_personnel_data = models.BooleanField(default=False)
+    # sha256 of the extracted page content, empty when personnel failed to scrape
+    fingerprint = models.CharField(max_length=64, blank=True, default='')
+    # search_key of name and additional_name (see helpers/search.py)
+    search_name = models.TextField(blank=True, default='')
+    # search_name and description, maintained by the api_company_search trigger
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
         indexes = [
             models.Index(fields=['name'], name="company_name_idx"),
+            # API filters, keyset paginated on id
+            models.Index(fields=['governorate', 'id'],
+                         name='company_governorate_idx'),
+            models.Index(fields=['legal_form', 'id'],
+                         name='company_legal_form_idx'),
+            models.Index(fields=['company_status', 'id'],
+                         name='company_status_idx'),
+            models.Index(fields=['registration_date', 'id'],
+                         name='company_reg_date_idx'),
+            GinIndex(fields=['search_name'], opclasses=['gin_trgm_ops'],
+                     name='company_search_name_idx'),
+            GinIndex(fields=['search_vector'], name='company_search_idx'),
         ]
 
     def __str__(self):
         return self.name
 
 
+class Individual(Base):
+    """
+    Canonical person behind the Person rows of every company they are in,
+    grouped by helpers/entity_resolution.py
+        - name_key: normalized name compared when matching new people
+    """
+    name = models.CharField(max_length=255)
+    nationality = models.CharField(max_length=128)
+    name_key = models.TextField()
+
+    def __str__(self):
+        return self.name
+
+
+class BlockingKey(models.Model):
+    """
+    Hashed phonetic key of an Individual's name and nationality,
+    new people are only compared with individuals sharing a key
+    """
+    key = models.CharField(max_length=32)
+    individual = models.ForeignKey(Individual, related_name='blocking_keys',
+                                   on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['key', 'individual'],
+                                    name='blocking_key_unique'),
+        ]
+
+    def __str__(self):
+        return self.key
+
+
 class Person(Base):
     name = models.CharField(max_length=255)
     company = models.ForeignKey(Company, related_name="company",
                                 on_delete=models.CASCADE)
+    # Set by resolve_individuals, null until then
+    individual = models.ForeignKey(Individual, related_name='persons',
+                                   null=True, blank=True,
+                                   on_delete=models.SET_NULL)
     nationality = models.CharField(max_length=128)
     relationship = models.CharField(max_length=128)
     stock = models.IntegerField()
     quota = models.IntegerField()
     ratio = models.IntegerField()
+    # search_key of name (see helpers/search.py)
+    search_name = models.TextField(blank=True, default='')
 
     class Meta:
         indexes = [
             models.Index(fields=['name'], name="person_name_idx"),
+            GinIndex(fields=['search_name'], opclasses=['gin_trgm_ops'],
+                     name='person_search_name_idx'),
+            # People written since the last ownership graph update
+            models.Index(fields=['updated_at'], name='person_updated_at_idx'),
         ]
 
     def __str__(self):
         return self.name
 
 
+class CompanyStats(models.Model):
+    """
+    Companies and capital per governorate, legal form, status and
+    registration year, maintained by the api_company_stats trigger
+    (see helpers/stats.py). Groups that lost all their companies keep
+    a row with companies = 0 until the next rebuild.
+    """
+    governorate = models.IntegerField(choices=Company.Governorate.choices)
+    legal_form = models.CharField(max_length=255)
+    company_status = models.CharField(max_length=255)
+    registration_year = models.IntegerField()
+    companies = models.BigIntegerField(default=0)
+    capital = models.DecimalField(max_digits=24, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['governorate', 'legal_form', 'company_status',
+                        'registration_year'],
+                name='company_stats_unique'),
+        ]
+
+    def __str__(self):
+        return (f'{self.governorate} {self.legal_form} {self.company_status} '
+                f'{self.registration_year}: {self.companies}')
+
+
+class CapitalStats(models.Model):
+    """
+    Distribution of capital per governorate, maintained by the
+    api_company_stats trigger: companies with
+    10^capital_magnitude <= capital < 10^(capital_magnitude + 1)
+    (capital below 10 counts in magnitude 0)
+    """
+    governorate = models.IntegerField(choices=Company.Governorate.choices)
+    capital_magnitude = models.IntegerField()
+    companies = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['governorate', 'capital_magnitude'],
+                                    name='capital_stats_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.governorate} 10^{self.capital_magnitude}: {self.companies}'
+
+
+class NationalityStats(models.Model):
+    """
+    Personnel per nationality and governorate of their company,
+    maintained by the api_person_stats trigger
+    """
+    governorate = models.IntegerField(choices=Company.Governorate.choices)
+    nationality = models.CharField(max_length=128)
+    persons = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['governorate', 'nationality'],
+                                    name='nationality_stats_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.governorate} {self.nationality}: {self.persons}'
+
+
+class GovernorateIdSpace(Base):
+    """
+    Largest existing cr_sub_id of a governorate, found by probing the
+    Commercial Registry (updated_at is when it was last probed)
+    """
+    governorate = models.IntegerField(
+        choices=Company.Governorate.choices, unique=True)
+    max_cr_sub_id = models.IntegerField()
+
+    def __str__(self):
+        return f'{self.get_governorate_display()}: {self.max_cr_sub_id}'
+
+
+class ScrapeCheckpoint(Base):
+    """
+    Durable crawl progress of one governorate
+        - cursor: next cr_sub_id not yet handed out in a ScrapeChunk
+        - end: exclusive end of the ids of the current crawl
+    """
+    class Status(models.TextChoices):
+        RUNNING = 'RU', _('Running')
+        COMPLETE = 'CO', _('Complete')
+
+    governorate = models.IntegerField(
+        choices=Company.Governorate.choices, unique=True)
+    cursor = models.IntegerField()
+    end = models.IntegerField()
+    refresh = models.BooleanField(default=False)
+    status = models.CharField(
+        max_length=2,
+        choices=Status.choices,
+        default=Status.RUNNING,
+    )
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.get_governorate_display()}: {self.cursor}/{self.end}'
+
+
+class ScrapeChunk(Base):
+    """
+    Range start <= cr_sub_id < end handed to one scrape_lcr_range task
+    or leased by one lease_worker (see helpers/dispatcher.py)
+        - lease_owner: worker holding a dispatched chunk
+        - lease_expires_at: when another worker may take the chunk over,
+          pushed back by the heartbeats of its owner
+    """
+    class Status(models.TextChoices):
+        PENDING = 'PE', _('Pending')
+        DISPATCHED = 'DI', _('Dispatched')
+        DONE = 'DO', _('Done')
+        FAILED = 'FA', _('Failed')
+
+    governorate = models.IntegerField(choices=Company.Governorate.choices)
+    start = models.IntegerField()
+    end = models.IntegerField()
+    status = models.CharField(
+        max_length=2,
+        choices=Status.choices,
+        default=Status.PENDING,
+    )
+    attempts = models.IntegerField(default=0)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    lease_owner = models.CharField(max_length=255, blank=True, default='')
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    stats = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['governorate', 'start'],
+                                    name='scrape_chunk_unique_start'),
+        ]
+        indexes = [
+            models.Index(fields=['governorate', 'status'],
+                         name='scrape_chunk_status_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.governorate}: {self.start}-{self.end}'
+
+
+class RecrawlSchedule(Base):
+    """
+    When the company of a cr_id is checked again (see helpers/recrawl.py)
+        - priority: value of checking it, 0 to 1, from its status,
+          registration date and change rate
+        - checks: recrawls so far, changes: how many found the page changed
+        - next_check_at: when it is due, recrawl_lcr takes due companies
+          highest priority first
+    """
+    cr_id = models.CharField(max_length=128, unique=True)
+    priority = models.FloatField()
+    checks = models.IntegerField(default=0)
+    changes = models.IntegerField(default=0)
+    checked_at = models.DateTimeField(null=True, blank=True)
+    next_check_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_check_at', '-priority'],
+                         name='recrawl_due_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.cr_id}: {self.priority:.3f}'
+
+
 class ScrapeError(Base):
+    """
+    Latest failure to scrape a cr_id, retried with exponential backoff
+    until it succeeds (and is deleted) or runs out of attempts
+    (next_retry_at is then null)
+    """
     class ModelType(models.TextChoices):
         COMPANY = 'CO', _('Company')
         PERSON = 'PE', _('Person')
         UNKNOWN = 'UK', _('Unknown')
+
+    class ErrorClass(models.TextChoices):
+        TIMEOUT = 'TO', _('Network timeout')
+        NETWORK = 'NE', _('Network error')
+        SERVER = '5X', _('HTTP 5xx')
+        HTTP = 'HT', _('Other HTTP error')
+        EMPTY = 'EM', _('Empty or nonexistent record')
+        PARSE = 'PA', _('Parse failure')
+        DATABASE = 'DB', _('Database error')
+
     cr_id = models.CharField(max_length=128, unique=True)
     model_type = models.CharField(
         max_length=2,
         choices=ModelType.choices,
         default=ModelType.UNKNOWN,
     )
+    error_class = models.CharField(
+        max_length=2,
+        choices=ErrorClass.choices,
+        default=ErrorClass.PARSE,
+    )
     error_message = models.TextField()
+    attempts = models.IntegerField(default=1)
+    next_retry_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_retry_at'],
+                         name='scrape_error_retry_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.cr_id}: {self.get_error_class_display()}'
@@ -0,0 +1,43 @@
+from api.models import Company, Individual, Person
+
+from rest_framework import serializers
+
+
+class PersonSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Person
+        fields = ('id', 'name', 'nationality', 'relationship',
+                  'stock', 'quota', 'ratio', 'individual', 'company')
+
+
+class CompanyPersonSerializer(PersonSerializer):
+    """ Person nested in its company, without the company """
+    class Meta(PersonSerializer.Meta):
+        fields = PersonSerializer.Meta.fields[:-1]
+
+
+class CompanySerializer(serializers.ModelSerializer):
+    # Person.company has related_name "company"
+    personnel = CompanyPersonSerializer(source='company', many=True,
+                                        read_only=True)
+
+    class Meta:
+        model = Company
+        fields = ('id', 'cr_id', 'source_url', 'registration_number', 'name',
+                  'additional_name', 'governorate', 'registration_date',
+                  'record_type', 'company_status', 'company_duration',
+                  'legal_form', 'capital', 'title', 'description',
+                  'missing_personnel_data', 'updated_at', 'personnel')
+
+
+class IndividualSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Individual
+        fields = ('id', 'name', 'nationality')
+
+
+class CompanySummarySerializer(serializers.ModelSerializer):
+    """ Company without its personnel """
+    class Meta:
+        model = Company
+        fields = CompanySerializer.Meta.fields[:-1]
@@ -1,35 +1,339 @@
-from api.models import Company, Person, ScrapeError
-from api.helpers.lcr_scrape import LCRScrape
+from api.models import Company, Person, ScrapeCheckpoint, ScrapeError
+from api.helpers.lcr_scrape import LCRScrape, build_cr_id, split_cr_id
+from api.helpers.lcr_fetch import fetch_ids
+from api.helpers.page_archive import get_page_archive
+from api.helpers.rate_limit import get_rate_limiter
+from api.helpers.id_discovery import DiscoveryError, discover_id_space, get_max_cr_sub_id
+from api.helpers.dispatcher import (start_crawl, dispatch_chunks, get_dispatch_loop,
+                                    complete_chunk, fail_chunk, LeaseHeartbeat)
+from api.helpers.scrape_errors import clear_scrape_errors
+from api.helpers.bulk_writer import BulkWriter
+from api.helpers.metrics import PAGES_TOTAL, get_metrics
+from api.helpers.entity_resolution import resolve_individuals
+from api.helpers.pipeline import ScrapePipeline, get_parse_pool
+from api.helpers.coverage import FAILED, SCRAPED, error_state, get_coverage_index
+from api.helpers.recrawl import get_recrawl_fingerprints, plan_recrawl, schedule_checks
 from api import constants
 
 from celery import shared_task
+from celery.utils.log import get_task_logger
 from bs4 import BeautifulSoup
 from datetime import datetime
 from decimal import Decimal
+from django.utils import timezone
 from django.utils.timezone import make_aware
+import itertools
 import requests
 import time
 
 
+logger = get_task_logger(__name__)
+
+
 @shared_task
-def scrape_lcr():
-    governorates = Company.Governorate
-    for gov in governorates:
-        if gov == governorates.BEIRUT or gov == governorates.MOUNT_LEBANON:
-            continue
-        scrape_count = 0
-        keep_scraping = True
-        cr_sub_id = get_initial_cr_sub_id(gov)
-        while(keep_scraping):
-            if scrape_count % constants.REQUEST_LIMIT == 0:
-                time.sleep(1)  # So we don't overload the Lebanon CR server
-            cr_sub_id += 1
-            run_scrape.delay(cr_sub_id, gov)
-            scrape_count += 1
-            if scrape_count % 500 == 0:
-                # Attempt to not overload our free Heroku redis server
-                time.sleep(60)
-            keep_scraping = scrape_count < constants.GOVERNORATE_SCRAPE_LIMIT[gov]
+def scrape_lcr(refresh=False):
+    """
+    Starts a crawl of every governorate (see start_crawls), all of them
+    in parallel, and hands them over to dispatch_scrape
+    """
+    start_crawls(refresh)
+    dispatch_scrape.delay()
+
+
+@shared_task
+def dispatch_scrape(token=None):
+    """
+    Enqueues the next chunks of every running crawl in one short pass,
+    then schedules itself again while any crawl is running
+    instead of sleeping in the worker
+        - token: the loop's, see DispatchLoop. Without one a new loop only
+          starts when none is running, so calling scrape_lcr again does
+          not start a second loop
+        - A governorate failing to dispatch is logged and dispatched again
+          on the next pass, without holding up the others
+    """
+    loop = get_dispatch_loop()
+    if token is None:
+        token = loop.start()
+        if token is None:
+            return  # Another loop is running
+    elif not loop.renew(token):
+        return  # Replaced by a newer loop while this one was held up
+    keep_running = True
+    try:
+        running = ScrapeCheckpoint.objects.filter(status=ScrapeCheckpoint.Status.RUNNING)
+        for gov, refresh in running.values_list('governorate', 'refresh'):
+            try:
+                for chunk in dispatch_chunks(gov):
+                    scrape_lcr_range.delay(gov, chunk.start, chunk.end, refresh, chunk.id)
+            except Exception:
+                logger.exception('Dispatching governorate %s failed', gov)
+        keep_running = running.exists()
+    finally:
+        if keep_running:
+            dispatch_scrape.apply_async((token,), countdown=constants.DISPATCH_INTERVAL)
+        else:
+            loop.stop(token)
+            if running.exists():
+                dispatch_scrape.delay()  # Started after the check above, when this loop still ran
+
+
+@shared_task
+def scrape_lcr_range(gov, start, end, refresh=False, chunk_id=None, owner=None):
+    """
+    Scrapes cr_sub_ids start <= id < end of one governorate in a single task
+        - Every page is fetched over one pooled HTTP session
+        - Every write goes through this worker's one DB connection
+        - refresh: companies whose page fingerprint did not change are not written
+        - chunk_id: ScrapeChunk marked done (or failed) at the end
+        - owner: lease_worker holding the chunk's lease, kept alive
+          by heartbeats while scraping. Once another worker took the
+          chunk over, no more ids are fetched and the chunk is left to it
+          (lease_lost is set in the stats).
+    Returns the stats of the range
+    """
+    lease_lost = False
+    try:
+        if owner is not None:
+            with LeaseHeartbeat(chunk_id, owner) as heartbeat:
+                stats = scrape_range(gov, start, end, refresh, stopped=heartbeat.is_lost)
+            lease_lost = stats['lease_lost'] = heartbeat.lost
+        else:
+            stats = scrape_range(gov, start, end, refresh)
+    except Exception:
+        if chunk_id is not None:
+            fail_chunk(chunk_id, owner)
+        raise
+    if chunk_id is not None and not lease_lost:
+        complete_chunk(chunk_id, stats)
+    if stats['scraped']:
+        resolve_lcr_individuals.delay()
+    return stats
+
+
+def scrape_range(gov, start, end, refresh=False, pipeline=None, skip_covered=True,
+                 stopped=None):
+    """
+    Body of scrape_lcr_range, returns the stats of the range
+        - pipeline: ScrapePipeline scraping pages while the next ones are
+          fetched and parsed, by default when SCRAPE_PIPELINE is set
+          (its stage stats are added to the range's). Without it every
+          page is fetched first, then scraped.
+        - skip_covered: ids the coverage index holds as fresh, missing or
+          failed are not fetched (counted as skipped)
+        - stopped: function checked before every request, once it returns
+          True no more ids are fetched (the pages already fetched are
+          still written)
+    """
+    stats = {
+        'governorate': gov,
+        'start': start,
+        'end': end,
+        'scraped': 0,
+        'unchanged': 0,
+        'fetch_errors': 0,
+        'scrape_errors': 0,
+        'skipped': 0,
+    }
+    started = time.monotonic()
+    if skip_covered:
+        cr_sub_ids = get_coverage_index().uncovered(gov, start, end).tolist()
+    else:
+        cr_sub_ids = range(start, end)
+    stats['skipped'] = end - start - len(cr_sub_ids)
+    fingerprints = get_stored_fingerprints(gov, start, end) if refresh else {}
+    scrape_ids(gov, cr_sub_ids, stats, refresh, fingerprints, pipeline, stopped)
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    return stats
+
+
+def scrape_ids(gov, cr_sub_ids, stats, refresh=False, fingerprints=None, pipeline=None,
+               stopped=None):
+    """
+    Fetches and scrapes cr_sub_ids of one governorate, counting outcomes
+    in stats (see scrape_range for refresh, pipeline and stopped)
+    """
+    # Workers share one adaptive rate limit, so we don't overload the Lebanon CR server
+    limiter = get_rate_limiter()
+    if pipeline is None and constants.SCRAPE_PIPELINE:
+        pipeline = ScrapePipeline(get_parse_pool(), limiter=limiter)
+    ids = [(gov, cr_sub_id) for cr_sub_id in cr_sub_ids]
+    if stopped is not None:
+        # Fetchers take ids as they send requests
+        ids = itertools.takewhile(lambda _: not stopped(), ids)
+    if pipeline is None:
+        results = fetch_ids(ids, limiter=limiter)
+        archive_results(results)
+    else:
+        results = stream_archived(pipeline.stream(ids))
+    scrape_results(results, stats, refresh, fingerprints)
+    if pipeline is not None:
+        stats['stages'] = pipeline.stats
+    return stats
+
+
+def scrape_results(results, stats, refresh=False, fingerprints=None, record=True):
+    """
+    Scrapes fetched pages and writes them through one BulkWriter,
+    counting outcomes in stats (see scrape_range)
+        - results: FetchResults, or results with a `parsed` ParsedPage
+          of their content (see helpers/pipeline.py)
+        - fingerprints: {cr_sub_id: stored fingerprint} for refresh
+        - record: outcomes are recorded in the coverage index, and the
+          next check of every company found is scheduled
+    """
+    fingerprints = fingerprints or {}
+    outcomes = []  # (governorate, cr_sub_id, cr_id, stats key, coverage state)
+    with BulkWriter() as writer:
+        for result in results:
+            scrape = LCRScrape(result.cr_sub_id, result.governorate, refresh=refresh,
+                               stored_fingerprint=fingerprints.get(result.cr_sub_id, ''),
+                               writer=writer)
+            try:
+                scrape.extract_data(result.content, result.error,
+                                    getattr(result, 'parsed', None))
+            except Exception as e:
+                # Already recorded as a ScrapeError
+                outcome = 'fetch_errors' if result.error is not None else 'scrape_errors'
+                state = error_state(e)
+            else:
+                outcome = 'scraped' if scrape.changed else 'unchanged'
+                state = SCRAPED
+            outcomes.append((result.governorate, result.cr_sub_id, scrape.cr_id, outcome, state))
+    metrics = get_metrics()
+    succeeded = set()
+    coverage = {}
+    checks = {}  # {cr_id: whether the page changed}
+    for gov, cr_sub_id, cr_id, outcome, state in outcomes:
+        if cr_id in writer.failed:
+            outcome, state = 'scrape_errors', FAILED
+        elif outcome in ('scraped', 'unchanged'):
+            succeeded.add(cr_id)
+        stats[outcome] += 1
+        metrics.increment(PAGES_TOTAL, governorate=gov, outcome=outcome)
+        coverage[(gov, cr_sub_id)] = state
+        if state != FAILED:
+            # A stored company gone from the registry is checked less and less
+            checks[cr_id] = outcome == 'scraped'
+    clear_scrape_errors(succeeded)
+    if record:
+        get_coverage_index().record(coverage)
+        schedule_checks(checks, refresh)
+    return stats
+
+
+@shared_task
+def retry_scrape_errors(batch_size=constants.RETRY_BATCH_SIZE):
+    """
+    Scrapes again the ScrapeErrors that are due for a retry
+        - Successes delete their ScrapeError
+        - Failures count an attempt and back off further
+    Runs again right away while a full batch was due
+    """
+    due = list(ScrapeError.objects.filter(
+        next_retry_at__lte=timezone.now()
+    ).order_by('next_retry_at').values_list('cr_id', flat=True)[:batch_size])
+    stats = {'retried': len(due), 'succeeded': 0}
+    if not due:
+        return stats
+    results = fetch_ids([split_cr_id(cr_id) for cr_id in due],
+                        limiter=get_rate_limiter())
+    archive_results(results)
+    succeeded = []
+    coverage = {}
+    with BulkWriter() as writer:
+        for result in results:
+            scrape = LCRScrape(result.cr_sub_id, result.governorate, writer=writer)
+            try:
+                scrape.extract_data(result.content, result.error)
+            except Exception as e:
+                # Attempt recorded on the ScrapeError
+                coverage[(result.governorate, result.cr_sub_id)] = error_state(e)
+                continue
+            succeeded.append(scrape.cr_id)
+            coverage[(result.governorate, result.cr_sub_id)] = SCRAPED
+    for cr_id in writer.failed:
+        coverage[split_cr_id(cr_id)] = FAILED
+    succeeded = set(succeeded) - writer.failed
+    clear_scrape_errors(succeeded)
+    get_coverage_index().record(coverage)
+    schedule_checks(dict.fromkeys(succeeded, True), refresh=False)
+    stats['succeeded'] = len(succeeded)
+    if succeeded:
+        resolve_lcr_individuals.delay()
+    if len(due) == batch_size:
+        retry_scrape_errors.delay(batch_size)
+    return stats
+
+
+@shared_task
+def recrawl_lcr():
+    """
+    Checks known companies again for changes, spending this pass's share
+    of RECRAWL_DAILY_BUDGET highest value first (see helpers/recrawl.py):
+    new ids past the end of every governorate, then due companies by
+    priority. Sent by celery beat every RECRAWL_INTERVAL (the
+    schedule_recrawls command schedules the companies scraped before).
+    """
+    planned = plan_recrawl()
+    for gov, cr_sub_ids in planned.items():
+        for index in range(0, len(cr_sub_ids), constants.SCRAPE_BATCH_SIZE):
+            scrape_lcr_ids.delay(gov, cr_sub_ids[index:index + constants.SCRAPE_BATCH_SIZE])
+    return {gov: len(cr_sub_ids) for gov, cr_sub_ids in planned.items()}
+
+
+@shared_task
+def scrape_lcr_ids(gov, cr_sub_ids):
+    """
+    Checks cr_sub_ids of one governorate again whatever the coverage index
+    holds, only writing the companies whose page changed
+    Returns the stats of the ids
+    """
+    stats = {
+        'governorate': gov,
+        'ids': len(cr_sub_ids),
+        'scraped': 0,
+        'unchanged': 0,
+        'fetch_errors': 0,
+        'scrape_errors': 0,
+    }
+    started = time.monotonic()
+    scrape_ids(gov, cr_sub_ids, stats, refresh=True,
+               fingerprints=get_recrawl_fingerprints(gov, cr_sub_ids))
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    if stats['scraped']:
+        resolve_lcr_individuals.delay()
+    return stats
+
+
+@shared_task
+def resolve_lcr_individuals():
+    """
+    Groups the people written since the last run into individuals,
+    queued after every scraped range (a run queued while another one
+    is running returns right away). The web processes merge them into
+    their ownership graph (see get_ownership_graph).
+    """
+    return resolve_individuals()
+
+
+@shared_task
+def discover_lcr_id_space():
+    """
+    Probes and records where the id space of every governorate ends,
+    run before scrape_lcr so it picks up new registrations.
+    Each governorate is recorded as soon as it is probed, one whose probes
+    fail keeps its previous bound without stopping the others.
+    """
+    discovered = {}
+    for gov in Company.Governorate:
+        try:
+            discovered[gov.value] = discover_id_space(gov.value, limiter=get_rate_limiter())
+        except DiscoveryError as e:
+            logger.warning('Id space discovery of %s failed: %s', gov.label, e)
+        except Exception:
+            logger.exception('Id space discovery of %s failed', gov.label)
+    return discovered
 
 
 @shared_task
@@ -45,3 +349,75 @@ def get_initial_cr_sub_id(gov):
     except Company.DoesNotExist:
         return 0  # First company ever scraped!
     return last_company.cr_sub_id
+
+
+def start_crawls(refresh=False):
+    """
+    Starts a crawl of every governorate but Beirut and Mount Lebanon,
+    which are not scraped
+        - A governorate whose crawl is still running resumes from its checkpoint
+        - A new crawl starts where the previous one ended
+        - refresh: also re-check the already scraped ids,
+          rewriting only the companies whose page changed
+    """
+    governorates = Company.Governorate
+    for gov in governorates:
+        if gov == governorates.BEIRUT or gov == governorates.MOUNT_LEBANON:
+            continue
+        start = 1 if refresh else get_resume_cr_sub_id(gov)
+        start_crawl(gov, start, get_scrape_end(gov, start), refresh)
+
+
+def get_resume_cr_sub_id(gov):
+    """
+    First id of a new crawl: where the previous crawl ended,
+    or past the last scraped company when there never was one
+    """
+    checkpoint = ScrapeCheckpoint.objects.filter(governorate=gov).first()
+    if checkpoint is not None:
+        return checkpoint.end
+    return get_initial_cr_sub_id(gov) + 1
+
+
+def get_scrape_end(gov, resume):
+    """
+    Exclusive end of the ids to scrape: the probed end of the id space,
+    or GOVERNORATE_SCRAPE_LIMIT ids past resume when it was never probed
+    """
+    max_cr_sub_id = get_max_cr_sub_id(gov)
+    if max_cr_sub_id is None:
+        return resume + constants.GOVERNORATE_SCRAPE_LIMIT[gov]
+    return max_cr_sub_id + 1
+
+
+def archive_results(results):
+    """ Stores fetched pages in the page archive, when archiving is enabled """
+    archive = get_page_archive()
+    if archive is not None:
+        archive.put_many(
+            (build_cr_id(result.governorate, result.cr_sub_id), result.content, None)
+            for result in results if result.content is not None)
+
+
+def stream_archived(results):
+    """
+    Yields results as they come, storing their pages in the page archive
+    SCRAPE_BATCH_SIZE at a time
+    """
+    batch = []
+    try:
+        for result in results:
+            yield result
+            batch.append(result)
+            if len(batch) == constants.SCRAPE_BATCH_SIZE:
+                archive_results(batch)
+                batch = []
+    finally:
+        archive_results(batch)
+
+
+def get_stored_fingerprints(gov, start, end):
+    """ {cr_sub_id: fingerprint} of stored companies in a range, in one query """
+    return dict(Company.objects.filter(
+        governorate=gov, cr_sub_id__gte=start, cr_sub_id__lt=end
+    ).values_list('cr_sub_id', 'fingerprint'))
@@ -1,3 +1,1408 @@
-from django.test import TestCase
+from api.models import (Company, GovernorateIdSpace, Individual, Person, RecrawlSchedule,
+                        ScrapeCheckpoint, ScrapeChunk, ScrapeError)
+from api.helpers import (coverage, dispatcher, metrics, ownership_graph, pipeline, recrawl,
+                         snapshot)
+from api.helpers.benchmark import run_benchmarks
+from api.helpers.bulk_writer import BulkWriter
+from api.helpers.dispatcher import dispatch_chunks, start_crawl
+from api.helpers.entity_resolution import (blocking_keys, name_similarity, name_tokens,
+                                           resolve_individuals)
+from api.helpers.id_discovery import DiscoveryError, discover_id_space, find_upper_bound
+from api.helpers.lcr_fetch import FetchResult
+from api.helpers.lcr_parse import EmptyPageError, LCRPage, page_fingerprint, parse_page
+from api.helpers.lcr_scrape import build_cr_id
+from api.helpers.lcr_writer import replace_personnel, upsert_companies
+from api.helpers.search import latin_skeleton, normalize_text, search_key
+from api.helpers.stats import check_stats, rebuild_stats, summarize_stats
+from api.helpers.synthetic_registry import SyntheticRegistry
+from api.helpers.scrape_errors import classify_error, get_retry_delay, record_scrape_error
+from api.admin import CompanyAdmin
+from api.tasks import (discover_lcr_id_space, dispatch_scrape, recrawl_lcr, scrape_lcr,
+                       scrape_lcr_range)
+from api.views import ExportThrottle
+from api import views
+from api import constants
 
-# Create your tests here.
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.db.models import F
+from django.test import (RequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.utils import timezone
+from unittest import mock, skipUnless
+import aiohttp
+import asyncio
+import json
+import os
+import requests
+import tempfile
+import threading
+import time
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None  # Tests of the Redis backed helpers are skipped
+
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'benchmarks', 'pages')
+
+
+def read_page(name):
+    with open(os.path.join(CORPUS_DIR, f'{name}.html'), 'rb') as page:
+        return page.read()
+
+
+def build_page(company=None, personnel=None):
+    """
+    Minimal result.aspx page
+        - company: {span id suffix: text}, the DataList1_LabelN_0 spans
+        - personnel: rows of (name, nationality, relationship, stock, quota, ratio),
+          None for a page without personnel table
+    """
+    spans = ''.join(f'<span id="DataList1_Label{label}_0">{text}</span>'
+                    for label, text in (company or {}).items())
+    table = ''
+    if personnel is not None:
+        table = '<table><tr id="Relations_ListView_Tr1"><th></th></tr>'
+        for index, row in enumerate(personnel):
+            table += '<tr>' + ''.join(
+                f'<td><span id="Relations_ListView_{field}_{index}">{value}</span></td>'
+                for field, value in zip(('desigLabel', 'countryLabel', 'relLabel',
+                                         'a_valLabel', 's_valLabel', 'r_valLabel'), row)
+            ) + '</tr>'
+        table += '</table>'
+    return f'<html><body>{spans}{table}</body></html>'.encode('utf-8')
+
+
+COMPANY_SPANS = {
+    1: '100', 2: 'Company', 3: '', 5: '3/14/2004 12:00:00 AM', 6: 'Main', 7: 'Active',
+    8: '', 9: 'SAL', 10: '30000000', 11: 'Beirut', 12: 'Trade',
+}
+
+
+class LCRPageTests(SimpleTestCase):
+
+    def test_company_record(self):
+        record = LCRPage(read_page('typical')).company_record()
+        self.assertEqual(record['registration_number'], '12345')
+        self.assertEqual(record['capital'], Decimal('30000000'))
+        self.assertEqual(record['registration_date'], datetime(2004, 3, 14))
+        self.assertFalse(record['missing_personnel_data'])
+
+    def test_personnel_records(self):
+        personnel = LCRPage(read_page('small')).personnel_records()
+        self.assertEqual(personnel, [{
+            'name': 'إيلي جورج عون', 'nationality': 'فرنسا',
+            'relationship': 'رئيس مجلس الادارة', 'stock': 405, 'quota': 0, 'ratio': 0,
+        }])
+
+    def test_repeated_person_is_merged(self):
+        page = LCRPage(build_page(COMPANY_SPANS, [
+            ('A', 'Lebanon', 'Partner', '0', '10', '0'),
+            ('B', 'France', 'Manager', '0', '0', '0'),
+            ('A', 'Lebanon', 'Manager', '5', '20', '50'),
+        ]))
+        self.assertEqual(page.personnel_records(), [
+            {'name': 'A', 'nationality': 'Lebanon', 'relationship': 'Partner \\ Manager',
+             'stock': 5, 'quota': 10, 'ratio': 50},
+            {'name': 'B', 'nationality': 'France', 'relationship': 'Manager',
+             'stock': 0, 'quota': 0, 'ratio': 0},
+        ])
+
+    def test_without_personnel_table(self):
+        page = LCRPage(read_page('no_personnel'))
+        self.assertTrue(page.company_record()['missing_personnel_data'])
+        self.assertEqual(page.personnel_records(), [])
+
+    def test_empty_page(self):
+        page = LCRPage(read_page('empty'))
+        self.assertTrue(page.is_empty())
+        with self.assertRaises(EmptyPageError):
+            page.company_record()
+
+    def test_legacy_encoding(self):
+        record = LCRPage(read_page('legacy_encoding')).company_record()
+        self.assertEqual(record['name'], 'شركة المثال للتجارة ش.م.ل')
+
+    def test_str_content(self):
+        page = LCRPage(build_page(COMPANY_SPANS).decode('utf-8'))
+        self.assertEqual(page.company_record()['name'], 'Company')
+
+
+class ParsePageTests(SimpleTestCase):
+
+    def test_parsed(self):
+        parsed = parse_page(read_page('large'))
+        self.assertIsNone(parsed.error)
+        self.assertEqual(parsed.company_record['registration_number'], '7002')
+        self.assertEqual(len(parsed.personnel_records), 321)
+
+    def test_without_personnel_table(self):
+        parsed = parse_page(read_page('no_personnel'))
+        self.assertIsNone(parsed.error)
+        self.assertIsNone(parsed.personnel_records)
+
+    def test_errors_are_returned_with_their_stage(self):
+        parsed = parse_page(read_page('empty'))
+        self.assertEqual(parsed.error_stage, 'company')
+        self.assertIsInstance(parsed.error, EmptyPageError)
+
+        parsed = parse_page(read_page('malformed'))
+        self.assertEqual(parsed.error_stage, 'company')
+        self.assertIsInstance(parsed.error, ValueError)
+        self.assertIsNone(parsed.company_record)
+
+    def test_personnel_error_keeps_company_record(self):
+        parsed = parse_page(build_page(COMPANY_SPANS, [('A', 'Lebanon', 'Partner', 'x', '0', '0')]))
+        self.assertEqual(parsed.error_stage, 'personnel')
+        self.assertEqual(parsed.company_record['name'], 'Company')
+        self.assertIsNone(parsed.personnel_records)
+
+
+def build_company(cr_sub_id, gov=1, **fields):
+    """ Unsaved Company with placeholder values """
+    cr_id = build_cr_id(gov, cr_sub_id)
+    values = dict(
+        cr_id=cr_id, cr_sub_id=cr_sub_id, source_url=f'http://registry/?id={cr_id}',
+        registration_number=cr_sub_id, name=f'Company {cr_sub_id}', additional_name='',
+        governorate=gov, registration_date=timezone.now(), record_type='Main',
+        company_status='Active', company_duration='', legal_form='SAL', capital=1000,
+        title='', description='')
+    values.update(fields)
+    return Company(**values)
+
+
+def build_person(name, nationality='Lebanon', **fields):
+    """ Unsaved Person with placeholder values """
+    values = dict(name=name, nationality=nationality, relationship='Partner',
+                  stock=0, quota=0, ratio=0)
+    values.update(fields)
+    return Person(**values)
+
+
+class PageFingerprintTests(SimpleTestCase):
+
+    def test_markup_does_not_change_it(self):
+        first = LCRPage(build_page(COMPANY_SPANS, [('A', 'Lebanon', 'Partner', '1', '0', '0')]))
+        second = LCRPage(build_page(COMPANY_SPANS, [('A', 'Lebanon', 'Partner', '1', '0', '0')])
+                         .replace(b'<body>', b'<body><div class="banner">Notice</div>'))
+        self.assertEqual(
+            page_fingerprint(first.company_record(), first.personnel_records()),
+            page_fingerprint(second.company_record(), second.personnel_records()))
+
+    def test_data_changes_it(self):
+        record = LCRPage(build_page(COMPANY_SPANS)).company_record()
+        personnel = [{'name': 'A', 'stock': 1}]
+        fingerprint = page_fingerprint(record, personnel)
+        self.assertNotEqual(fingerprint, page_fingerprint(record, [{'name': 'A', 'stock': 2}]))
+        self.assertNotEqual(fingerprint, page_fingerprint(dict(record, capital=Decimal(1)),
+                                                          personnel))
+
+
+class UpsertCompaniesTests(TestCase):
+
+    def test_inserts_and_updates_in_place(self):
+        upsert_companies([build_company(1)])
+        stored = Company.objects.get(cr_sub_id=1)
+
+        company = build_company(1, name='Renamed')
+        upsert_companies([company, build_company(2)])
+        self.assertEqual(company.pk, stored.pk)
+        renamed = Company.objects.get(pk=stored.pk)
+        self.assertEqual(renamed.name, 'Renamed')
+        self.assertEqual(renamed.created_at, stored.created_at)
+        self.assertEqual(Company.objects.count(), 2)
+
+    def test_last_duplicate_wins(self):
+        upsert_companies([build_company(1, name='First'), build_company(1, name='Last')])
+        self.assertEqual(Company.objects.get().name, 'Last')
+
+
+class ReplacePersonnelTests(TestCase):
+
+    def setUp(self):
+        self.company = build_company(1)
+        upsert_companies([self.company])
+        self.individual = Individual.objects.create(name='A', nationality='Lebanon', name_key='a')
+
+    def test_keeps_individual_of_same_person(self):
+        company = self.company
+        replace_personnel({company.id: [
+            build_person('A', company=company, individual=self.individual),
+            build_person('B', company=company)]})
+        replace_personnel({company.id: [
+            build_person('A', company=company, stock=10), build_person('B', company=company),
+            build_person('A', 'France', company=company)]})
+        people = {(person.name, person.nationality): person
+                  for person in Person.objects.filter(company=self.company)}
+        self.assertEqual(len(people), 3)
+        self.assertEqual(people['A', 'Lebanon'].individual, self.individual)
+        self.assertEqual(people['A', 'Lebanon'].stock, 10)
+        self.assertIsNone(people['B', 'Lebanon'].individual)
+        self.assertIsNone(people['A', 'France'].individual)
+
+    def test_bulk_writer_keeps_individual_of_same_person(self):
+        Person.objects.create(company=self.company, name='A', nationality='Lebanon',
+                              relationship='Partner', stock=0, quota=0, ratio=0,
+                              individual=self.individual)
+        with BulkWriter() as writer:
+            writer.add(build_company(1), [build_person('A', stock=10), build_person('B')])
+        people = {person.name: person for person in Person.objects.filter(company=self.company)}
+        self.assertEqual(people['A'].individual, self.individual)
+        self.assertEqual(people['A'].stock, 10)
+        self.assertIsNone(people['B'].individual)
+
+
+class FakeFetcher:
+    """ Stands in for LCRFetcher, answering for a registry holding the existing ids """
+
+    def __init__(self, existing=(), failing=()):
+        self.existing = set(existing)
+        self.failing = set(failing)
+        self.requests = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def fetch_range(self, gov, start, end):
+        for cr_sub_id in range(start, end):
+            self.requests += 1
+            if cr_sub_id in self.failing:
+                yield FetchResult(gov, cr_sub_id, None, OSError('Connection reset'))
+            elif cr_sub_id in self.existing:
+                yield FetchResult(gov, cr_sub_id, build_page(COMPANY_SPANS), None)
+            else:
+                yield FetchResult(gov, cr_sub_id, build_page(), None)
+
+    async def fetch_many(self, ids):
+        for gov, cr_sub_id in ids:
+            async for result in self.fetch_range(gov, cr_sub_id, cr_sub_id + 1):
+                yield result
+
+
+class IdDiscoveryTests(TestCase):
+
+    def test_gaps_shorter_than_tolerance_are_crossed(self):
+        fetcher = FakeFetcher(cr_sub_id for cr_sub_id in range(1, 12346) if cr_sub_id % 40)
+        bound = asyncio.run(find_upper_bound(fetcher, 1, 0, gap_tolerance=50, initial_step=1000))
+        self.assertEqual(bound, 12345)
+        self.assertLess(fetcher.requests, 2000)
+
+    def test_longer_gap_ends_the_id_space(self):
+        fetcher = FakeFetcher(list(range(1, 300)) + list(range(1000, 1100)))
+        bound = asyncio.run(find_upper_bound(fetcher, 1, 0, gap_tolerance=50, initial_step=100))
+        self.assertEqual(bound, 299)
+
+    def test_bound_below_first_step(self):
+        fetcher = FakeFetcher(range(1, 30))
+        bound = asyncio.run(find_upper_bound(fetcher, 1, 0, gap_tolerance=50, initial_step=1000))
+        self.assertEqual(bound, 29)
+
+    def test_failed_probe_raises(self):
+        fetcher = FakeFetcher(range(1, 3000), failing=[1010])
+        with self.assertRaises(DiscoveryError):
+            asyncio.run(find_upper_bound(fetcher, 1, 0, gap_tolerance=50, initial_step=1000))
+
+    def test_discover_id_space_records_the_bound(self):
+        upsert_companies([build_company(2000)])
+        fetcher = FakeFetcher(range(1, 2500))
+        with mock.patch('api.helpers.id_discovery.LCRFetcher', return_value=fetcher):
+            self.assertEqual(discover_id_space(1), 2499)
+        self.assertEqual(GovernorateIdSpace.objects.get(governorate=1).max_cr_sub_id, 2499)
+
+    def test_failed_governorate_does_not_stop_the_others(self):
+        def discover(gov, **kwargs):
+            if gov == 2:
+                raise DiscoveryError('Probe failed')
+            GovernorateIdSpace.objects.update_or_create(
+                governorate=gov, defaults={'max_cr_sub_id': gov * 100})
+            return gov * 100
+
+        with mock.patch('api.tasks.discover_id_space', side_effect=discover), \
+                mock.patch('api.tasks.get_rate_limiter'):
+            discovered = discover_lcr_id_space()
+        expected = {gov: gov * 100 for gov in Company.Governorate.values if gov != 2}
+        self.assertEqual(discovered, expected)
+        self.assertEqual(dict(GovernorateIdSpace.objects.values_list(
+            'governorate', 'max_cr_sub_id')), expected)
+
+
+class RedisMixin:
+    """ The Redis backed helpers of the process share an empty fakeredis """
+
+    def setUp(self):
+        super().setUp()
+        self.redis = fakeredis.FakeRedis()
+        for module, name, helper in (
+                (coverage, '_coverage_index', coverage.CoverageIndex),
+                (dispatcher, '_dispatch_loop', dispatcher.DispatchLoop),
+                (recrawl, '_recrawl_budget', recrawl.RecrawlBudget),
+                (metrics, '_metrics', metrics.MetricsRecorder)):
+            patcher = mock.patch.object(module, name, helper(self.redis))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+@skipUnless(fakeredis, 'Requires fakeredis (pip install fakeredis)')
+class RedisTestCase(RedisMixin, TestCase):
+    pass
+
+
+@mock.patch.object(constants, 'SCRAPE_BATCH_SIZE', 500)
+class DispatcherTests(RedisTestCase):
+
+    def chunk_ranges(self, gov=3):
+        return list(ScrapeChunk.objects.filter(governorate=gov).order_by('start').values_list(
+            'start', 'end', 'status'))
+
+    def test_chunks_are_cut_from_the_cursor(self):
+        start_crawl(3, 1, 1201)
+        self.assertEqual([(chunk.start, chunk.end) for chunk in dispatch_chunks(3)],
+                         [(1, 501), (501, 1001), (1001, 1201)])
+        self.assertEqual(ScrapeCheckpoint.objects.get(governorate=3).cursor, 1201)
+        self.assertEqual(dispatch_chunks(3), [])
+
+    def test_covered_ids_are_not_cut(self):
+        coverage.get_coverage_index().record(
+            {(3, cr_sub_id): coverage.SCRAPED for cr_sub_id in range(1, 701)})
+        start_crawl(3, 1, 1501)
+        self.assertEqual([(chunk.start, chunk.end) for chunk in dispatch_chunks(3)],
+                         [(701, 1201), (1201, 1501)])
+
+    def test_crawl_completes_once_every_chunk_is_done(self):
+        start_crawl(3, 1, 1001)
+        for chunk in dispatch_chunks(3):
+            dispatcher.complete_chunk(chunk.id, {})
+        self.assertEqual(dispatch_chunks(3), [])
+        checkpoint = ScrapeCheckpoint.objects.get(governorate=3)
+        self.assertEqual(checkpoint.status, ScrapeCheckpoint.Status.COMPLETE)
+
+    def test_failed_chunk_is_dispatched_again(self):
+        start_crawl(3, 1, 1001)
+        first, second = dispatch_chunks(3)
+        dispatcher.complete_chunk(first.id, {})
+        dispatcher.fail_chunk(second.id)
+        self.assertEqual([chunk.id for chunk in dispatch_chunks(3)], [second.id])
+
+    def test_carried_chunk_is_not_cut_again(self):
+        # [501, 1001) fails out of its attempts, a refresh crawl covers it again
+        start_crawl(3, 1, 1501)
+        for chunk in dispatch_chunks(3):
+            if chunk.start == 501:
+                ScrapeChunk.objects.filter(id=chunk.id).update(
+                    status=ScrapeChunk.Status.FAILED, attempts=constants.CHUNK_MAX_ATTEMPTS)
+            else:
+                dispatcher.complete_chunk(chunk.id, {})
+        dispatch_chunks(3)
+        self.assertEqual(ScrapeCheckpoint.objects.get(governorate=3).status,
+                         ScrapeCheckpoint.Status.COMPLETE)
+
+        start_crawl(3, 1, 2001, refresh=True)
+        dispatched = dispatch_chunks(3)
+        self.assertEqual(self.chunk_ranges(), [
+            (1, 501, ScrapeChunk.Status.DISPATCHED), (501, 1001, ScrapeChunk.Status.DISPATCHED),
+            (1001, 1501, ScrapeChunk.Status.DISPATCHED), (1501, 2001, ScrapeChunk.Status.DISPATCHED),
+        ])
+        self.assertEqual(len(dispatched), 4)
+
+    def test_chunk_ends_where_a_carried_chunk_starts(self):
+        ScrapeChunk.objects.create(governorate=3, start=301, end=801,
+                                   status=ScrapeChunk.Status.FAILED)
+        start_crawl(3, 1, 1001)
+        dispatch_chunks(3)
+        self.assertEqual([(start, end) for start, end, _ in self.chunk_ranges()],
+                         [(1, 301), (301, 801), (801, 1001)])
+
+
+@mock.patch('api.tasks.scrape_lcr_range')
+@mock.patch.object(dispatch_scrape, 'apply_async')
+class DispatchScrapeTests(RedisTestCase):
+
+    def test_failing_governorate_does_not_stop_the_others(self, apply_async, scrape_lcr_range):
+        start_crawl(3, 1, 101)
+        start_crawl(4, 1, 101)
+
+        def dispatch(gov):
+            if gov == 3:
+                raise ValueError('Dispatch failed')
+            return dispatch_chunks(gov)
+
+        with mock.patch('api.tasks.dispatch_chunks', side_effect=dispatch):
+            dispatch_scrape()
+        scrape_lcr_range.delay.assert_called_once()
+        self.assertEqual(scrape_lcr_range.delay.call_args[0][:3], (4, 1, 101))
+        apply_async.assert_called_once()
+
+    def test_loop_is_rescheduled_when_the_pass_fails(self, apply_async, scrape_lcr_range):
+        start_crawl(3, 1, 101)
+        with mock.patch('api.tasks.ScrapeCheckpoint.objects.filter',
+                        side_effect=DatabaseError('Connection lost')):
+            with self.assertRaises(DatabaseError):
+                dispatch_scrape()
+        apply_async.assert_called_once()
+
+    def test_only_one_loop_runs(self, apply_async, scrape_lcr_range):
+        start_crawl(3, 1, 101)
+        dispatch_scrape()
+        token = apply_async.call_args[0][0][0]
+        dispatch_scrape()
+        self.assertEqual(apply_async.call_count, 1)
+
+        dispatch_scrape(token)
+        self.assertEqual(apply_async.call_count, 2)
+
+    def test_replaced_loop_stops(self, apply_async, scrape_lcr_range):
+        start_crawl(3, 1, 101)
+        dispatch_scrape()
+        token = apply_async.call_args[0][0][0]
+        self.redis.delete(dispatcher.DispatchLoop.KEY)  # Held up past DISPATCH_LOOP_TIMEOUT
+        dispatch_scrape()
+        dispatch_scrape(token)
+        self.assertEqual(apply_async.call_count, 2)
+        self.assertNotEqual(apply_async.call_args[0][0][0], token)
+
+    def test_loop_stops_without_running_crawl(self, apply_async, scrape_lcr_range):
+        dispatch_scrape()
+        apply_async.assert_not_called()
+        self.assertFalse(self.redis.exists(dispatcher.DispatchLoop.KEY))
+
+    def test_scrape_lcr_skips_beirut_and_mount_lebanon(self, apply_async, scrape_lcr_range):
+        with mock.patch.object(dispatch_scrape, 'delay'):
+            scrape_lcr()
+        self.assertEqual(
+            sorted(ScrapeCheckpoint.objects.values_list('governorate', flat=True)),
+            [gov for gov in Company.Governorate.values
+             if gov not in (Company.Governorate.BEIRUT, Company.Governorate.MOUNT_LEBANON)])
+
+
+class ScrapeErrorTests(TestCase):
+
+    def test_classify_error(self):
+        ErrorClass = ScrapeError.ErrorClass
+        server_error = requests.Response()
+        server_error.status_code = 503
+        for error, error_class in (
+                (EmptyPageError('No company on page'), ErrorClass.EMPTY),
+                (asyncio.TimeoutError(), ErrorClass.TIMEOUT),
+                (requests.Timeout(), ErrorClass.TIMEOUT),
+                (aiohttp.ClientResponseError(None, (), status=502), ErrorClass.SERVER),
+                (requests.HTTPError(response=server_error), ErrorClass.SERVER),
+                (aiohttp.ClientResponseError(None, (), status=404), ErrorClass.HTTP),
+                (aiohttp.ClientConnectionError(), ErrorClass.NETWORK),
+                (ConnectionResetError(), ErrorClass.NETWORK),
+                (DatabaseError(), ErrorClass.DATABASE),
+                (ValueError('No span with id DataList1_Label6_0 on page'), ErrorClass.PARSE)):
+            with self.subTest(error=error):
+                self.assertEqual(classify_error(error), error_class)
+
+    def test_retry_delay_doubles_up_to_the_maximum(self):
+        ErrorClass = ScrapeError.ErrorClass
+        self.assertEqual(get_retry_delay(ErrorClass.TIMEOUT, 1),
+                         timedelta(seconds=constants.RETRY_BASE_DELAY))
+        self.assertEqual(get_retry_delay(ErrorClass.TIMEOUT, 3),
+                         timedelta(seconds=4 * constants.RETRY_BASE_DELAY))
+        self.assertEqual(get_retry_delay(ErrorClass.EMPTY, 2),
+                         timedelta(seconds=min(2 * constants.EMPTY_RETRY_DELAY,
+                                               constants.RETRY_MAX_DELAY)))
+        self.assertEqual(get_retry_delay(ErrorClass.SERVER, 30),
+                         timedelta(seconds=constants.RETRY_MAX_DELAY))
+
+    def test_attempts_are_counted_until_given_up(self):
+        started = timezone.now()
+        scrape_error = record_scrape_error('3000000001', 'CO', asyncio.TimeoutError())
+        self.assertEqual(scrape_error.attempts, 1)
+        self.assertEqual(scrape_error.error_class, ScrapeError.ErrorClass.TIMEOUT)
+        self.assertGreaterEqual(scrape_error.next_retry_at,
+                                started + timedelta(seconds=constants.RETRY_BASE_DELAY))
+
+        for _ in range(constants.RETRY_MAX_ATTEMPTS - 1):
+            scrape_error = record_scrape_error('3000000001', 'PE', ValueError('Bad row'))
+        self.assertEqual(ScrapeError.objects.count(), 1)
+        self.assertEqual(scrape_error.attempts, constants.RETRY_MAX_ATTEMPTS)
+        self.assertEqual(scrape_error.error_class, ScrapeError.ErrorClass.PARSE)
+        self.assertIsNone(scrape_error.next_retry_at)
+
+
+class BulkWriterTests(TestCase):
+
+    def test_copy_writes_companies_and_personnel(self):
+        with BulkWriter() as writer:
+            writer.add(build_company(1, description='Trade, "import"\nand export'),
+                       [build_person('A', stock=5), build_person('B')])
+            writer.add(build_company(2), [])
+        self.assertEqual(writer.stats['companies'], 2)
+        self.assertEqual(writer.stats['persons'], 2)
+        company = Company.objects.get(cr_sub_id=1)
+        self.assertEqual(company.description, 'Trade, "import"\nand export')
+        people = {person.name: person for person in company.company.all()}
+        self.assertEqual(people['A'].stock, 5)
+        self.assertIsNone(people['A'].individual_id)
+        self.assertFalse(Person.objects.filter(company__cr_sub_id=2).exists())
+
+    def test_personnel_none_keeps_the_stored_people(self):
+        with BulkWriter() as writer:
+            writer.add(build_company(1), [build_person('A')])
+        with BulkWriter() as writer:
+            writer.add(build_company(1, name='Renamed'), None)
+        company = Company.objects.get(cr_sub_id=1)
+        self.assertEqual(company.name, 'Renamed')
+        self.assertEqual([person.name for person in company.company.all()], ['A'])
+
+    def test_company_added_twice_is_written_once(self):
+        with BulkWriter() as writer:
+            writer.add(build_company(1), [build_person('A')])
+            writer.add(build_company(1, name='Again'), [build_person('B')])
+        self.assertEqual(writer.buffered_rows, 0)
+        company = Company.objects.get(cr_sub_id=1)
+        self.assertEqual(company.name, 'Again')
+        self.assertEqual([person.name for person in company.company.all()], ['B'])
+
+    def test_flushes_once_max_rows_are_buffered(self):
+        writer = BulkWriter(max_rows=3)
+        writer.add(build_company(1), [build_person('A')])
+        self.assertFalse(Company.objects.exists())
+        writer.add(build_company(2), [])
+        self.assertEqual(Company.objects.count(), 2)
+        self.assertEqual(writer.stats['flushes'], 1)
+
+    def test_failed_batch_is_written_one_by_one(self):
+        with BulkWriter() as writer:
+            writer.add(build_company(1), [build_person('A')])
+            writer.add(build_company(2, name='x' * 300), [build_person('B')])
+            writer.add(build_company(3), [])
+        self.assertEqual(writer.failed, {build_cr_id(1, 2)})
+        self.assertEqual(writer.stats['companies'], 2)
+        self.assertEqual(sorted(Company.objects.values_list('cr_sub_id', flat=True)), [1, 3])
+        scrape_error = ScrapeError.objects.get()
+        self.assertEqual(scrape_error.cr_id, build_cr_id(1, 2))
+        self.assertEqual(scrape_error.error_class, ScrapeError.ErrorClass.DATABASE)
+
+    def test_without_copy(self):
+        with mock.patch.object(connection, 'vendor', 'sqlite'):
+            with BulkWriter() as writer:
+                writer.add(build_company(1), [build_person('A'), build_person('B')])
+        self.assertEqual(writer.stats, dict(writer.stats, companies=1, persons=2))
+        self.assertEqual(Person.objects.filter(company__cr_sub_id=1).count(), 2)
+
+
+"""
+Names and descriptions as the registry writes them: Arabic with
+diacritics, letter variants and Arabic digits, accented Latin, punctuation
+"""
+SEARCH_SAMPLES = (
+    'شركة المثال للتجارة ش.م.ل',
+    'مُؤَسَّسَةُ إيلي الخوري وأولاده - ٣',
+    'بيع مواد بناء، استيراد وتصدير (جملة ومفرق)',
+    'Société Générale de Banque au Liban S.A.L.',
+    'Élie Chaccour & Fils_Trading, co-founders: 2004/3',
+    'ﻻ تجارة  ـــ  مستشفى',
+    'Müller-Lüdenscheidt Ñandú Ça',
+)
+
+
+class SearchNormalizationTests(TestCase):
+
+    def test_normalize_text(self):
+        self.assertEqual(normalize_text('مُؤَسَّسَةُ إيلي ٣'), 'موسسه ايلي 3')
+        self.assertEqual(normalize_text('Élie CHACCOUR, S.A.L.'), 'elie chaccour s a l')
+        self.assertEqual(normalize_text(None), '')
+
+    def test_latin_and_arabic_names_share_skeletons(self):
+        self.assertEqual(latin_skeleton('خوري'), latin_skeleton('khoury'))
+        self.assertEqual(latin_skeleton('khouri'), 'khr')
+        self.assertEqual(search_key('Elie', 'KHOURY'), 'elie khoury l khr')
+
+    def test_sql_normalization_indexes_like_normalize_text(self):
+        """ Descriptions are indexed by api_normalize_text, queries use normalize_text """
+        with connection.cursor() as cursor:
+            for text in SEARCH_SAMPLES:
+                cursor.execute(
+                    "SELECT to_tsvector('simple', api_normalize_text(%s))::text, "
+                    "to_tsvector('simple', %s)::text",
+                    [text, normalize_text(text)])
+                sql_lexemes, python_lexemes = cursor.fetchone()
+                with self.subTest(text=text):
+                    self.assertEqual(sql_lexemes, python_lexemes)
+
+
+class RankedSearchAdminTests(TestCase):
+
+    def setUp(self):
+        upsert_companies([build_company(1, capital=10), build_company(2, capital=30),
+                          build_company(3, capital=20)])
+        self.model_admin = CompanyAdmin(Company, AdminSite())
+        # Ranked by capital, search_companies needs pg_trgm
+        self.model_admin.search_function = lambda queryset, query: queryset.annotate(
+            rank=F('capital')).order_by('-rank', 'id')
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def changelist_order(self, **params):
+        request = RequestFactory().get('/admin/api/company/', params)
+        request.user = self.user
+        changelist = self.model_admin.get_changelist_instance(request)
+        return [company.cr_sub_id for company in changelist.result_list]
+
+    def test_search_results_keep_their_rank(self):
+        self.assertEqual(self.changelist_order(q='company'), [2, 3, 1])
+
+    def test_sorted_column_wins_over_the_rank(self):
+        self.assertEqual(self.changelist_order(q='company', o='0'), [1, 2, 3])
+
+
+class ExportViewTests(TestCase):
+
+    def setUp(self):
+        cache.clear()  # Throttle history
+        with BulkWriter() as writer:
+            writer.add(build_company(1), [build_person('A')])
+        self.staff = User.objects.create_user('staff', password='password', is_staff=True)
+
+    def test_requires_a_staff_user(self):
+        self.assertEqual(self.client.get('/api/export/').status_code, 403)
+        User.objects.create_user('user', password='password')
+        self.client.login(username='user', password='password')
+        self.assertEqual(self.client.get('/api/export/').status_code, 403)
+
+    def test_streams_the_export(self):
+        self.client.force_login(self.staff)
+        response = self.client.get('/api/export/', {'format': 'jsonl'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertIn(b'Company 1', b''.join(response.streaming_content))
+
+    def test_invalid_format(self):
+        self.client.force_login(self.staff)
+        response = self.client.get('/api/export/', {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('detail', response.json())
+
+    @mock.patch.object(ExportThrottle, 'get_rate', return_value='2/hour')
+    def test_is_throttled(self, get_rate):
+        self.client.force_login(self.staff)
+        for _ in range(2):
+            self.assertEqual(self.client.get('/api/export/').status_code, 200)
+        self.assertEqual(self.client.get('/api/export/').status_code, 429)
+
+
+@mock.patch.object(views, 'render_prometheus', return_value='lcr_fetches_total 1\n')
+class MetricsViewTests(TestCase):
+
+    def test_requires_a_staff_user_or_the_token(self, render):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        with mock.patch.object(constants, 'METRICS_TOKEN', 'secret'):
+            response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, 403)
+        # No token configured, no token accepted
+        response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer ')
+        self.assertEqual(response.status_code, 403)
+        render.assert_not_called()
+
+    def test_staff_user(self, render):
+        self.client.force_login(
+            User.objects.create_user('staff', password='password', is_staff=True))
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'lcr_fetches_total 1\n')
+
+    @mock.patch.object(constants, 'METRICS_TOKEN', 'secret')
+    def test_token(self, render):
+        response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer secret',
+                                   HTTP_ACCEPT='text/plain;q=0.5')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+
+class StatsTriggerTests(TestCase):
+    """ The triggers of migration 0011 keep the statistics equal to check_stats' """
+
+    def write(self, *companies):
+        """ Writes the (company, personnel) pairs with a BulkWriter """
+        with BulkWriter() as writer:
+            for company, personnel in companies:
+                writer.add(company, personnel)
+        self.assertEqual(check_stats(), [])
+
+    def test_inserts_updates_and_deletes(self):
+        self.write((build_company(1, capital=5000),
+                    [build_person('A'), build_person('B', 'France')]),
+                   (build_company(2, gov=3, legal_form='SARL'), [build_person('C')]))
+        self.write((build_company(1, capital=20, company_status='Struck off',
+                                  registration_date=timezone.now() - timedelta(days=800)),
+                    [build_person('A', 'Syria')]),
+                   (build_company(2, gov=3, legal_form='SARL'), None))
+        upsert_companies([build_company(2, gov=3, capital=10 ** 9)])
+        company = Company.objects.get(cr_sub_id=1)
+        replace_personnel({company.id: [build_person('D', company=company),
+                                        build_person('E', company=company)]})
+        self.assertEqual(check_stats(), [])
+
+        Company.objects.filter(cr_sub_id=2).delete()
+        self.assertEqual(check_stats(), [])
+        summary = summarize_stats()
+        self.assertEqual(summary['companies'], 1)
+        self.assertEqual(summary['capital'], 20)
+        self.assertEqual(summary['nationalities'], [{'nationality': 'Lebanon', 'persons': 2}])
+
+    def test_without_copy(self):
+        with mock.patch.object(connection, 'vendor', 'sqlite'):
+            self.write((build_company(1), [build_person('A'), build_person('B')]))
+            self.write((build_company(1, gov=2), [build_person('A')]))
+
+    def test_check_stats_reports_drift(self):
+        self.write((build_company(1), [build_person('A')]))
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE api_companystats SET companies = companies + 1')
+        differences = check_stats()
+        self.assertEqual([model for model, *_ in differences], ['CompanyStats'])
+        self.assertEqual(differences[0][2][0], differences[0][3][0] + 1)
+        rebuild_stats()
+        self.assertEqual(check_stats(), [])
+
+
+class CoverageIndexTests(RedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.coverage = coverage.get_coverage_index()
+
+    def test_states(self):
+        self.coverage.record({(3, 2): coverage.SCRAPED, (3, 5): coverage.MISSING,
+                              (3, 9): coverage.FAILED, (4, 3): coverage.SCRAPED})
+        self.assertEqual(self.coverage.states(3, 1, 11).tolist(),
+                         [0, 1, 0, 0, 2, 0, 0, 0, 3, 0])
+        self.assertEqual(self.coverage.uncovered(4, 1, 5).tolist(), [1, 2, 4])
+        self.assertEqual(self.coverage.states(3, 5, 5).tolist(), [])
+
+    def test_newest_bucket_gives_the_state(self):
+        now = time.time()
+        self.coverage.record({(3, 1): coverage.SCRAPED, (3, 2): coverage.FAILED},
+                             now - constants.COVERAGE_BUCKET_SECONDS)
+        self.coverage.record({(3, 1): coverage.MISSING, (3, 2): coverage.SCRAPED}, now)
+        self.assertEqual(self.coverage.states(3, 1, 3).tolist(), [2, 1])
+        # Recorded again in the same bucket, the id keeps only its last state
+        self.coverage.record({(3, 1): coverage.FAILED}, now)
+        self.assertEqual(self.coverage.states(3, 1, 2).tolist(), [3])
+
+    def test_states_past_their_ttl_are_uncovered(self):
+        self.coverage.record({(3, 1): coverage.FAILED, (3, 2): coverage.SCRAPED},
+                             time.time() - 3 * constants.COVERAGE_FAILED_TTL)
+        self.assertEqual(self.coverage.states(3, 1, 3).tolist(), [0, 1])
+
+    @mock.patch.object(constants, 'COVERAGE_SCAN_SIZE', 16)
+    def test_next_chunk(self):
+        self.coverage.record({(3, cr_sub_id): coverage.SCRAPED
+                              for cr_sub_id in range(1, 100) if cr_sub_id % 10})
+        end, ids = self.coverage.next_chunk(3, 1, 100, 3)
+        self.assertEqual((end, ids.tolist()), (31, [10, 20, 30]))
+        end, ids = self.coverage.next_chunk(3, end, 100, 10)
+        self.assertEqual((end, ids.tolist()), (100, [40, 50, 60, 70, 80, 90]))
+        end, ids = self.coverage.next_chunk(3, 100, 100, 10)
+        self.assertEqual((end, ids.tolist()), (100, []))
+
+    def test_summary_and_reset(self):
+        self.coverage.record({(3, 1): coverage.SCRAPED, (3, 2): coverage.SCRAPED,
+                              (3, 3): coverage.MISSING, (4, 1): coverage.FAILED})
+        self.assertEqual(self.coverage.summary(3, 6),
+                         {'uncovered': 2, 'scraped': 2, 'missing': 1, 'failed': 0})
+        self.assertEqual(self.coverage.reset(3), len(coverage.STATES))
+        self.assertEqual(self.coverage.summary(3, 6)['uncovered'], 5)
+        self.assertEqual(self.coverage.summary(4, 2)['failed'], 1)
+
+    def test_error_state(self):
+        try:
+            try:
+                raise EmptyPageError()
+            except EmptyPageError:
+                raise ValueError()
+        except ValueError as e:
+            self.assertEqual(coverage.error_state(e), coverage.MISSING)
+        self.assertEqual(coverage.error_state(requests.ConnectionError()), coverage.FAILED)
+
+
+ACTIVE, STRUCK_OFF = 'قائمة', 'مشطوبة'
+
+
+class RecrawlPriorityTests(SimpleTestCase):
+
+    def test_priority(self):
+        now = timezone.now()
+        new = recrawl.get_priority(ACTIVE, now, 0, 0, now)
+        self.assertAlmostEqual(new, (1 + 0.5) / 2)
+        self.assertLess(recrawl.get_priority(STRUCK_OFF, now, 0, 0, now), new)
+        self.assertLess(recrawl.get_priority(ACTIVE, now - timedelta(days=3650), 0, 0, now), new)
+        self.assertLess(recrawl.get_priority(ACTIVE, now, 10, 0, now), new)
+        self.assertGreater(recrawl.get_priority(ACTIVE, now, 10, 10, now), new)
+        self.assertAlmostEqual(recrawl.get_priority('Other', None, 0, 0, now),
+                               constants.RECRAWL_DEFAULT_STATUS_WEIGHT * (1 + 0.5) / 2)
+
+    def test_interval(self):
+        self.assertEqual(recrawl.get_recrawl_interval(1).total_seconds(),
+                         constants.RECRAWL_MIN_INTERVAL)
+        self.assertEqual(recrawl.get_recrawl_interval(0.5).total_seconds(),
+                         2 * constants.RECRAWL_MIN_INTERVAL)
+        self.assertEqual(recrawl.get_recrawl_interval(0).total_seconds(),
+                         constants.RECRAWL_MAX_INTERVAL)
+
+
+class RecrawlTests(RedisTestCase):
+
+    def schedule(self, cr_sub_id, priority, due_in=-1, gov=1):
+        return RecrawlSchedule.objects.create(
+            cr_id=build_cr_id(gov, cr_sub_id), priority=priority,
+            next_check_at=timezone.now() + timedelta(seconds=due_in))
+
+    def test_schedule_checks(self):
+        upsert_companies([build_company(1, company_status=ACTIVE)])
+        cr_id = build_cr_id(1, 1)
+        self.assertEqual(recrawl.schedule_checks({cr_id: True, build_cr_id(1, 2): True}), 1)
+        first = RecrawlSchedule.objects.get()
+        self.assertEqual((first.checks, first.changes), (0, 0))
+
+        recrawl.schedule_checks({cr_id: True}, refresh=False)
+        self.assertEqual(RecrawlSchedule.objects.get().checks, 0)
+        recrawl.schedule_checks({cr_id: True})
+        recrawl.schedule_checks({cr_id: False})
+        schedule = RecrawlSchedule.objects.get()
+        self.assertEqual((schedule.checks, schedule.changes), (2, 1))
+        self.assertEqual(schedule.next_check_at - schedule.checked_at,
+                         recrawl.get_recrawl_interval(schedule.priority))
+
+    def test_claim_due_by_priority(self):
+        self.schedule(1, 0.2)
+        self.schedule(2, 0.9)
+        self.schedule(3, 1, due_in=60)
+        self.schedule(4, 0.5)
+        self.assertEqual(recrawl.claim_due(2), [build_cr_id(1, 2), build_cr_id(1, 4)])
+        # Claimed companies are not due again before RECRAWL_CLAIM_TIMEOUT
+        self.assertEqual(recrawl.claim_due(10), [build_cr_id(1, 1)])
+        self.assertEqual(recrawl.claim_due(10), [])
+        self.assertEqual(recrawl.claim_due(0), [])
+
+    @mock.patch.object(constants, 'RECRAWL_DAILY_BUDGET', 10)
+    def test_budget(self):
+        budget = recrawl.get_recrawl_budget()
+        self.assertEqual(budget.take(6), 6)
+        self.assertEqual(budget.take(6), 4)
+        self.assertEqual(budget.take(1), 0)
+        budget.give_back(3)
+        self.assertEqual(budget.spent(), 7)
+        self.assertEqual(budget.take(5), 3)
+
+    @mock.patch.object(constants, 'RECRAWL_NEW_IDS', 2)
+    @mock.patch.object(constants, 'RECRAWL_DAILY_BUDGET', 24 * 20)  # 20 a pass
+    def test_plan_recrawl(self):
+        upsert_companies([build_company(5, gov=1), build_company(3, gov=2)])
+        GovernorateIdSpace.objects.create(governorate=2, max_cr_sub_id=7)
+        self.schedule(1, 0.1)
+        self.schedule(2, 0.8, gov=3)
+        self.schedule(3, 0.9, due_in=60)
+        planned = recrawl.plan_recrawl()
+        self.assertEqual(planned[1], [6, 7, 1])
+        self.assertEqual(planned[2], [8, 9])
+        self.assertEqual(planned[3], [1, 2, 2])
+        self.assertEqual(sum(map(len, planned.values())), 2 * 6 + 2)
+        # The unspent share is given back
+        self.assertEqual(recrawl.get_recrawl_budget().spent(), 14)
+
+    @mock.patch.object(constants, 'RECRAWL_NEW_IDS', 1)
+    @mock.patch.object(constants, 'RECRAWL_DAILY_BUDGET', 24 * 3)  # 3 a pass
+    def test_plan_recrawl_within_the_budget(self):
+        self.schedule(1, 0.5)
+        planned = recrawl.plan_recrawl()
+        self.assertEqual(sum(map(len, planned.values())), 3)
+        self.assertEqual(RecrawlSchedule.objects.filter(
+            next_check_at__lte=timezone.now()).count(), 1)
+        self.assertEqual(recrawl.get_recrawl_budget().spent(), 3)
+
+    @mock.patch('api.tasks.scrape_lcr_ids')
+    def test_recrawl_lcr_queues_batches(self, scrape_lcr_ids):
+        self.schedule(1, 0.5)
+        with mock.patch.object(recrawl_lcr, 'apply_async') as apply_async:
+            planned = recrawl_lcr()
+        apply_async.assert_not_called()  # Sent by celery beat
+        self.assertEqual(planned[1], constants.RECRAWL_NEW_IDS + 1)
+        queued = {call.args[0]: call.args[1] for call in scrape_lcr_ids.delay.call_args_list}
+        self.assertIn(1, queued[1])
+
+
+@mock.patch.object(constants, 'SCRAPE_BATCH_SIZE', 500)
+class ChunkLeaseTests(RedisTestCase):
+
+    def claim_all(self, owner='node'):
+        chunks = []
+        while True:
+            chunk = dispatcher.claim_chunk(owner)
+            if chunk is None:
+                return chunks
+            chunks.append(chunk)
+
+    def test_claims_chunks_cut_from_the_cursor(self):
+        start_crawl(3, 1, 1201)
+        first = dispatcher.claim_chunk('a')
+        self.assertEqual((first.start, first.end, first.lease_owner, first.attempts),
+                         (1, 501, 'a', 1))
+        self.assertEqual(first.status, ScrapeChunk.Status.DISPATCHED)
+        self.assertEqual([(chunk.start, chunk.end) for chunk in self.claim_all('b')],
+                         [(501, 1001), (1001, 1201)])
+
+    def test_crawl_completes_once_every_chunk_is_done(self):
+        start_crawl(3, 1, 1001)
+        for chunk in self.claim_all():
+            dispatcher.complete_chunk(chunk.id, {})
+        self.assertIsNone(dispatcher.claim_chunk('node'))
+        self.assertEqual(ScrapeCheckpoint.objects.get(governorate=3).status,
+                         ScrapeCheckpoint.Status.COMPLETE)
+
+    def test_expired_lease_is_taken_over(self):
+        start_crawl(3, 1, 501)
+        chunk = dispatcher.claim_chunk('a')
+        self.assertIsNone(dispatcher.claim_chunk('b'))
+        ScrapeChunk.objects.filter(id=chunk.id).update(
+            lease_expires_at=timezone.now() - timedelta(seconds=1))
+        taken = dispatcher.claim_chunk('b')
+        self.assertEqual((taken.id, taken.lease_owner, taken.attempts), (chunk.id, 'b', 2))
+        # The first worker lost its lease: it can neither renew nor fail the chunk
+        self.assertFalse(dispatcher.renew_lease(chunk.id, 'a'))
+        dispatcher.fail_chunk(chunk.id, 'a')
+        self.assertEqual(ScrapeChunk.objects.get(id=chunk.id).status,
+                         ScrapeChunk.Status.DISPATCHED)
+        self.assertTrue(dispatcher.renew_lease(chunk.id, 'b'))
+        dispatcher.fail_chunk(chunk.id, 'b')
+        self.assertEqual(dispatcher.claim_chunk('c').id, chunk.id)
+
+    def test_failed_chunk_out_of_attempts_is_not_claimed(self):
+        start_crawl(3, 1, 501)
+        chunk = dispatcher.claim_chunk('a')
+        ScrapeChunk.objects.filter(id=chunk.id).update(
+            status=ScrapeChunk.Status.FAILED, attempts=constants.CHUNK_MAX_ATTEMPTS)
+        self.assertIsNone(dispatcher.claim_chunk('a'))
+
+    def test_locked_chunk_is_skipped(self):
+        start_crawl(3, 1, 1001)
+        dispatch_chunks(3)
+        ScrapeChunk.objects.update(status=ScrapeChunk.Status.PENDING)
+        locked = ScrapeChunk.objects.order_by('start').first()
+        skip_locked = ScrapeChunk.objects.select_for_update(skip_locked=True)
+        with mock.patch.object(ScrapeChunk.objects, 'select_for_update',
+                               return_value=skip_locked.exclude(id=locked.id)):
+            chunk = dispatcher.claim_chunk('node')
+        self.assertNotEqual(chunk.id, locked.id)
+
+    def test_claimed_chunk_ends_where_a_carried_chunk_starts(self):
+        ScrapeChunk.objects.create(governorate=3, start=301, end=801,
+                                   status=ScrapeChunk.Status.FAILED,
+                                   attempts=constants.CHUNK_MAX_ATTEMPTS)
+        start_crawl(3, 1, 1001)
+        # The carried chunk is claimed again, never cut a second time
+        self.assertEqual(sorted((chunk.start, chunk.end) for chunk in self.claim_all()),
+                         [(1, 301), (301, 801), (801, 1001)])
+
+    @mock.patch('api.management.commands.lease_worker.time.sleep')
+    @mock.patch('api.management.commands.lease_worker.scrape_lcr_range')
+    def test_lease_worker(self, scrape_lcr_range, sleep):
+        def scrape(gov, start, end, refresh, chunk_id, owner):
+            dispatcher.complete_chunk(chunk_id, {})
+            return dict.fromkeys(('scraped', 'unchanged', 'fetch_errors', 'scrape_errors',
+                                  'skipped', 'seconds', 'lease_lost'), 0)
+
+        scrape_lcr_range.side_effect = scrape
+        for gov in Company.Governorate.values:
+            GovernorateIdSpace.objects.create(governorate=gov, max_cr_sub_id=600)
+        errors = [DatabaseError('Connection lost')]
+
+        def claim_chunk(owner):
+            if errors:
+                raise errors.pop()
+            return dispatcher.claim_chunk(owner)
+
+        stderr = StringIO()
+        with mock.patch('api.management.commands.lease_worker.claim_chunk', claim_chunk):
+            call_command('lease_worker', start=True, exit_when_idle=True,
+                         stdout=StringIO(), stderr=stderr)
+        self.assertIn('Connection lost', stderr.getvalue())
+        sleep.assert_called_once_with(constants.LEASE_IDLE_SECONDS)
+        # Beirut and Mount Lebanon are not scraped
+        self.assertEqual(sorted({call.args[0] for call in scrape_lcr_range.call_args_list}),
+                         [3, 4, 5, 6])
+        self.assertEqual(scrape_lcr_range.call_count, 8)
+        self.assertFalse(ScrapeCheckpoint.objects.filter(
+            status=ScrapeCheckpoint.Status.RUNNING).exists())
+
+
+class EntityResolutionTests(TestCase):
+
+    def test_name_tokens_drop_articles(self):
+        self.assertEqual(name_tokens('إيلي الخوري'), ['ايلي', 'خوري'])
+        self.assertEqual(name_tokens('Elie El Khoury'), ['elie', 'khoury'])
+
+    def test_blocking_keys(self):
+        with_middle_name = blocking_keys('Elie Georges Khoury', 'Lebanon')
+        self.assertTrue(with_middle_name & blocking_keys('Elie Khoury', 'Lebanon'))
+        self.assertTrue(blocking_keys('إيلي خوري', 'Lebanon')
+                        & blocking_keys('Elie Khoury', 'lebanon'))
+        self.assertFalse(with_middle_name & blocking_keys('Elie Georges Khoury', 'France'))
+        self.assertEqual(blocking_keys('', 'Lebanon'), set())
+
+    def test_name_similarity(self):
+        self.assertEqual(name_similarity(['elie', 'khoury'], ['elie', 'khoury']), 1)
+        self.assertGreaterEqual(
+            name_similarity(['elie', 'khoury'], ['elie', 'georges', 'khoury']),
+            constants.RESOLUTION_MIN_SIMILARITY)
+        self.assertGreater(
+            name_similarity(['elie', 'george', 'khoury'], ['elie', 'georges', 'khoury']),
+            constants.RESOLUTION_MIN_SIMILARITY)
+        # One word too far from its counterpart, or two middle names more
+        self.assertEqual(name_similarity(['elie', 'khoury'], ['elie', 'haddad']), 0)
+        self.assertEqual(name_similarity(['elie', 'khoury'], ['elie', 'a', 'b', 'khoury']), 0)
+        self.assertEqual(name_similarity(['elie'], ['elie', 'khoury']), 0)
+
+    def resolve(self, *people):
+        """ Writes each (cr_sub_id, person) in its own company, resolves everyone """
+        with BulkWriter() as writer:
+            for cr_sub_id, person in people:
+                writer.add(build_company(cr_sub_id), [person])
+        resolve_individuals()
+        return {(person.company.cr_sub_id, person.name, person.nationality): person.individual_id
+                for person in Person.objects.select_related('company')}
+
+    def test_same_person_in_one_batch_shares_an_individual(self):
+        individuals = self.resolve(
+            (1, build_person('Elie Georges Khoury')), (2, build_person('Elie Khoury')),
+            (3, build_person('Elie el Khoury')), (4, build_person('Elie Khoury', 'France')),
+            (5, build_person('Elie Haddad')))
+        same = individuals[1, 'Elie Georges Khoury', 'Lebanon']
+        self.assertIsNotNone(same)
+        self.assertEqual(individuals[2, 'Elie Khoury', 'Lebanon'], same)
+        self.assertEqual(individuals[3, 'Elie el Khoury', 'Lebanon'], same)
+        self.assertNotEqual(individuals[4, 'Elie Khoury', 'France'], same)
+        self.assertNotEqual(individuals[5, 'Elie Haddad', 'Lebanon'], same)
+        self.assertEqual(Individual.objects.count(), 3)
+
+    def test_later_people_join_stored_individuals(self):
+        first = self.resolve((1, build_person('Elie Khoury')))[1, 'Elie Khoury', 'Lebanon']
+        individuals = self.resolve((2, build_person('Elie Georges Khoury')))
+        self.assertEqual(individuals[2, 'Elie Georges Khoury', 'Lebanon'], first)
+        self.assertEqual(resolve_individuals(), 0)
+
+        response = self.client.get(f'/api/individuals/{first}/companies/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(company['name'] for company in response.json()['results']),
+                         ['Company 1', 'Company 2'])
+
+
+class OwnershipGraphRefreshTests(TransactionTestCase):
+    """ The serving process builds and updates its own graph, in a thread """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for name, value in (('_ownership_graph', None), ('_refresh_thread', None),
+                            ('_refreshed_at', None)):
+            patcher = mock.patch.object(ownership_graph, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        settings = override_settings(GRAPH_INDEX_DIR=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.individual = Individual.objects.create(name='A', nationality='Lebanon',
+                                                    name_key='a')
+
+    def write(self, cr_sub_id):
+        with BulkWriter() as writer:
+            writer.add(build_company(cr_sub_id), [build_person('A', individual=self.individual)])
+        return Company.objects.get(cr_sub_id=cr_sub_id).id
+
+    def get_graph(self):
+        """ Graph served before and after the refresh thread ran """
+        graph = ownership_graph.get_ownership_graph()
+        ownership_graph._refresh_thread.join()
+        return graph, ownership_graph.get_ownership_graph()
+
+    def test_built_then_updated_by_the_serving_process(self):
+        first = self.write(1)
+        graph, built = self.get_graph()
+        self.assertIsNone(graph)
+        self.assertEqual(built.companies_of(self.individual.id), [first])
+
+        second = self.write(2)
+        # Not checked again before GRAPH_REFRESH_SECONDS
+        self.assertIs(ownership_graph.get_ownership_graph(), built)
+        with mock.patch.object(constants, 'GRAPH_REFRESH_SECONDS', 0):
+            graph, updated = self.get_graph()
+            self.assertIs(graph, built)  # Served while the update runs
+            self.assertEqual(updated.connected_companies(first), {second: 1})
+            # Nothing changed since, the graph is kept
+            self.assertIs(self.get_graph()[1], updated)
+
+    def test_graph_endpoints(self):
+        company_id, other_id = self.write(1), self.write(2)
+        response = self.client.get(f'/api/companies/{company_id}/network/')
+        self.assertEqual(response.status_code, 503)
+        ownership_graph._refresh_thread.join()
+        response = self.client.get(f'/api/companies/{company_id}/component/')
+        self.assertEqual(response.json(), {'count': 1, 'results': [other_id]})
+
+
+class BenchmarkMetricsTests(RedisTestCase):
+
+    def test_benchmarks_do_not_record_metrics(self):
+        recorder = metrics.get_metrics()
+        recorder.increment(metrics.PAGES_TOTAL, governorate=3, outcome='scraped')
+        results = run_benchmarks(stages=('parse', 'write', 'end_to_end'), repeat=1,
+                                 companies=5, pages=10)
+        self.assertGreater(results['stages']['end_to_end']['scraped'], 0)
+        self.assertIs(metrics.get_metrics(), recorder)
+        recorder.flush()
+        self.assertEqual(list(metrics.read_series(self.redis)), [
+            (metrics.PAGES_TOTAL, {'governorate': '3', 'outcome': 'scraped'}, {'value': 1.0})])
+
+
+class SyntheticRegistryTests(SimpleTestCase):
+    """ Synthetic pages parse like registry pages """
+
+    def test_page_parses(self):
+        registry = SyntheticRegistry({3: 100}, seed=0, missing_rate=0, no_personnel_rate=0)
+        parsed = parse_page(registry.page(build_cr_id(3, 5)))
+        self.assertIsNone(parsed.error)
+        self.assertEqual(parsed.company_record['registration_number'], '5')
+        self.assertTrue(parsed.company_record['name'])
+        self.assertFalse(parsed.company_record['missing_personnel_data'])
+        self.assertTrue(parsed.personnel_records)
+        for record in parsed.personnel_records:
+            self.assertTrue(record['name'])
+            self.assertTrue(record['nationality'])
+
+    def test_every_page_parses(self):
+        registry = SyntheticRegistry({3: 200}, seed=0)
+        for cr_sub_id in range(1, 201):
+            parsed = parse_page(registry.page(build_cr_id(3, cr_sub_id)))
+            if parsed.error is not None:
+                self.assertIsInstance(parsed.error, EmptyPageError)
+
+    def test_ids_past_the_id_space_are_empty(self):
+        registry = SyntheticRegistry({3: 100}, seed=0, missing_rate=0)
+        for cr_id in (build_cr_id(3, 101), build_cr_id(1, 0), 'invalid'):
+            with self.assertRaises(EmptyPageError):
+                LCRPage(registry.page(cr_id)).company_record()
+
+    def test_pages_are_deterministic(self):
+        cr_id = build_cr_id(3, 5)
+        self.assertEqual(SyntheticRegistry(seed=0).page(cr_id),
+                         SyntheticRegistry(seed=0).page(cr_id))
+        self.assertNotEqual(SyntheticRegistry(seed=0, missing_rate=0).page(cr_id),
+                            SyntheticRegistry(seed=1, missing_rate=0).page(cr_id))
+
+
+class FailingFetcher(FakeFetcher):
+    """ FakeFetcher whose connection breaks after `pages` pages """
+
+    def __init__(self, pages, **kwargs):
+        super().__init__(**kwargs)
+        self.pages = pages
+
+    async def fetch_many(self, ids):
+        async for result in super().fetch_many(ids):
+            if self.requests > self.pages:
+                raise aiohttp.ClientConnectionError('Connection lost')
+            yield result
+
+
+class ScrapePipelineTests(SimpleTestCase):
+    """ Pages parsed in the parse thread (pool=None) """
+
+    def stream(self, fetcher, ids, queue_size=2):
+        scrape_pipeline = pipeline.ScrapePipeline(None, queue_size=queue_size)
+        patcher = mock.patch.object(pipeline, 'LCRFetcher', return_value=fetcher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return scrape_pipeline, scrape_pipeline.stream([(3, cr_sub_id) for cr_sub_id in ids])
+
+    def test_every_page_is_fetched_and_parsed_in_order(self):
+        fetcher = FakeFetcher(existing=range(2, 51, 2), failing=[7])
+        scrape_pipeline, results = self.stream(fetcher, range(1, 51))
+        results = list(results)
+        self.assertEqual([result.cr_sub_id for result in results], list(range(1, 51)))
+        self.assertIsNone(results[6].parsed)
+        self.assertIsInstance(results[6].error, OSError)
+        self.assertEqual(results[1].parsed.company_record['name'], 'Company')
+        self.assertIsInstance(results[0].parsed.error, EmptyPageError)
+        self.assertEqual({stage: stats['pages'] for stage, stats in scrape_pipeline.stats.items()},
+                         {'fetch': 50, 'parse': 50, 'write': 50})
+
+    def test_backpressure(self):
+        fetcher = FakeFetcher(existing=range(1, 1001))
+        _, results = self.stream(fetcher, range(1, 1001))
+        next(results)
+        time.sleep(0.3)
+        # Each stage holds one page besides the queues of two pages
+        self.assertLessEqual(fetcher.requests, 1 + 2 * 2 + 3)
+        results.close()
+
+    def test_closing_the_stream_stops_every_stage(self):
+        fetcher = FakeFetcher(existing=range(1, 10001))
+        scrape_pipeline, results = self.stream(fetcher, range(1, 10001))
+        self.assertEqual([next(results).cr_sub_id for _ in range(3)], [1, 2, 3])
+        closing = threading.Thread(target=results.close, daemon=True)
+        closing.start()
+        closing.join(5)
+        self.assertFalse(closing.is_alive())
+        self.assertLess(fetcher.requests, 100)
+        self.assertEqual(scrape_pipeline.stats['write']['pages'], 3)
+
+    def test_fetch_error_is_raised_by_the_stream(self):
+        _, results = self.stream(FailingFetcher(5, existing=range(1, 101)), range(1, 101))
+        with self.assertRaises(aiohttp.ClientConnectionError):
+            for _ in results:
+                pass
+
+    def test_parse_error_is_raised_by_the_stream(self):
+        _, results = self.stream(FakeFetcher(existing=range(1, 101)), range(1, 101))
+        with mock.patch.object(pipeline, 'parse_page', side_effect=RuntimeError('Parse failed')):
+            with self.assertRaises(RuntimeError):
+                list(results)
+
+
+class SnapshotTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.individual = Individual.objects.create(name='A', nationality='Lebanon',
+                                                    name_key='a')
+        with BulkWriter() as writer:
+            writer.add(build_company(1, gov=3, capital=1000,
+                                     registration_date=datetime(2004, 3, 14, tzinfo=timezone.utc)),
+                       [build_person('A', stock=100, individual=self.individual),
+                        build_person('B', 'France', stock=5)])
+            writer.add(build_company(2, gov=3, legal_form='SARL', capital=50000,
+                                     registration_date=datetime(2010, 1, 1, tzinfo=timezone.utc)),
+                       [build_person('A', stock=300, individual=self.individual)])
+            writer.add(build_company(3, gov=4, capital=20,
+                                     registration_date=datetime(2010, 6, 1, tzinfo=timezone.utc)),
+                       [build_person('C', stock=50)])
+        self.snapshot = snapshot.write_snapshot(*snapshot.read_columns(), timezone.now(),
+                                                self.root)
+
+    def test_aggregate(self):
+        self.assertEqual(self.snapshot.aggregate(['legal_form'], 'capital'), [
+            {'legal_form': 'SAL', 'count': 2, 'sum_capital': 1020.0},
+            {'legal_form': 'SARL', 'count': 1, 'sum_capital': 50000.0},
+        ])
+        self.assertEqual(self.snapshot.aggregate(['nationality'], 'stock', persons=True), [
+            {'nationality': 'Lebanon', 'count': 3, 'sum_stock': 450.0},
+            {'nationality': 'France', 'count': 1, 'sum_stock': 5.0},
+        ])
+        self.assertEqual(self.snapshot.aggregate(['registration_year'], 'capital', 'max',
+                                                 order_by_count=False), [
+            {'registration_year': 2004, 'count': 1, 'max_capital': 1000.0},
+            {'registration_year': 2010, 'count': 2, 'max_capital': 50000.0},
+        ])
+        self.assertEqual(self.snapshot.aggregate(persons=True, governorate=3),
+                         [{'count': 3}])
+        with self.assertRaises(snapshot.SnapshotQueryError):
+            self.snapshot.aggregate(['name'])
+
+    def test_mask(self):
+        self.assertEqual(self.snapshot.mask(capital_min=1000).tolist(), [True, True, False])
+        self.assertEqual(self.snapshot.mask(registered_from='2005-01-01',
+                                            legal_form='SAL').tolist(), [False, False, True])
+        self.assertEqual(self.snapshot.mask(True, capital_max=1000).tolist(),
+                         [False, False, False, True])
+        self.assertFalse(self.snapshot.mask(legal_form='Unknown').any())
+
+    def test_top(self):
+        people = {(person.company.cr_sub_id, person.name): person.id
+                  for person in Person.objects.select_related('company')}
+        companies = dict(Company.objects.values_list('cr_sub_id', 'id'))
+        self.assertEqual(self.snapshot.top('stock', limit=2), [
+            {'person_id': people[2, 'A'], 'company_id': companies[2], 'stock': 300},
+            {'person_id': people[1, 'A'], 'company_id': companies[1], 'stock': 100},
+        ])
+        self.assertEqual(self.snapshot.top('stock', governorate=4),
+                         [{'person_id': people[3, 'C'], 'company_id': companies[3], 'stock': 50}])
+        self.assertEqual(self.snapshot.top('stock', by_individual=True), [
+            {'individual_id': self.individual.id, 'companies': 2, 'stock': 400.0}])
+
+    def test_analytics_builds_on_this_machine(self):
+        with override_settings(SNAPSHOT_DIR=self.root), \
+                mock.patch.object(snapshot, '_snapshot', None):
+            output = StringIO()
+            call_command('analytics', build=True, by=['governorate'], json=True, stdout=output)
+        self.assertEqual(json.loads(output.getvalue()), [
+            {'governorate': 3, 'count': 2}, {'governorate': 4, 'count': 1}])
+
+
+class SlowFetcher(FakeFetcher):
+    """ FakeFetcher taking `latency` seconds per page """
+
+    def __init__(self, latency, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    async def fetch_many(self, ids):
+        async for result in super().fetch_many(ids):
+            await asyncio.sleep(self.latency)
+            yield result
+
+
+@skipUnless(fakeredis, 'Requires fakeredis (pip install fakeredis)')
+@mock.patch('api.tasks.resolve_lcr_individuals')
+class LeaseHeartbeatTests(RedisMixin, TransactionTestCase):
+    """ Heartbeats renew leases from their own thread and connection """
+
+    def setUp(self):
+        super().setUp()
+        start_crawl(3, 1, 501)
+        self.chunk = dispatcher.claim_chunk('a')
+
+    def lease(self):
+        return ScrapeChunk.objects.values_list('lease_owner', 'lease_expires_at', 'status').get(
+            id=self.chunk.id)
+
+    @mock.patch.object(constants, 'LEASE_HEARTBEAT_INTERVAL', 0.05)
+    def test_lease_is_renewed_while_scraping(self, resolve_lcr_individuals):
+        fetcher = SlowFetcher(0.002, existing=range(1, 501))
+        with mock.patch('api.helpers.lcr_fetch.LCRFetcher', return_value=fetcher), \
+                mock.patch.object(dispatcher, 'renew_lease',
+                                  wraps=dispatcher.renew_lease) as renew_lease:
+            stats = scrape_lcr_range(3, 1, 501, chunk_id=self.chunk.id, owner='a')
+        self.assertGreater(renew_lease.call_count, 1)
+        renew_lease.assert_called_with(self.chunk.id, 'a')
+        self.assertFalse(stats['lease_lost'])
+        self.assertEqual(fetcher.requests, 500)
+        owner, _, status = self.lease()
+        self.assertEqual((owner, status), ('a', ScrapeChunk.Status.DONE))
+
+    @mock.patch.object(constants, 'LEASE_HEARTBEAT_INTERVAL', 0.05)
+    def test_scrape_stops_once_the_lease_is_lost(self, resolve_lcr_individuals):
+        def take_over():
+            # Expired lease claimed by another node, renewals wait for the row lock
+            with transaction.atomic():
+                ScrapeChunk.objects.filter(id=self.chunk.id).update(
+                    lease_expires_at=timezone.now() - timedelta(seconds=1))
+                self.assertEqual(dispatcher.claim_chunk('b').id, self.chunk.id)
+            connection.close()  # This thread's own connection
+
+        fetcher = SlowFetcher(0.01, existing=range(1, 501))
+        takeover = threading.Timer(0.2, take_over)
+        takeover.start()
+        with mock.patch('api.helpers.lcr_fetch.LCRFetcher', return_value=fetcher):
+            stats = scrape_lcr_range(3, 1, 501, chunk_id=self.chunk.id, owner='a')
+        takeover.join()
+        self.assertTrue(stats['lease_lost'])
+        self.assertLess(fetcher.requests, 100)
+        self.assertEqual(stats['scraped'], fetcher.requests)
+        # Left to the new owner
+        owner, _, status = self.lease()
+        self.assertEqual((owner, status), ('b', ScrapeChunk.Status.DISPATCHED))
@@ -0,0 +1,17 @@
+from api import views
+
+from django.urls import include, path
+from rest_framework import routers
+
+
+router = routers.DefaultRouter()
+router.register('companies', views.CompanyViewSet, basename='company')
+router.register('persons', views.PersonViewSet, basename='person')
+router.register('individuals', views.IndividualViewSet, basename='individual')
+router.register('stats', views.StatsViewSet, basename='stats')
+
+urlpatterns = [
+    path('export/', views.ExportView.as_view(), name='export'),
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
+    path('', include(router.urls)),
+]
@@ -1,3 +1,300 @@
-from django.shortcuts import render
+from api.models import Company, Individual, Person
+from api.serializers import (CompanySerializer, CompanySummarySerializer,
+                             IndividualSerializer, PersonSerializer)
+from api.helpers.search import search_companies, search_persons
+from api.helpers.ownership_graph import get_ownership_graph
+from api.helpers.export import (CONTENT_TYPES, ExportError, export_dataset,
+                                get_file_name)
+from api.helpers.metrics import render_prometheus
+from api.helpers.stats import summarize_stats
+from api import constants
 
-# Create your views here.
+from datetime import datetime, time, timedelta
+import hmac
+from django.utils.dateparse import parse_date
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.timezone import make_aware
+from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.pagination import CursorPagination
+from rest_framework.permissions import BasePermission, IsAdminUser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.throttling import UserRateThrottle
+from rest_framework.views import APIView
+
+
+class IdCursorPagination(CursorPagination):
+    """
+    Keyset pagination on the primary key: every page is an index range
+    scan starting after the last id of the previous page, so deep pages
+    cost as much as the first one and no COUNT is run
+    """
+    ordering = 'id'
+    page_size = constants.API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = constants.API_MAX_PAGE_SIZE
+
+
+class GraphUnavailable(APIException):
+    status_code = 503
+    default_detail = 'The ownership graph is being built, try again shortly.'
+    default_code = 'graph_unavailable'
+
+
+def get_int_param(request, name):
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError({name: 'Must be an integer.'})
+
+
+def get_date_param(request, name):
+    """ Start of the given day as an aware datetime """
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    date = parse_date(value)
+    if date is None:
+        raise ValidationError({name: 'Must be a date formatted YYYY-MM-DD.'})
+    return make_aware(datetime.combine(date, time.min))
+
+
+class SearchMixin:
+    """
+    search/?q=...: the limit (at most API_MAX_SEARCH_RESULTS) best matches
+    of search_function for the query, the listing filters still apply
+    """
+    search_function = None
+
+    @action(detail=False)
+    def search(self, request):
+        query = request.query_params.get('q', '')
+        if not query.strip():
+            raise ValidationError({'q': 'This parameter is required.'})
+        limit = get_int_param(request, 'limit') or constants.API_SEARCH_RESULTS
+        limit = min(max(limit, 1), constants.API_MAX_SEARCH_RESULTS)
+        results = self.search_function(self.get_queryset(), query)[:limit]
+        serializer = self.get_serializer(results, many=True)
+        return Response({'results': serializer.data})
+
+
+class NetworkMixin:
+    """
+    Traversals of the ownership graph from a company
+        - network/?hops=n: companies sharing individuals, up to
+          GRAPH_MAX_HOPS hops away, nearest first
+        - component/: every company connected to it
+      (both list at most API_MAX_PAGE_SIZE companies, count has them all)
+        - path/?to=id: shortest chain of companies and individuals to
+          another company
+    """
+
+    def get_graph_company(self, pk):
+        """ OwnershipGraph and the id of the company, 404 when it does not exist """
+        company = get_object_or_404(Company.objects.only('id'), pk=pk)
+        graph = get_ownership_graph()
+        if graph is None:
+            raise GraphUnavailable()
+        return graph, company.id
+
+    @action(detail=True)
+    def network(self, request, pk=None):
+        graph, company_id = self.get_graph_company(pk)
+        hops = min(max(get_int_param(request, 'hops') or 1, 1), constants.GRAPH_MAX_HOPS)
+        try:
+            companies = graph.connected_companies(company_id, hops)
+        except KeyError:
+            companies = {}  # Nobody in the company is resolved yet
+        return Response({
+            'hops': hops,
+            'count': len(companies),
+            'results': [{'id': other, 'hops': distance}
+                        for other, distance in sorted(companies.items(),
+                                                      key=lambda item: (item[1], item[0]))
+                        ][:constants.API_MAX_PAGE_SIZE],
+        })
+
+    @action(detail=True)
+    def component(self, request, pk=None):
+        graph, company_id = self.get_graph_company(pk)
+        try:
+            companies = graph.component(company_id)
+        except KeyError:
+            companies = []
+        return Response({'count': len(companies),
+                         'results': companies[:constants.API_MAX_PAGE_SIZE]})
+
+    @action(detail=True)
+    def path(self, request, pk=None):
+        graph, company_id = self.get_graph_company(pk)
+        other = get_int_param(request, 'to')
+        if other is None:
+            raise ValidationError({'to': 'This parameter is required.'})
+        get_object_or_404(Company.objects.only('id'), pk=other)
+        try:
+            path = graph.shortest_path(company_id, other)
+        except KeyError:
+            path = None
+        return Response({'path': None if path is None else [
+            {'type': node_type, 'id': node_id} for node_type, node_id in path]})
+
+
+class CompanyViewSet(SearchMixin, NetworkMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Companies with their personnel
+    Filters:
+        - governorate, legal_form, company_status: exact match
+        - registered_after, registered_before: registration date range (inclusive)
+    """
+    serializer_class = CompanySerializer
+    pagination_class = IdCursorPagination
+    search_function = staticmethod(search_companies)
+
+    def get_queryset(self):
+        queryset = Company.objects.prefetch_related('company')
+        params = self.request.query_params
+        governorate = get_int_param(self.request, 'governorate')
+        if governorate is not None:
+            queryset = queryset.filter(governorate=governorate)
+        for field in ('legal_form', 'company_status'):
+            if field in params:
+                queryset = queryset.filter(**{field: params[field]})
+        # Compared as datetimes so company_reg_date_idx can serve the range
+        registered_after = get_date_param(self.request, 'registered_after')
+        if registered_after is not None:
+            queryset = queryset.filter(registration_date__gte=registered_after)
+        registered_before = get_date_param(self.request, 'registered_before')
+        if registered_before is not None:
+            queryset = queryset.filter(
+                registration_date__lt=registered_before + timedelta(days=1))
+        return queryset
+
+
+class PersonViewSet(SearchMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    People, each with the id of their company and individual
+    Filters:
+        - company: company id
+        - individual: individual id
+    """
+    serializer_class = PersonSerializer
+    pagination_class = IdCursorPagination
+    search_function = staticmethod(search_persons)
+
+    def get_queryset(self):
+        queryset = Person.objects.all()
+        company = get_int_param(self.request, 'company')
+        if company is not None:
+            queryset = queryset.filter(company_id=company)
+        individual = get_int_param(self.request, 'individual')
+        if individual is not None:
+            queryset = queryset.filter(individual_id=individual)
+        return queryset
+
+
+class IndividualViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Individuals resolved from the people of every company
+        - companies/: every company the individual is in, an index lookup
+          on Person.individual
+    """
+    queryset = Individual.objects.all()
+    serializer_class = IndividualSerializer
+    pagination_class = IdCursorPagination
+
+    @action(detail=True)
+    def companies(self, request, pk=None):
+        individual = self.get_object()
+        queryset = Company.objects.filter(
+            id__in=Person.objects.filter(individual=individual).values('company_id'))
+        page = self.paginate_queryset(queryset)
+        serializer = CompanySummarySerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+
+class StatsViewSet(viewsets.ViewSet):
+    """
+    Company counts, capital and nationality breakdowns from the statistics
+    tables (see helpers/stats.py), optionally filtered by governorate,
+    legal_form and company_status
+    """
+
+    def list(self, request):
+        return Response(summarize_stats(
+            governorate=get_int_param(request, 'governorate'),
+            legal_form=request.query_params.get('legal_form'),
+            company_status=request.query_params.get('company_status'),
+        ))
+
+
+class ExportThrottle(UserRateThrottle):
+    scope = 'export'
+
+
+class FirstRendererNegotiation(DefaultContentNegotiation):
+    """
+    Views returning their own content render errors with their first
+    renderer, whatever the format parameter or Accept header asks for
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+class ExportView(APIView):
+    """
+    Streams the whole dataset (see helpers/export.py), to staff users only
+    and at the EXPORT_THROTTLE_RATE, every export scans the whole tables
+        - format: csv (default), jsonl or parquet
+        - compression: none (default) or gzip
+    """
+    permission_classes = [IsAdminUser]
+    throttle_classes = [ExportThrottle]
+    renderer_classes = [JSONRenderer]
+    content_negotiation_class = FirstRendererNegotiation
+
+    def get(self, request):
+        export_format = request.query_params.get('format', 'csv')
+        compression = request.query_params.get('compression', 'none')
+        try:
+            pieces = export_dataset(export_format, compression)
+        except ExportError as e:
+            return Response({'detail': str(e)}, status=400)
+        file_name = get_file_name(export_format, compression)
+        content_type = ('application/gzip' if file_name.endswith('.gz')
+                        else CONTENT_TYPES[export_format])
+        response = StreamingHttpResponse(pieces, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+        return response
+
+
+class HasMetricsToken(BasePermission):
+    """ Authorization: Bearer METRICS_TOKEN, never granted when it is unset """
+
+    def has_permission(self, request, view):
+        if not constants.METRICS_TOKEN:
+            return False
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(
+            token.strip().encode(), constants.METRICS_TOKEN.encode())
+
+
+class MetricsView(APIView):
+    """
+    Scrape and Celery metrics of every worker, for Prometheus, to staff
+    users and requests with the METRICS_TOKEN
+    """
+    permission_classes = [IsAdminUser | HasMetricsToken]
+    renderer_classes = [JSONRenderer]
+    content_negotiation_class = FirstRendererNegotiation
+
+    def get(self, request):
+        return HttpResponse(render_prometheus(),
+                            content_type='text/plain; version=0.0.4; charset=utf-8')
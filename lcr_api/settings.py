@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+from celery.schedules import crontab
 from pathlib import Path
 import os
 import dj_database_url
@@ -27,17 +28,90 @@ env = environ.Env(
 env_file = os.path.join(BASE_DIR, ".env")
 environ.Env.read_env(env_file)
 
-BEIRUT_SCRAPE_LIMIT = env('BEIRUT_SCRAPE_LIMIT')
-MOUNT_LEBANON_SCRAPE_LIMIT = env('MOUNT_LEBANON_SCRAPE_LIMIT')
-NORTH_LEBANON_SCRAPE_LIMIT = env('NORTH_LEBANON_SCRAPE_LIMIT')
-BEKAA_SCRAPE_LIMIT = env('BEKAA_SCRAPE_LIMIT')
-SOUTH_LEBANON_SCRAPE_LIMIT = env('SOUTH_LEBANON_SCRAPE_LIMIT')
-NABATIEH_SCRAPE_LIMIT = env('NABATIEH_SCRAPE_LIMIT')
+# Commercial Registry page URL, the cr_id is appended
+COMMERCIAL_REGISTRY_URL = env('COMMERCIAL_REGISTRY_URL',
+                              default='http://cr.justice.gov.lb/search/result.aspx?id=')
+
+# Fallbacks for governorates whose id space has not been probed yet
+BEIRUT_SCRAPE_LIMIT = env('BEIRUT_SCRAPE_LIMIT', default=0)
+MOUNT_LEBANON_SCRAPE_LIMIT = env('MOUNT_LEBANON_SCRAPE_LIMIT', default=0)
+NORTH_LEBANON_SCRAPE_LIMIT = env('NORTH_LEBANON_SCRAPE_LIMIT', default=0)
+BEKAA_SCRAPE_LIMIT = env('BEKAA_SCRAPE_LIMIT', default=0)
+SOUTH_LEBANON_SCRAPE_LIMIT = env('SOUTH_LEBANON_SCRAPE_LIMIT', default=0)
+NABATIEH_SCRAPE_LIMIT = env('NABATIEH_SCRAPE_LIMIT', default=0)
+
+# Directory of the raw page archive, archiving is disabled when unset
+PAGE_ARCHIVE_DIR = env('PAGE_ARCHIVE_DIR', default=None)
+
+# Directory of the memory-mapped company/individual ownership graph. It is
+# only read by the process serving the graph endpoints, which builds and
+# updates it itself (see get_ownership_graph), so a local, even ephemeral,
+# disk is enough and nothing has to be shared with the workers
+GRAPH_INDEX_DIR = env('GRAPH_INDEX_DIR', default=os.path.join(BASE_DIR, 'graph_index'))
+
+# Scrape ranges through the fetch/parse/write pipeline (helpers/pipeline.py).
+# Its parse processes need workers started with --pool solo or --pool threads,
+# prefork workers parse in a thread.
+SCRAPE_PIPELINE = env.bool('SCRAPE_PIPELINE', default=False)
+# Processes parsing pages in the pipeline, 0 parses in a thread
+SCRAPE_PARSE_PROCESSES = env.int('SCRAPE_PARSE_PROCESSES', default=os.cpu_count())
+
+# Registry requests per day spent on recrawling known companies
+RECRAWL_DAILY_BUDGET = env.int('RECRAWL_DAILY_BUDGET', default=20000)
+
+# Directory of the memory-mapped columnar snapshot queried by analytics. It
+# must be on the disk of the machine running analytics: on Heroku, where
+# every dyno has its own ephemeral disk, build it in the same one-off dyno
+# (analytics --build)
+SNAPSHOT_DIR = env('SNAPSHOT_DIR', default=os.path.join(BASE_DIR, 'snapshot'))
+
+# Directory benchmark_scrape writes its JSON results to
+BENCHMARK_RESULTS_DIR = env('BENCHMARK_RESULTS_DIR',
+                            default=os.path.join(BASE_DIR, 'benchmark_results'))
+
+# Bearer token Prometheus sends to read metrics/, staff users only when unset
+METRICS_TOKEN = env('METRICS_TOKEN', default=None)
+
+
+# Django REST Framework
+REST_FRAMEWORK = {
+    'DEFAULT_PERMISSION_CLASSES': [
+        'rest_framework.permissions.AllowAny',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        # Full dataset exports per staff user, each one scans every company and person
+        'export': env('EXPORT_THROTTLE_RATE', default='10/hour'),
+    },
+}
 
 
 # Celery
 CELERY_BROKER_URL = env('REDIS_URL')
 
+# Periodic tasks, sent by the beat process (see Procfile)
+CELERY_BEAT_SCHEDULE = {
+    # Daily, so scrape_lcr and recrawls know where new registrations end
+    'discover-lcr-id-space': {
+        'task': 'api.tasks.discover_lcr_id_space',
+        'schedule': crontab(hour=2, minute=0),
+    },
+    # Retries the ScrapeErrors that are due, more batches follow while a full one was due
+    'retry-scrape-errors': {
+        'task': 'api.tasks.retry_scrape_errors',
+        'schedule': crontab(minute='*/10'),
+    },
+    # Starts the dispatch_scrape loop again if it died, does nothing while it runs
+    'dispatch-scrape': {
+        'task': 'api.tasks.dispatch_scrape',
+        'schedule': crontab(minute='*/5'),
+    },
+    # Hourly, every RECRAWL_INTERVAL of api/constants.py (keep both in sync)
+    'recrawl-lcr': {
+        'task': 'api.tasks.recrawl_lcr',
+        'schedule': crontab(minute=30),
+    },
+}
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/3.1/howto/deployment/checklist/
@@ -60,6 +134,9 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
+    # Third party apps
+    'rest_framework',
     # Local apps
     'api',
 ]